@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Backend report
+--------------
+
+Compare the optimized inference backend of tree_detect.py with the eager
+deepforest model on a fixed test raster
+
+Both models predict the same windows. Boxes are matched per window by
+IoU, the report lists the timings, the share of matched boxes and the
+differences of the boxes and scores.
+
+"""
+
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+import torch
+from pathlib import Path
+from typing import List, NoReturn, Optional, Tuple
+from rasterio.windows import Window
+
+from tree_detect import compute_windows, get_logger, load_model, optimize_model, predict_windows
+from tree_detect import get_parser as get_detect_parser
+
+
+def time_predictions(
+    model,
+    dataset: rasterio.DatasetReader,
+    windows: List[Window],
+    batch_size: int
+) -> Tuple[List[Optional[pd.DataFrame]], float]:
+    """
+    Predict the windows, after one warm-up batch
+
+    :return: boxes of each window and seconds per window
+    """
+
+    predict_windows(model, dataset, windows[:batch_size], batch_size)
+
+    start = time.perf_counter()
+    boxes = predict_windows(model, dataset, windows, batch_size)
+
+    return boxes, (time.perf_counter() - start) / len(windows)
+
+
+def match_boxes(
+    expected: pd.DataFrame,
+    actual: pd.DataFrame,
+    iou_threshold: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Match boxes greedily by decreasing IoU
+
+    :return: indexes of matched expected and actual boxes and their IoU
+    """
+
+    a = expected[["xmin", "ymin", "xmax", "ymax"]].values.astype(float)
+    b = actual[["xmin", "ymin", "xmax", "ymax"]].values.astype(float)
+
+    width = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    height = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    intersection = width * height
+    areas_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    areas_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    iou = intersection / (areas_a[:, None] + areas_b[None, :] - intersection)
+
+    first, second, values = [], [], []
+    for index in np.argsort(-iou, axis=None):
+        i, j = np.unravel_index(index, iou.shape)
+        if iou[i, j] < iou_threshold:
+            break
+        if i in first or j in second:
+            continue
+        first.append(i)
+        second.append(j)
+        values.append(iou[i, j])
+
+    return np.array(first, dtype=int), np.array(second, dtype=int), np.array(values)
+
+
+def backend_report(
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Predict the test raster with the eager and the optimized model and
+    report their differences
+
+    :return: NoReturn
+    """
+
+    logger.info(f"Starting backend report with arguments {args}")
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    with rasterio.open(args.raster_path) as dataset:
+        rows = compute_windows(dataset.width, dataset.height, args.patch_size, args.patch_overlap)
+        windows = [window for _, row in rows for window in row][:args.max_windows]
+
+        logger.info(f"Starting eager prediction of {len(windows)} windows")
+        expected, eager_seconds = time_predictions(load_model(), dataset, windows, 1)
+
+        logger.info(f"Starting {args.backend} prediction of {len(windows)} windows")
+        model = optimize_model(load_model(), args, logger)
+        actual, backend_seconds = time_predictions(model, dataset, windows, args.batch_size)
+
+    expected_count = actual_count = 0
+    ious, box_differences, score_differences = [], [], []
+
+    for expected_boxes, actual_boxes in zip(expected, actual):
+        expected_count += 0 if expected_boxes is None else len(expected_boxes)
+        actual_count += 0 if actual_boxes is None else len(actual_boxes)
+        if expected_boxes is None or actual_boxes is None:
+            continue
+
+        i, j, iou = match_boxes(expected_boxes, actual_boxes, args.match_iou)
+        columns = ["xmin", "ymin", "xmax", "ymax"]
+        ious.extend(iou)
+        box_differences.extend(np.abs(expected_boxes[columns].values[i].astype(float) - actual_boxes[columns].values[j].astype(float)).max(axis=1))
+        score_differences.extend(np.abs(expected_boxes.score.values[i].astype(float) - actual_boxes.score.values[j].astype(float)))
+
+    matched = len(ious)
+    report = pd.Series({
+        "backend": args.backend + (" int8" if args.quantize else ""),
+        "windows": len(windows),
+        "batch_size": args.batch_size,
+        "eager_seconds_per_window": eager_seconds,
+        "backend_seconds_per_window": backend_seconds,
+        "speedup": eager_seconds / backend_seconds,
+        "eager_boxes": expected_count,
+        "backend_boxes": actual_count,
+        "matched_boxes": matched,
+        "matched_share_of_eager": matched / expected_count if expected_count else np.nan,
+        "mean_iou": np.mean(ious) if matched else np.nan,
+        "min_iou": np.min(ious) if matched else np.nan,
+        "max_box_difference_px": np.max(box_differences) if matched else np.nan,
+        "mean_score_difference": np.mean(score_differences) if matched else np.nan,
+        "max_score_difference": np.max(score_differences) if matched else np.nan
+    })
+
+    print(report.to_string())
+
+    if args.outputs:
+        report.to_frame().T.to_csv(args.outputs, index=False)
+
+    return
+
+
+def get_parser():
+    parser = get_detect_parser()
+    parser.description = "Compare the optimized inference backend with the eager model"
+    parser.set_defaults(backend="torchscript", outputs=None)
+    parser.add_argument(
+        "--max-windows",
+        type=int,
+        default=50,
+        help="Number of windows of the raster to compare (default: 50)"
+    )
+    parser.add_argument(
+        "--match-iou",
+        type=float,
+        default=0.5,
+        help="Minimum IoU of matching boxes (default: 0.5)"
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    # logger
+    logger = get_logger()
+
+    # args
+    args = get_parser().parse_args()
+
+    # backend report
+    backend_report(args=args, logger=logger)
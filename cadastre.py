@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Cadastre
+--------
+
+Load the tree cadastre of Konstanz from CSV or GeoJSON with compact dtypes
+
+Names and locations are categoricals and the measurements small nullable
+ints. The points are built from the X/Y columns of the CSV. The loaded
+cadastre is cached as Arrow IPC file named after the source and its
+modification time, so a changed source is read again and repeated loads
+only map the cached file.
+
+"""
+
+import os
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyarrow.feather as feather
+from pathlib import Path
+
+CACHE_DIR = Path("data/cache")
+
+CATEGORY_COLUMNS = ["location", "Name_dt", "Name_lat", "Name_Sym"]
+
+INT_DTYPES = {
+    "OBJECTID": "Int32",
+    "baumId": "Int32",
+    "baumNr": "Int16",
+    "baumart": "Int16",
+    "hoeheM": "Int8",
+    "kronendurchmesserM": "Int8",
+    "stammumfangCM": "Int16"
+}
+
+
+def read_source(path):
+    """
+    Reads the cadastre from CSV with X/Y columns in WGS84 or from any file
+    readable by geopandas
+    """
+    if Path(path).suffix.lower() == ".csv":
+        dtypes = {column: "category" for column in CATEGORY_COLUMNS}
+        dtypes.update(INT_DTYPES)
+        trees = pd.read_csv(path, encoding="utf-8-sig", dtype=dtypes)
+        geometry = gpd.points_from_xy(trees.X.values, trees.Y.values, crs="EPSG:4326")
+        trees = gpd.GeoDataFrame(trees, geometry=geometry)
+    else:
+        trees = gpd.read_file(path).to_crs("EPSG:4326")
+
+    trees = trees.drop(columns=[column for column in ["X", "Y"] if column in trees])
+
+    dtypes = {column: "category" for column in CATEGORY_COLUMNS if column in trees}
+    dtypes.update({column: dtype for column, dtype in INT_DTYPES.items() if column in trees})
+
+    return trees.astype(dtypes)
+
+
+def load_cadastre(path, cache_dir=CACHE_DIR):
+    """
+    Returns the cadastre trees with point geometry in EPSG:4326, from the
+    cache if the source did not change since it was cached
+
+    :param path: cadastre as CSV or GeoJSON
+    :param cache_dir: directory of cached copies, None to always read the source
+    """
+    path = Path(path)
+
+    if cache_dir is None:
+        return read_source(path)
+
+    cache_dir = Path(cache_dir)
+    cached = cache_dir / f"{path.name}.{path.stat().st_mtime_ns}.arrow"
+
+    if cached.exists():
+        trees = feather.read_table(cached, memory_map=True).to_pandas()
+        return gpd.GeoDataFrame(trees, geometry=shapely.from_wkb(trees.geometry.values), crs="EPSG:4326")
+
+    trees = read_source(path)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for stale in cache_dir.glob(f"{path.name}.*.arrow"):
+        stale.unlink()
+
+    # written under another name first, so readers never map a partial file
+    partial = cached.with_suffix(".partial")
+    trees.to_feather(partial, compression="uncompressed")
+    os.replace(partial, cached)
+
+    return trees
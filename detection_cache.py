@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Detection cache
+---------------
+
+SQLite cache of the boxes predicted in windows of ortho images
+
+Entries are keyed by a hash of the window pixels and a fingerprint of the
+model and its parameters, so unchanged windows are found again wherever
+they are in a raster and are not predicted again. The boxes are stored in
+window pixel coordinates before the NMS between windows.
+
+"""
+
+import sqlite3
+import hashlib
+import numpy as np
+import pandas as pd
+
+COLUMNS = ["xmin", "ymin", "xmax", "ymax", "label", "score"]
+
+
+class DetectionCache:
+    """
+    Window detection cache writing entries in batched transactions
+    """
+
+    def __init__(self, path, fingerprint, batch_size=100):
+        self.path = path
+        self.fingerprint = fingerprint.encode("utf-8")
+        self.batch_size = batch_size
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+        # several shard workers may share the cache
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS windows (key TEXT PRIMARY KEY, boxes BLOB NOT NULL)")
+        self.connection.commit()
+
+    def key(self, crop):
+        """
+        Returns the hash of the window pixels, their shape and the fingerprint
+        """
+        digest = hashlib.sha1(self.fingerprint)
+        digest.update(str(crop.shape).encode("utf-8"))
+        digest.update(np.ascontiguousarray(crop).tobytes())
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached boxes of a window, None if the window is not cached
+        """
+        row = self.connection.execute("SELECT boxes FROM windows WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        values = np.frombuffer(row[0], dtype="float32").reshape(-1, len(COLUMNS))
+        boxes = pd.DataFrame(values, columns=COLUMNS)
+        boxes["label"] = boxes.label.astype(int)
+
+        return boxes
+
+    def put(self, key, boxes):
+        """
+        Adds the boxes of a window, None if no tree was found
+        """
+        values = np.empty((0, len(COLUMNS)), dtype="float32") if boxes is None else boxes[COLUMNS].values.astype("float32")
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO windows (key, boxes) VALUES (?, ?)",
+            (key, sqlite3.Binary(values.tobytes())))
+
+        self.pending += 1
+
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Merged store
+------------
+
+GeoPackage of the merged trees for incremental merges
+
+The merged trees are one layer with point geometry, the R-tree of the
+GeoPackage answers the area queries and attribute indexes on baumId and
+detect_id the lookups of single trees. Area queries read plain columns
+with SQL. Rows are written through GDAL, which fills the R-tree, and
+deleted with plain SQL, the delete triggers of the R-tree only need
+SQLite.
+
+"""
+
+import sqlite3
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from pathlib import Path
+
+
+class MergedStore:
+    """
+    Layer of merged trees in a GeoPackage
+    """
+
+    def __init__(self, path, layer="trees"):
+        self.path = Path(path)
+        self.layer = layer
+
+    def exists(self):
+        return self.path.exists()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def rtree(self, connection):
+        """
+        Returns the name of the R-tree of the layer
+        """
+        column = connection.execute(
+            "SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?", (self.layer,)).fetchone()[0]
+
+        return f"rtree_{self.layer}_{column}"
+
+    def create(self, trees):
+        """
+        Writes all merged trees, replacing the store
+        """
+        if self.exists():
+            self.path.unlink()
+
+        trees.to_file(self.path, layer=self.layer, driver="GPKG")
+
+        with self.connect() as connection:
+            connection.execute(f'CREATE INDEX IF NOT EXISTS "{self.layer}_baumId" ON "{self.layer}" (baumId)')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS "{self.layer}_detect_id" ON "{self.layer}" (detect_id)')
+        connection.close()
+
+    def read(self, columns, areas=None):
+        """
+        Returns columns of the merged trees within any of the areas, given as
+        bounds, or of all merged trees, without geometry. Only SQLite is
+        used, GDAL turns every feature into Python objects one by one.
+        """
+        names = ", ".join(f't."{column}"' for column in columns)
+        connection = self.connect()
+        if areas is None:
+            rows = connection.execute(f'SELECT t.fid, {names} FROM "{self.layer}" t').fetchall()
+        else:
+            rtree = self.rtree(connection)
+            query = (
+                f'SELECT t.fid, {names} FROM "{self.layer}" t JOIN "{rtree}" r ON r.id = t.fid '
+                f'WHERE r.maxx >= ? AND r.maxy >= ? AND r.minx <= ? AND r.miny <= ?')
+            rows = [row for bounds in areas for row in connection.execute(query, tuple(map(float, bounds))).fetchall()]
+        connection.close()
+
+        trees = pd.DataFrame(rows, columns=["fid", *columns])
+
+        return trees.drop_duplicates("fid").drop(columns="fid").reset_index(drop=True)
+
+    def positions(self, baum_ids):
+        """
+        Returns the points of the stored trees with these baumIds as x and y
+        arrays
+        """
+        connection = self.connect()
+        rtree = self.rtree(connection)
+        rows = []
+        for start in range(0, len(baum_ids), 500):
+            chunk = [int(baum_id) for baum_id in baum_ids[start:start + 500]]
+            rows += connection.execute(
+                f'SELECT r.minx, r.miny FROM "{self.layer}" t JOIN "{rtree}" r ON r.id = t.fid '
+                f'WHERE t.baumId IN ({",".join("?" * len(chunk))})', chunk).fetchall()
+        connection.close()
+
+        rows = np.array(rows, dtype=float).reshape(-1, 2)
+
+        return rows[:, 0], rows[:, 1]
+
+    def next_detect_id(self):
+        """
+        Returns the first detect_id not used in the store
+        """
+        connection = self.connect()
+        value = connection.execute(f'SELECT MAX(detect_id) FROM "{self.layer}"').fetchone()[0]
+        connection.close()
+
+        return 0 if value is None else int(value) + 1
+
+    def delete(self, baum_ids, detect_ids):
+        """
+        Deletes the merged trees with these baumIds or detect_ids
+        """
+        with self.connect() as connection:
+            connection.executemany(f'DELETE FROM "{self.layer}" WHERE baumId = ?', [(int(i),) for i in baum_ids])
+            connection.executemany(f'DELETE FROM "{self.layer}" WHERE detect_id = ?', [(int(i),) for i in detect_ids])
+        connection.close()
+
+    def append(self, trees):
+        """
+        Appends merged trees
+        """
+        if len(trees):
+            trees.to_file(self.path, layer=self.layer, driver="GPKG", mode="a")
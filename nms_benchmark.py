@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+NMS benchmark
+-------------
+
+Compare the grid NMS of tree_detect.py with deepforest soft_nms and
+torchvision nms used by predict_tile
+
+The boxes are simulated as trees predicted in several overlapping windows
+or read from a CSV with xmin, ymin, xmax, ymax and score columns (e.g. the
+raw boxes of a sweep). The reference implementations compare all pairs of
+boxes, so they are only run up to --max-reference boxes.
+
+"""
+
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+from pathlib import Path
+from typing import NoReturn, Tuple
+from torchvision.ops import nms
+from deepforest import predict
+
+from tree_detect import IOU_THRESHOLD, get_logger, grid_nms, grid_soft_nms
+
+
+def simulate_boxes(count: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Simulate trees found in three overlapping windows each, with slightly
+    shifted boxes and independent scores
+
+    :return: boxes and scores
+    """
+
+    rng = np.random.default_rng(seed)
+    trees = count // 3
+    side = np.sqrt(trees) * 25
+
+    centers = np.repeat(rng.uniform(0, side, (trees, 2)), 3, axis=0) + rng.normal(0, 2, (trees * 3, 2))
+    sizes = np.repeat(rng.uniform(8, 40, trees), 3) + rng.normal(0, 2, trees * 3)
+    boxes = np.column_stack([
+        centers[:, 0] - sizes / 2, centers[:, 1] - sizes / 2,
+        centers[:, 0] + sizes / 2, centers[:, 1] + sizes / 2
+    ]).round().astype("float32")
+
+    return boxes, rng.uniform(0.05, 0.9, len(boxes)).astype("float32")
+
+
+def reference(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    args: argparse.Namespace
+) -> np.ndarray:
+    """
+    NMS of predict_tile
+
+    :return: indexes of kept boxes
+    """
+
+    tensor = torch.tensor(boxes, dtype=torch.float32)
+    scores = torch.tensor(scores, dtype=torch.float32)
+
+    if not args.use_soft_nms:
+        return nms(boxes=tensor, scores=scores, iou_threshold=IOU_THRESHOLD).numpy()
+
+    return predict.soft_nms(boxes=tensor, scores=scores, sigma=args.sigma, thresh=args.thresh).numpy()
+
+
+def grid(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    args: argparse.Namespace
+) -> np.ndarray:
+    """
+    NMS of tree_detect.py
+
+    :return: indexes of kept boxes
+    """
+
+    if not args.use_soft_nms:
+        return grid_nms(boxes, scores, iou_threshold=IOU_THRESHOLD)
+
+    return grid_soft_nms(boxes, scores, sigma=args.sigma, thresh=args.thresh)
+
+
+def nms_benchmark(
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Time both NMS implementations on growing numbers of boxes
+
+    :return: NoReturn
+    """
+
+    logger.info(f"Starting NMS benchmark with arguments {args}")
+
+    if args.boxes:
+        data = pd.read_csv(args.boxes)
+        all_boxes = data[["xmin", "ymin", "xmax", "ymax"]].values.astype("float32")
+        all_scores = data.score.values.astype("float32")
+
+    results = []
+
+    for count in args.counts:
+        if args.boxes:
+            boxes, scores = all_boxes[:count], all_scores[:count]
+        else:
+            boxes, scores = simulate_boxes(count, args.seed)
+
+        start = time.perf_counter()
+        kept = grid(boxes, scores, args)
+        grid_seconds = time.perf_counter() - start
+
+        result = {"boxes": len(boxes), "kept": len(kept), "grid_seconds": grid_seconds}
+
+        if len(boxes) <= args.max_reference:
+            start = time.perf_counter()
+            expected = reference(boxes, scores, args)
+            result["reference_seconds"] = time.perf_counter() - start
+            result["same_boxes"] = set(expected.tolist()) == set(kept.tolist())
+
+        logger.info(f"Finished {result}")
+        results.append(result)
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    if args.outputs:
+        results.to_csv(args.outputs, index=False)
+
+    return
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark grid NMS against predict_tile NMS")
+    parser.add_argument(
+        "--boxes",
+        type=Path,
+        help="CSV with xmin, ymin, xmax, ymax and score columns (default: simulated boxes)"
+    )
+    parser.add_argument(
+        "--counts",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 30000, 100000, 1000000],
+        help="Numbers of boxes (default: 1000 10000 30000 100000 1000000)"
+    )
+    parser.add_argument(
+        "--max-reference",
+        type=int,
+        default=30000,
+        help="Largest number of boxes for the predict_tile NMS (default: 30000)"
+    )
+    parser.add_argument(
+        "--use-soft-nms",
+        type=bool,
+        default=True,
+        help="Use Soft NMS (default: True)"
+    )
+    parser.add_argument(
+        "--sigma",
+        type=float,
+        default=0.01,
+        help="Variance of the Gaussian function of Soft NMS (default: 0.01)"
+    )
+    parser.add_argument(
+        "--thresh",
+        type=float,
+        default=0.1,
+        help="Score threshold after Soft NMS (default: 0.1)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the simulated boxes (default: 0)"
+    )
+    parser.add_argument(
+        "--outputs",
+        type=Path,
+        help="Path to the CSV of timings"
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    # logger
+    logger = get_logger()
+
+    # args
+    args = get_parser().parse_args()
+
+    # nms benchmark
+    nms_benchmark(args=args, logger=logger)
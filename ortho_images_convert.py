@@ -12,16 +12,28 @@ Source: https://github.com/jimutt/tiles-to-tiff
 
 """
 
+import csv
 import argparse
 import urllib.request
 import os
 import glob
+import time
 import shutil
-from osgeo import gdal
+import requests
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from xml.sax.saxutils import escape
+from osgeo import gdal, osr
+from tile_store import MBTilesStore
+from tile_coverage import load_coverage, xyz_tiles
 from math import log, tan, radians, cos, pi, floor, degrees, atan, sinh
 
 temp_dir = os.path.join(os.path.dirname(__file__), 'temp')
 
+user_agent = 'Mozilla/5.0 (X11; Linux x86_64) tiles-to-tiff/1.0 (+https://github.com/jimutt/tiles-to-tiff)'
+
+worker_tile_store = None  # tile store of the current worker process
+
 
 def sec(x):
     return(1/cos(x))
@@ -69,7 +81,16 @@ def tile_edges(x, y, z):
     return[lon1, lat1, lon2, lat2]
 
 
-def fetch_tile(x, y, z, tile_source):
+def fetch_tile(x, y, z, tile_source, tile_store=None):
+    if tile_store:
+        data = tile_store.get(z, x, y)
+        if data is None:
+            raise OSError(f"Tile {x},{y},{z} not in {tile_source}")
+        path = f'{temp_dir}/{x}_{y}_{z}.png'
+        with open(path, 'b+w') as f:
+            f.write(data)
+        return path
+
     url = tile_source.replace(
         "{x}", str(x)).replace(
         "{y}", str(y)).replace(
@@ -83,7 +104,7 @@ def fetch_tile(x, y, z, tile_source):
         url,
         data=None,
         headers={
-            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) tiles-to-tiff/1.0 (+https://github.com/jimutt/tiles-to-tiff)'
+            'User-Agent': user_agent
         }
     )
     g = urllib.request.urlopen(req)
@@ -92,27 +113,395 @@ def fetch_tile(x, y, z, tile_source):
     return path
 
 
-def merge_tiles(input_pattern, output_path):
+def merge_tiles(input_pattern, output_path, **output_options):
     vrt_path = temp_dir + "/tiles.vrt"
-    gdal.BuildVRT(vrt_path, glob.glob(input_pattern))
-    gdal.Translate(output_path, vrt_path)
+    # sorted, so the mosaic does not depend on the order the tiles were written in
+    gdal.BuildVRT(vrt_path, sorted(glob.glob(input_pattern)))
+    write_output(vrt_path, output_path, **output_options)
+
+
+def patch_mosaic(input_pattern, mosaic_path, **output_options):
+    """
+    Writes the georeferenced tiles over an existing mosaic, which keeps its
+    resolution and all pixels outside the tiles
+    """
+    vrt_path = temp_dir + "/patched.vrt"
+    patched_path = mosaic_path + ".patched.tif"
+
+    mosaic = gdal.Open(mosaic_path)
+    _, res_x, _, _, _, res_y = mosaic.GetGeoTransform()
+    mosaic = None
+
+    # later sources are drawn over earlier ones, so the tiles replace the old pixels
+    gdal.BuildVRT(vrt_path, [mosaic_path] + sorted(glob.glob(input_pattern)),
+                  resolution="user", xRes=res_x, yRes=abs(res_y))
+    write_output(vrt_path, patched_path, **output_options)
+    os.replace(patched_path, mosaic_path)
+
+
+def write_output(vrt_path, output_path, cog=False, compress="DEFLATE", quality=75, threads="ALL_CPUS"):
+    """
+    Writes the mosaic, as Cloud-Optimized GeoTIFF with internal tiles,
+    compression and overviews if cog is set
+    """
+    if not cog:
+        gdal.Translate(output_path, vrt_path)
+        return
+
+    if gdal.GetDriverByName("COG") is None:
+        raise RuntimeError("The COG driver requires GDAL >= 3.1")
+
+    creation_options = [
+        f"COMPRESS={compress}",
+        "BLOCKSIZE=512",
+        "OVERVIEWS=AUTO",
+        "OVERVIEW_RESAMPLING=AVERAGE",
+        f"NUM_THREADS={threads}",
+        "BIGTIFF=IF_SAFER",
+    ]
+    if compress in ("JPEG", "WEBP"):
+        creation_options.append(f"QUALITY={quality}")
+    elif compress in ("DEFLATE", "LZW"):
+        creation_options.append("PREDICTOR=YES")
+
+    gdal.SetConfigOption("GDAL_NUM_THREADS", str(threads))
+    gdal.Translate(output_path, vrt_path, format="COG", creationOptions=creation_options)
 
 
 def georeference_raster_tile(x, y, z, path):
     bounds = tile_edges(x, y, z)
-    gdal.Translate(os.path.join(temp_dir, f'{temp_dir}/{x}_{y}_{z}.tif'),
-                   path,
-                   outputSRS='EPSG:4326',
-                   outputBounds=bounds,
-                   rgbExpand='rgb')
+    ds = gdal.Translate(os.path.join(temp_dir, f'{temp_dir}/{x}_{y}_{z}.tif'),
+                        path,
+                        outputSRS='EPSG:4326',
+                        outputBounds=bounds,
+                        rgbExpand='rgb')
+    if ds is None:
+        raise OSError(gdal.GetLastErrorMsg())
+
+
+def init_worker(tile_source):
+    global worker_tile_store
+    if tile_source.endswith(".mbtiles"):
+        worker_tile_store = MBTilesStore(tile_source, readonly=True)
+
+
+def process_tile(tile):
+    """
+    Fetches and georeferences a tile
+
+    :return: the tile and the error message if it failed
+    """
+    x, y, z, tile_source = tile
+    try:
+        png_path = fetch_tile(x, y, z, tile_source, worker_tile_store)
+        georeference_raster_tile(x, y, z, png_path)
+    except Exception as error:
+        return x, y, str(error)
+    return x, y, None
+
+
+def process_tiles(tiles, z, tile_source, jobs=1):
+    """
+    Fetches and georeferences the tiles, in worker processes if jobs > 1
+
+    :return: the failed tiles with their error messages
+    """
+    work = [(x, y, z, tile_source) for x, y in tiles]
+
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(tile_source,))
+        results = executor.map(process_tile, work, chunksize=16)
+    else:
+        executor = None
+        init_worker(tile_source)
+        results = map(process_tile, work)
+
+    failed = []
+    start = time.perf_counter()
+
+    try:
+        for count, (x, y, error) in enumerate(results, 1):
+            if error is not None:
+                print(f"Error, failed to get {x},{y}: {error}")
+                failed.append((x, y, error))
+
+            if count % 100 == 0 or count == len(work):
+                elapsed = time.perf_counter() - start
+                print(f"{count}/{len(work)} tiles processed, {len(failed)} failed ({count / elapsed:.1f} tiles/s)")
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    return failed
+
+
+def write_failed_tiles(path, failed, z):
+    """
+    Writes the failed tiles in the format of --tiles for a later retry, the
+    list of an earlier run is removed if no tile failed
+    """
+    if not failed:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["zoom", "col", "row", "error"])
+        for x, y, error in sorted(failed):
+            writer.writerow([z, x, y, error])
+
+    print(f"{len(failed)} tiles failed, written to {path}")
+
+
+def tile_path(x, y, z, tile_source, tile_store=None):
+    """
+    GDAL path of a tile that reads it directly from the source
+    """
+    if tile_store:
+        data = tile_store.get(z, x, y)
+        if data is None:
+            return None
+        path = f'/vsimem/tiles/{x}_{y}_{z}.png'
+        gdal.FileFromMemBuffer(path, data)
+        return path
+
+    url = tile_source.replace(
+        "{x}", str(x)).replace(
+        "{y}", str(y)).replace(
+        "{z}", str(z))
+
+    if tile_source.startswith("http"):
+        return "/vsicurl/" + url
+
+    path = url.replace("file:///", "")
+    return path if os.path.exists(path) else None
+
+
+def tile_grid(tiles, z, tile_size):
+    """
+    Grid of a EPSG:4326 mosaic of the tiles with the average resolution of
+    the tiles, as BuildVRT computes it
+
+    :return: geotransform, width, height and the pixel window of each tile
+    """
+    x_min = min(x for x, _ in tiles)
+    x_max = max(x for x, _ in tiles)
+    y_min = min(y for _, y in tiles)
+    y_max = max(y for _, y in tiles)
+
+    lon_min = x_to_lon_edges(x_min, z)[0]
+    lon_max = x_to_lon_edges(x_max, z)[1]
+    lat_max = y_to_lat_edges(y_min, z)[0]
+    lat_min = y_to_lat_edges(y_max, z)[1]
+
+    width = (x_max - x_min + 1) * tile_size
+    height = (y_max - y_min + 1) * tile_size
+    res_x = (lon_max - lon_min) / width
+    res_y = (lat_max - lat_min) / height
+
+    windows = {}
+    for x, y in tiles:
+        lon1, lat1, lon2, lat2 = tile_edges(x, y, z)
+        windows[(x, y)] = ((lon1 - lon_min) / res_x, (lat_max - lat1) / res_y,
+                           (lon2 - lon1) / res_x, (lat1 - lat2) / res_y)
+
+    return (lon_min, res_x, 0, lat_max, 0, -res_y), width, height, windows
+
+
+def build_tile_vrt(vrt_path, tiles, z, tile_source, tile_store=None):
+    """
+    Writes a EPSG:4326 VRT placing every source tile at the window given by
+    its x/y/z, without any intermediate raster
+
+    :return: GDAL paths of the tiles and the failed tiles with their error
+        messages
+    """
+    paths = {}
+    failed = []
+    for x, y in tiles:
+        path = tile_path(x, y, z, tile_source, tile_store)
+        if path is None:
+            print(f"Error, failed to get {x},{y}")
+            failed.append((x, y, "Tile not found"))
+            continue
+        paths[(x, y)] = path
+
+    if not paths:
+        raise OSError("No tiles found")
+
+    # paletted and RGB tiles may be mixed, each tile is read as it is stored
+    paletted = {}
+    tile_size = None
+    for tile, path in paths.items():
+        dataset = gdal.Open(path)
+        if dataset is None:
+            raise OSError(f"Can't read tile {tile}: {gdal.GetLastErrorMsg()}")
+        if tile_size is None:
+            tile_size = dataset.RasterXSize
+        if (dataset.RasterXSize, dataset.RasterYSize) != (tile_size, tile_size):
+            raise OSError(f"Tile {tile} is {dataset.RasterXSize}x{dataset.RasterYSize} pixels, expected {tile_size}x{tile_size}")
+        paletted[tile] = dataset.GetRasterBand(1).GetColorTable() is not None
+        if not paletted[tile] and dataset.RasterCount < 3:
+            raise OSError(f"Tile {tile} has {dataset.RasterCount} bands without color table, expected RGB")
+        dataset = None
+
+    geotransform, width, height, windows = tile_grid(list(paths), z, tile_size)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+
+    bands = []
+    for band, color in enumerate(["Red", "Green", "Blue"], 1):
+        sources = []
+        for (x, y), path in sorted(paths.items()):
+            x_off, y_off, x_size, y_size = windows[(x, y)]
+            # paletted tiles are expanded to RGB like rgbExpand does
+            component = f"<ColorTableComponent>{band}</ColorTableComponent>" if paletted[(x, y)] else ""
+            sources.append(
+                f'<ComplexSource><SourceFilename relativeToVRT="0">{escape(path)}</SourceFilename>'
+                f'<SourceBand>{1 if paletted[(x, y)] else band}</SourceBand>'
+                f'<SrcRect xOff="0" yOff="0" xSize="{tile_size}" ySize="{tile_size}"/>'
+                f'<DstRect xOff="{x_off!r}" yOff="{y_off!r}" xSize="{x_size!r}" ySize="{y_size!r}"/>'
+                f'{component}</ComplexSource>')
+        bands.append(
+            f'<VRTRasterBand dataType="Byte" band="{band}"><ColorInterp>{color}</ColorInterp>'
+            + "\n".join(sources) + '</VRTRasterBand>')
+
+    with open(vrt_path, "w") as f:
+        f.write(f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">'
+                f'<SRS>{escape(srs.ExportToWkt())}</SRS>'
+                f'<GeoTransform>{", ".join(repr(v) for v in geotransform)}</GeoTransform>\n'
+                + "\n".join(bands) + '</VRTDataset>')
+
+    return list(paths.values()), failed
+
+
+def fetch_tile_data(x, y, z, tile_source, session):
+    """
+    Fetches a tile into memory, through the pooled session for URL sources
+    """
+    url = tile_source.replace(
+        "{x}", str(x)).replace(
+        "{y}", str(y)).replace(
+        "{z}", str(z))
 
-def convert(tile_source, output_dir, bounding_box, zoom):
+    if not tile_source.startswith("http"):
+        with open(url.replace("file:///", ""), "rb") as f:
+            return f.read()
+
+    response = session.get(url, headers={'User-Agent': user_agent})
+    response.raise_for_status()
+    return response.content
+
+
+def convert_in_memory(tiles, z, tile_source, output_path, max_inflight=16):
+    """
+    Fetches the tiles into memory and warps each one into the output as
+    soon as it arrives, through /vsimem/ datasets. No temporary files are
+    written and at most max_inflight tiles are held in memory.
+
+    :return: the failed tiles with their error messages
+    """
+    tile_store = MBTilesStore(tile_source, readonly=True) if tile_source.endswith(".mbtiles") else None
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_inflight)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    output = None
+    failed = []
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        def submit(x, y):
+            if not tile_store:
+                return executor.submit(fetch_tile_data, x, y, z, tile_source, session)
+
+            # the MBTiles connection can only be used by this thread
+            future = Future()
+            data = tile_store.get(z, x, y)
+            if data is None:
+                future.set_exception(OSError(f"Tile {x},{y},{z} not in {tile_source}"))
+            else:
+                future.set_result(data)
+            return future
+
+        remaining = iter(tiles)
+        pending = deque()
+
+        while len(pending) < max_inflight:
+            tile = next(remaining, None)
+            if tile is None:
+                break
+            pending.append((*tile, submit(*tile)))
+
+        count = 0
+        while pending:
+            x, y, future = pending.popleft()
+
+            tile = next(remaining, None)
+            if tile is not None:
+                pending.append((*tile, submit(*tile)))
+
+            count += 1
+            png_path = f'/vsimem/{x}_{y}_{z}.png'
+            vrt_path = f'/vsimem/{x}_{y}_{z}.vrt'
+            try:
+                gdal.FileFromMemBuffer(png_path, future.result())
+
+                # georeferenced like georeference_raster_tile, but only as VRT
+                tile = gdal.Translate(vrt_path, png_path, format="VRT",
+                                      outputSRS='EPSG:4326',
+                                      outputBounds=tile_edges(x, y, z),
+                                      rgbExpand='rgb')
+                if tile is None:
+                    raise OSError(gdal.GetLastErrorMsg())
+
+                if output is None:
+                    geotransform, width, height, _ = tile_grid(tiles, z, tile.RasterXSize)
+                    output = gdal.GetDriverByName("GTiff").Create(
+                        output_path, width, height, 3, gdal.GDT_Byte,
+                        options=["TILED=YES", "COMPRESS=DEFLATE", "SPARSE_OK=TRUE", "BIGTIFF=IF_SAFER"])
+                    output.SetGeoTransform(geotransform)
+                    output.SetProjection(tile.GetProjection())
+
+                if gdal.Warp(output, tile) is None:
+                    raise OSError(gdal.GetLastErrorMsg())
+                tile = None
+            except Exception as error:
+                print(f"Error, failed to get {x},{y}: {error}")
+                failed.append((x, y, str(error)))
+            finally:
+                gdal.Unlink(vrt_path)
+                gdal.Unlink(png_path)
+
+            if count % 100 == 0 or count == len(tiles):
+                elapsed = time.perf_counter() - start
+                print(f"{count}/{len(tiles)} tiles processed, {len(failed)} failed ({count / elapsed:.1f} tiles/s)")
+
+    if tile_store:
+        tile_store.close()
+
+    if output is None:
+        raise OSError("No tiles found")
+    output = None
+
+    return failed
+
+
+def read_tile_list(path, z):
+    with open(path) as f:
+        return [(int(tile["col"]), int(tile["row"])) for tile in csv.DictReader(f)
+                if int(tile["zoom"]) == z]
+
+
+def convert(tile_source, output_dir, bounding_box, zoom, coverage=None, buffer=0, tile_list=None, vrt=False, jobs=1,
+            in_memory=False, max_inflight=16, **output_options):
     lon_min, lat_min, lon_max, lat_max = bounding_box
 
     # Script start:
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -125,22 +514,72 @@ def convert(tile_source, output_dir, bounding_box, zoom):
     x_min, x_max, y_min, y_max = 14457, 14718, 26460, 26776
     print(x_min, x_max, y_min, y_max)
 
-    print(f"Fetching & georeferencing {(x_max - x_min + 1) * (y_max - y_min + 1)} tiles")
+    if tile_list and (vrt or in_memory) and os.path.exists(output_dir + '/merged.tif'):
+        # both build the mosaic from the listed tiles only
+        raise ValueError("--tiles can only patch an existing merged.tif without --vrt and --in-memory")
 
-    for x in range(x_min, x_max + 1):
-        for y in range(y_min, y_max + 1):
-            try:
-                png_path = fetch_tile(x, y, zoom, tile_source)
-                print(f"{x},{y} fetched")
-                georeference_raster_tile(x, y, zoom, png_path)
-            except OSError:
-                print(f"Error, failed to get {x},{y}")
-                pass
+    if tile_list:
+        tiles = read_tile_list(tile_list, zoom)
+    elif coverage:
+        tiles = xyz_tiles(load_coverage(coverage, buffer), zoom)
+    else:
+        tiles = [(x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+
+    print(f"Fetching & georeferencing {len(tiles)} tiles")
+
+    if in_memory:
+        output_path = output_dir + '/merged.tif'
+        if output_options.get("cog"):
+            output_path = output_dir + '/merged.gtiff.tif'
+
+        failed = convert_in_memory(tiles, zoom, tile_source, output_path, max_inflight)
+
+        write_failed_tiles(output_dir + '/failed_tiles.csv', failed, zoom)
+
+        if output_options.get("cog"):
+            print("Writing Cloud-Optimized GeoTIFF")
+            write_output(output_path, output_dir + '/merged.tif', **output_options)
+            os.remove(output_path)
+
+        print("Merge complete")
+        return
+
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
+
+    if vrt:
+        tile_store = MBTilesStore(tile_source, readonly=True) if tile_source.endswith(".mbtiles") else None
+
+        print("Building VRT of the source tiles")
+        gdal.SetConfigOption('GDAL_HTTP_USERAGENT', user_agent)
+        paths, failed = build_tile_vrt(temp_dir + "/tiles.vrt", tiles, zoom, tile_source, tile_store)
+        if tile_store:
+            tile_store.close()
+
+        write_failed_tiles(output_dir + '/failed_tiles.csv', failed, zoom)
+
+        print("Merging tiles")
+        write_output(temp_dir + "/tiles.vrt", output_dir + '/merged.tif', **output_options)
+        print("Merge complete")
+
+        for path in paths:
+            if path.startswith('/vsimem/'):
+                gdal.Unlink(path)
+        shutil.rmtree(temp_dir)
+        return
+
+    failed = process_tiles(tiles, zoom, tile_source, jobs)
 
     print("Resolving and georeferencing of raster tiles complete")
 
-    print("Merging tiles")
-    merge_tiles(temp_dir + '/*.tif', output_dir + '/merged.tif')
+    write_failed_tiles(output_dir + '/failed_tiles.csv', failed, zoom)
+
+    if tile_list and os.path.exists(output_dir + '/merged.tif'):
+        print("Patching tiles into the existing mosaic")
+        patch_mosaic(temp_dir + '/*.tif', output_dir + '/merged.tif', **output_options)
+    else:
+        print("Merging tiles")
+        merge_tiles(temp_dir + '/*.tif', output_dir + '/merged.tif', **output_options)
     print("Merge complete")
 
     shutil.rmtree(temp_dir)
@@ -148,18 +587,37 @@ def convert(tile_source, output_dir, bounding_box, zoom):
 
 def main():
     parser = argparse.ArgumentParser("tiles_to_tiff", "python tiles_to_tiff https://tileserver-url.com/{z}/{x}/{y}.png 21.49147 65.31016 21.5 65.31688 -o output -z 17")
-    parser.add_argument("tile_source", type=str, help="Local directory pattern or URL pattern to a slippy maps tile source.", )
+    parser.add_argument("tile_source", type=str, help="Local directory pattern, URL pattern or MBTiles file of a slippy maps tile source.", )
     parser.add_argument("lng_min", type=float, help="Min longitude of bounding box")
     parser.add_argument("lat_min", type=float, help="Min latitude of bounding box")
     parser.add_argument("lng_max", type=float, help="Max longitude of bounding box")
     parser.add_argument("lat_max", type=float, help="Max latitude of bounding box")
     parser.add_argument("-z", "--zoom", type=int, help="Tilesource zoom level", default=14)
     parser.add_argument("-o", "--output", type=str, help="Output directory", required=True)
+    parser.add_argument("--coverage", type=str, help="Polygon file or CSV with X/Y points, only tiles intersecting it are converted", default=None)
+    parser.add_argument("--buffer", type=float, help="Buffer (in meters) around the coverage geometries", default=0)
+    parser.add_argument("--tiles", type=str, help="CSV with zoom,col,row of the tiles to convert, e.g. the changed_tiles.csv of a download refresh. The tiles are patched into an existing merged.tif", default=None)
+    parser.add_argument("--vrt", action="store_true", help="Georeference the tiles in a single VRT pointing at the source tiles instead of temporary GeoTIFFs")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes fetching and georeferencing tiles", default=1)
+    parser.add_argument("--in-memory", action="store_true", help="Fetch the tiles into memory and warp them straight into the output, without temporary files (with --cog the mosaic is copied once more)")
+    parser.add_argument("--max-inflight", type=int, help="Maximum number of tiles fetched and held in memory at once with --in-memory", default=16)
+    parser.add_argument("--cog", action="store_true", help="Write a Cloud-Optimized GeoTIFF with internal tiles, compression and overviews")
+    parser.add_argument("--compress", type=str, help="Compression of the Cloud-Optimized GeoTIFF", default="DEFLATE",
+                        choices=["DEFLATE", "LZW", "JPEG", "WEBP", "NONE"])
+    parser.add_argument("--quality", type=int, help="Quality of JPEG and WEBP compression", default=75)
+    parser.add_argument("--threads", type=str, help="Number of threads encoding the Cloud-Optimized GeoTIFF", default="ALL_CPUS")
 
     args = parser.parse_args()
 
-    tile_source = args.tile_source if args.tile_source.startswith("http") else "file:///" + args.tile_source
+    tile_source = args.tile_source
+    if not tile_source.startswith("http") and not tile_source.endswith(".mbtiles"):
+        tile_source = "file:///" + tile_source
+
+    convert(tile_source, args.output, [args.lng_min, args.lat_min, args.lng_max, args.lat_max], args.zoom,
+            coverage=args.coverage, buffer=args.buffer, tile_list=args.tiles, vrt=args.vrt, jobs=args.jobs,
+            in_memory=args.in_memory, max_inflight=args.max_inflight,
+            cog=args.cog, compress=args.compress, quality=args.quality, threads=args.threads)
 
-    convert(tile_source, args.output, [args.lng_min, args.lat_min, args.lng_max, args.lat_max], args.zoom)
 
-main()
+if __name__ == "__main__":
+    main()
@@ -15,24 +15,43 @@ Source: https://github.com/GastonZalba/wmts-downloader
 import os
 import time
 import math
+import random
 import shutil
+import sqlite3
+import hashlib
 import tempfile
 import argparse
+import threading
 import traceback
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from owslib.wmts import WebMapTileService
+from tile_store import MBTilesStore
+from tile_coverage import load_coverage, matrix_tiles
 
 
 tmp_folder = f'{tempfile.gettempdir()}/wmts-downloader'
 output_folder = 'output'
+store = 'files'
 
 zoom = 15
 format = 'image/png'
 url = ''
 proj = 'EPSG:3857'
-limit_requests = 0
 bbox = None
+coverage = None
+buffer = 0
 
-sleep = 0  # sleep time between request
+workers = 1  # concurrent downloads
+rate = 10  # max requests per second
+max_inflight = 0  # max requests in flight, defaults to the number of workers
+retries = 5  # retries per tile
+backoff = 1  # base backoff time (in seconds) between retries
+
+manifest_file = 'manifest.sqlite'
+changed_tiles_file = 'changed_tiles.csv'
+
+session_local = threading.local()
 
 parser = argparse.ArgumentParser(
     description='Script to download images from a WMTS service')
@@ -46,24 +65,38 @@ parser.add_argument('--layer', type=str, metavar='Layer name', required=True,
                     help='Layer name (default: %(default)s)')
 parser.add_argument('--format', type=str, metavar='Image format', default=format,
                     help='Image format supported by the geoserver (default: %(default)s)')
-parser.add_argument('--zoom', type=int, metavar='Zoom level', default=zoom,
-                    help='Zoom level. Higher number is more detail, and more images (default: %(default)s)')
+parser.add_argument('--zoom', type=int, metavar='Zoom level', nargs='+', default=[zoom],
+                    help='Zoom levels. Higher number is more detail, and more images. Separate each value with a space (default: %(default)s)')
 parser.add_argument('--proj', type=str, metavar='EPSG projection code', default=proj,
                     help='EPSG projection code existing in the geoserver (default: %(default)s)')
 parser.add_argument('--output', type=str, metavar='Output folder',
                     default=output_folder,
                     help='Folder path to save the images (default: %(default)s)')
-parser.add_argument('--limit', type=int, metavar='Limit requests number',
-                    default=limit_requests,
-                    help='Limit the number of requests to avoid overloading the server (default: %(default)s)')
+parser.add_argument('--store', type=str, metavar='Tile store', default=store,
+                    choices=['files', 'mbtiles'],
+                    help='Save the tiles as {col}/{row} files or in a single MBTiles container per layer and projection (default: %(default)s)')
 parser.add_argument('--removeold', action='store_true',
                     help='Remove already downloaded files (default: %(default)s)')
-parser.add_argument('--sleep', type=float, metavar='Sleep time', default=sleep,
-                    help='Sleep time (in seconds) betweeen each reques to avoid overloading the server (default: %(default)s)')
 parser.add_argument('--bbox', type=str, metavar='Bounding Box', nargs='+', default=bbox,
                     help='Bounding Box of interest to filter the requests. Separate each value with a space (default: %(default)s)')
-
-args = parser.parse_args()
+parser.add_argument('--coverage', type=str, metavar='Coverage file', default=coverage,
+                    help='Polygon file (e.g. GeoJSON city boundary) or CSV with X/Y points; only tiles intersecting it are downloaded (default: %(default)s)')
+parser.add_argument('--buffer', type=float, metavar='Buffer', default=buffer,
+                    help='Buffer (in meters) around the coverage geometries (default: %(default)s)')
+parser.add_argument('--workers', type=int, metavar='Workers', default=workers,
+                    help='Number of tiles downloaded concurrently, each worker keeps its own keep-alive connection (default: %(default)s)')
+parser.add_argument('--rate', type=float, metavar='Requests per second', default=rate,
+                    help='Maximum request rate, lowered automatically when the server answers with 429/5xx (default: %(default)s)')
+parser.add_argument('--max-inflight', type=int, metavar='Requests in flight', default=max_inflight,
+                    help='Maximum number of requests in flight, 0 uses the number of workers (default: %(default)s)')
+parser.add_argument('--retries', type=int, metavar='Retries', default=retries,
+                    help='Retries per tile with exponential backoff before the tile is recorded as failed (default: %(default)s)')
+parser.add_argument('--retry-failed', action='store_true',
+                    help=f'Only download the tiles recorded as failed in the {manifest_file} of a previous run (default: %(default)s)')
+parser.add_argument('--refresh', action='store_true',
+                    help=f'Request the already downloaded tiles again with conditional requests and replace the changed ones, the new and changed tiles are listed in {changed_tiles_file} (default: %(default)s)')
+parser.add_argument('--verify', action='store_true',
+                    help='Check the size of the downloaded tiles against the manifest and download missing or truncated tiles again (default: %(default)s)')
 
 
 def init():
@@ -86,17 +119,21 @@ def init():
         username = args.username
         password = args.password
         format = args.format
-        zoom = int(args.zoom)
+        zooms = args.zoom
         proj = args.proj
         layer_id = args.layer
         output_folder = args.output
-        limit_requests = args.limit
         remove_old = args.removeold
-        sleep = args.sleep
         bbox = args.bbox
 
-        download_count = 1
+        download_count = 0
         skip_count = 0
+        failed = []
+        changed = []
+        manifest = None
+        tile_store = None
+        executor = None
+        total_tiles = 0
 
         print(f'Connecting to server: {url}')
 
@@ -144,101 +181,160 @@ def init():
 
                         tile_matrix = wmts.tilematrixsets[tile_matrix_set].tilematrix
 
-                        for tml in tile_matrix:
+                        extension = format.split("/")[-1]
 
-                            z = int(tml.split(":")[-1])
+                        if args.store == 'mbtiles':
+                            store_path = f'{args.output}/{layer_id}/{proj.replace(":", "-")}.mbtiles'
+                            print(f'--> Writing tiles to {store_path}')
 
-                            if z == zoom:
-                                limit = tml
+                            os.makedirs(os.path.dirname(store_path), exist_ok=True)
 
-                        matrix_limits = tile_matrix_link.tilematrixlimits[limit]
+                            tile_store = MBTilesStore(store_path)
+                            tile_store.set_metadata(
+                                name=layer_id, format=extension, type='baselayer')
 
-                        # important
-                        matrix = tile_matrix[limit]
+                        if args.coverage:
+                            area = load_coverage(args.coverage, args.buffer)
 
-                        min_row = matrix_limits.mintilerow
-                        max_row = matrix_limits.maxtilerow
+                        workers = max(1, args.workers)
+                        limiter = RateLimiter(args.rate, args.max_inflight or workers)
 
-                        min_col = matrix_limits.mintilecol
-                        max_col = matrix_limits.maxtilecol
+                        # the worker threads and their keep-alive sessions are shared by all zoom levels
+                        executor = ThreadPoolExecutor(max_workers=workers)
 
-                        print(min_col, max_col, min_row, max_row)
+                        for zoom in zooms:
 
-                        # check if output folder exists
-                        output_folder = f'{output_folder}/{layer_id}/{proj.replace(":", "-")}/{zoom}'
+                            limit = next((tml for tml in tile_matrix if int(tml.split(":")[-1]) == zoom), None)
 
-                        if remove_old:
-                            if os.path.exists(output_folder):
-                                print('Removing old files...')
-                                shutil.rmtree(output_folder)
+                            if limit is None or limit not in tile_matrix_link.tilematrixlimits:
+                                print(f'--> Zoom level {zoom} not in tile matrix set {tile_matrix_set}, skipped')
+                                continue
 
-                        # create folder if not exists
-                        if not os.path.exists(output_folder):
-                            os.makedirs(output_folder)
+                            matrix_limits = tile_matrix_link.tilematrixlimits[limit]
 
-                        print('\t')
-                        print('Downloading images...')
+                            # important
+                            matrix = tile_matrix[limit]
 
-                        if bbox:
-                            (f_min_col, f_max_col, f_min_row,
-                             f_max_row) = filter_row_cols_by_bbox(matrix, bbox)
+                            min_row = matrix_limits.mintilerow
+                            max_row = matrix_limits.maxtilerow
 
-                            print(f_min_col, f_max_col, f_min_row, f_max_row)
+                            min_col = matrix_limits.mintilecol
+                            max_col = matrix_limits.maxtilecol
 
-                            # clamp values
-                            min_col = f_min_col if f_min_col >= min_col else min_col
-                            max_col = f_max_col if f_max_col <= max_col else max_col
-                            min_row = f_min_row if f_min_row >= min_row else min_row
-                            max_row = f_max_row if f_max_row <= max_row else max_row
+                            print(min_col, max_col, min_row, max_row)
 
-                        print(min_col, max_col, min_row, max_row)
-                        print((max_row-min_row)*(max_col-min_col), " tiles")
+                            # check if output folder exists
+                            output_folder = f'{args.output}/{layer_id}/{proj.replace(":", "-")}/{zoom}'
 
-                        for row in range(min_row, max_row):
+                            if remove_old:
+                                if os.path.exists(output_folder):
+                                    print('Removing old files...')
+                                    shutil.rmtree(output_folder)
 
-                            for col in range(min_col, max_col):
+                                # the store is outside the zoom folder and would be imported into the new manifest
+                                if tile_store:
+                                    removed = tile_store.delete_zoom(zoom)
+                                    print(f'Removed {removed} old tiles from the store')
 
-                                extension = format.split("/")[-1]
-                                #file_name = f'{layer_id}_{proj.replace(":", "-")}_row-{row}_col-{col}_zoom-{zoom}'
-                                file_name = f'{col}/{row}'
-                                if not os.path.exists(f"{output_folder}/{col}"):
-                                    os.makedirs(f"{output_folder}/{col}")
-                                # skip already downloaded files
-                                if tile_already_exists(file_name, extension):
-                                    print(
-                                        f'--> Skipped existing tile: Column {col} - Row {row} - Zoom {zoom}')
-                                    skip_count += 1
-                                    continue
+                            # create folder if not exists
+                            if not os.path.exists(output_folder):
+                                os.makedirs(output_folder)
+
+                            print('\t')
+                            print(f'Downloading images of zoom level {zoom}...')
+
+                            if bbox:
+                                (f_min_col, f_max_col, f_min_row,
+                                 f_max_row) = filter_row_cols_by_bbox(matrix, bbox)
+
+                                print(f_min_col, f_max_col, f_min_row, f_max_row)
 
-                                print(
-                                    f'--> Downloading tile ({download_count}): Column {col} - Row {row} - Zoom {zoom}')
+                                # clamp values
+                                min_col = f_min_col if f_min_col >= min_col else min_col
+                                max_col = f_max_col if f_max_col <= max_col else max_col
+                                min_row = f_min_row if f_min_row >= min_row else min_row
+                                max_row = f_max_row if f_max_row <= max_row else max_row
 
-                                img = wmts.gettile(
-                                    url,
-                                    layer=layer_id,
-                                    tilematrixset=tile_matrix_set,
-                                    tilematrix=limit,
-                                    row=row,
-                                    column=col,
-                                    format=format
-                                )
+                            print(min_col, max_col, min_row, max_row)
 
-                                #write_world_file(file_name, extension, col, row, matrix)
+                            if args.coverage:
+                                candidates = [
+                                    (col, row) for col, row in matrix_tiles(area, matrix, proj)
+                                    if min_col <= col < max_col and min_row <= row < max_row
+                                ]
+                            else:
+                                candidates = [
+                                    (col, row)
+                                    for row in range(min_row, max_row)
+                                    for col in range(min_col, max_col)
+                                ]
+
+                            total_tiles += len(candidates)
+                            print(len(candidates), " tiles")
 
-                                write_image(file_name, extension, img)
+                            manifest = Manifest(output_folder)
 
-                                if limit_requests:
-                                    if download_count >= limit_requests:
-                                        break
+                            if manifest.created:
+                                if tile_store:
+                                    imported = manifest.import_store(tile_store, zoom)
+                                else:
+                                    imported = manifest.import_tiles(extension)
+                                print(f'--> Imported {imported} existing tiles into the manifest')
 
-                                download_count += 1
+                            if args.verify and not tile_store:
+                                invalid = manifest.verify(extension)
+                                print(f'--> Found {invalid} missing or truncated tiles')
 
-                                if sleep:
-                                    time.sleep(sleep)
+                            done = manifest.validators()
 
+                            if args.retry_failed:
+                                retry = manifest.tiles('failed')
+                                print(f'--> Retrying {len(retry)} failed tiles')
                             else:
-                                continue  # only executed if the inner loop did NOT break
-                            break  # only executed if the inner loop DID break
+                                retry = None
+
+                            tiles = []
+
+                            for col, row in candidates:
+
+                                # skip already downloaded files, unless they are refreshed
+                                if (col, row) in done and not args.refresh:
+                                    skip_count += 1
+                                    continue
+
+                                if retry is None or (col, row) in retry:
+                                    tiles.append((col, row))
+
+                            print(f'--> Skipped existing tiles: {skip_count}')
+
+                            zoom_download_count, zoom_failed, zoom_changed = download_tiles(
+                                wmts, url, username, password, tiles,
+                                layer_id=layer_id,
+                                tilematrixset=tile_matrix_set,
+                                tilematrix=limit,
+                                format=format,
+                                extension=extension,
+                                limiter=limiter,
+                                manifest=manifest,
+                                executor=executor,
+                                validators=done if args.refresh else None,
+                                tile_store=tile_store,
+                                zoom=zoom,
+                                retries=args.retries
+                            )
+
+                            manifest.close()
+                            manifest = None
+
+                            download_count += zoom_download_count
+                            failed += zoom_failed
+                            changed += [(zoom, col, row) for col, row in zoom_changed]
+
+                        executor.shutdown()
+
+                        changed_path = f'{args.output}/{layer_id}/{proj.replace(":", "-")}/{changed_tiles_file}'
+                        write_changed_tiles(changed_path, changed)
+                        print(f'--> Changed tiles written to {changed_path}')
 
         if os.path.exists(tmp_folder):
             print(f'-> Removing tmp files...')
@@ -250,7 +346,7 @@ def init():
         print(f'-> Layer: {layer_id}')
         print(f'-> Format: {format}')
         print(f'-> Projection: {proj}')
-        print(f'-> Zoom: {zoom}')
+        print(f'-> Zoom: {", ".join(str(zoom) for zoom in zooms)}')
         print('------------------------------')
 
         if skip_count:
@@ -261,12 +357,17 @@ def init():
         else:
             print(f'-> No files downloaded')
 
-        print('------------------------------')
+        if args.refresh:
+            print(f'-> Changed tiles: {len(changed)}')
+
+        if failed:
+            print(f'-> Failed tiles: {len(failed)} (recorded in {manifest_file}, rerun with --retry-failed)')
 
-        total_tiles = (max_row - min_row) * (max_col - min_col)
+        print('------------------------------')
 
         print(f'-> Total tiles in layer: {total_tiles}')
-        print(f'-> Tiles remaining: {total_tiles - (skip_count + download_count)}')
+        if not args.refresh:
+            print(f'-> Tiles remaining: {total_tiles - (skip_count + download_count)}')
 
         print('------------------------------')
 
@@ -274,6 +375,421 @@ def init():
         print(f'{error}')
         print(traceback.format_exc())
 
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+        if manifest:
+            manifest.close()
+
+        if tile_store:
+            tiles_count, images_count = tile_store.count()
+            print(f'-> Tiles in store: {tiles_count} ({images_count} unique images)')
+            tile_store.close()
+
+
+def get_session(username, password):
+    '''
+    Returns the keep-alive session of the current worker thread
+    '''
+    session = getattr(session_local, 'session', None)
+
+    if session is None:
+        session = requests.Session()
+        session.auth = (username, password)
+        session_local.session = session
+
+    return session
+
+
+def fetch_tile(wmts, url, username, password, layer_id, tilematrixset,
+               tilematrix, row, col, format, headers=None):
+    '''
+    Fetches a single tile through the pooled session of the current thread
+    '''
+    session = get_session(username, password)
+
+    if wmts.restonly:
+        response = session.get(wmts.buildTileResource(
+            layer_id, None, format, tilematrixset, tilematrix, row, col),
+            headers=headers)
+    else:
+        data = wmts.buildTileRequest(
+            layer_id, None, format, tilematrixset, tilematrix, row, col)
+        response = session.get(url, params=data, headers=headers)
+
+    response.raise_for_status()
+
+    if response.headers.get('Content-Type') == 'application/vnd.ogc.se_xml':
+        raise Exception(
+            f'Service exception for tile: Column {col} - Row {row}: {response.text}')
+
+    return response
+
+
+def download_tiles(wmts, url, username, password, tiles, layer_id,
+                   tilematrixset, tilematrix, format, extension, limiter,
+                   manifest, executor, validators=None, tile_store=None,
+                   zoom=None, retries=retries):
+    '''
+    Downloads the tiles with a pool of workers, records them in the manifest
+    and returns the number of written tiles, the failed tiles with their
+    errors and the new or changed tiles.
+
+    Tiles with validators (checksum, ETag, Last-Modified) are requested
+    conditionally and only replaced if their content changed. Files are
+    written by the workers, tiles for a tile store are handed back and
+    written in batches by the calling thread
+    '''
+
+    validators = validators or {}
+
+    def download(col, row):
+        checksum, etag, modified = validators.get((col, row), (None, None, None))
+
+        headers = {}
+
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+        for attempt in range(retries + 1):
+            limiter.acquire()
+
+            try:
+                response = fetch_tile(wmts, url, username, password, layer_id,
+                                      tilematrixset, tilematrix, row, col,
+                                      format, headers)
+            except requests.RequestException as error:
+                response = error.response
+                status = response.status_code if response is not None else None
+
+                # only throttling, server errors and connection errors are retried
+                if status is not None and status != 429 and status < 500:
+                    raise
+
+                if status is not None:
+                    limiter.throttle(retry_after(response))
+
+                if attempt == retries:
+                    raise
+
+                time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+                continue
+            finally:
+                limiter.release()
+
+            limiter.succeed()
+            break
+
+        if response.status_code == 304:
+            return 'unchanged', None, None, None, None, None
+
+        img = response.content
+        new_checksum = hashlib.sha1(img).hexdigest()
+        etag = response.headers.get('ETag')
+        modified = response.headers.get('Last-Modified')
+
+        if checksum == new_checksum:
+            return 'unchanged', None, len(img), checksum, etag, modified
+
+        status = 'changed' if checksum else 'new'
+
+        #write_world_file(file_name, extension, col, row, matrix)
+
+        if tile_store:
+            return status, img, len(img), new_checksum, etag, modified
+
+        write_image(f'{col}/{row}', extension, img)
+
+        return status, None, len(img), new_checksum, etag, modified
+
+    print(f'--> Downloading {len(tiles)} tiles')
+
+    # create the column folders once instead of probing them per tile
+    if not tile_store:
+        for col in sorted({col for col, _ in tiles}):
+            os.makedirs(f'{output_folder}/{col}', exist_ok=True)
+
+    download_count = 0
+    unchanged_count = 0
+    failed = []
+    changed = []
+    start = time.perf_counter()
+
+    futures = {executor.submit(download, col, row): (col, row)
+               for col, row in tiles}
+
+    for count, future in enumerate(as_completed(futures), 1):
+        col, row = futures[future]
+
+        try:
+            status, img, size, checksum, etag, modified = future.result()
+        except Exception as error:
+            print(f'--> Failed tile: Column {col} - Row {row}: {error}')
+            failed.append((col, row, error))
+
+            # a failed refresh keeps the previously downloaded tile
+            if (col, row) not in validators:
+                manifest.record(col, row, 'failed', error=error)
+        else:
+            if status == 'unchanged':
+                unchanged_count += 1
+
+                # keep the validators of the server up to date
+                if checksum:
+                    manifest.record(col, row, 'done', size, checksum,
+                                    etag=etag, modified=modified)
+            else:
+                if tile_store:
+                    tile_store.put(zoom, col, row, img, checksum)
+
+                manifest.record(col, row, 'done', size, checksum,
+                                etag=etag, modified=modified)
+                changed.append((col, row))
+                download_count += 1
+
+        if count % 100 == 0 or count == len(tiles):
+            elapsed = time.perf_counter() - start
+            print(
+                f'--> Downloaded {download_count}/{len(tiles)} tiles, {unchanged_count} unchanged, {len(failed)} failed ({count / elapsed:.1f} tiles/s, rate limit {limiter.rate:.1f}/s)')
+
+            # the manifest never gets ahead of the tile store
+            if tile_store:
+                tile_store.commit()
+
+            manifest.commit()
+
+    if tile_store:
+        tile_store.commit()
+
+    manifest.commit()
+
+    return download_count, failed, changed
+
+
+class RateLimiter:
+    '''
+    Token bucket limiting the requests per second and the requests in
+    flight. The rate is halved on throttling responses and recovers
+    additively on successful requests
+    '''
+
+    def __init__(self, rate, max_inflight, min_rate=0.1):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.throttled_at = 0
+        self.lock = threading.Lock()
+        self.inflight = threading.BoundedSemaphore(max_inflight)
+
+    def acquire(self):
+        self.inflight.acquire()
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if now >= self.paused_until:
+                    self.tokens = min(max(1.0, self.rate),
+                                      self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+
+            time.sleep(wait)
+
+    def release(self):
+        self.inflight.release()
+
+    def throttle(self, pause=None):
+        with self.lock:
+            now = time.monotonic()
+
+            # requests in flight fail together, only back off once per second
+            if now - self.throttled_at >= 1:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.throttled_at = now
+
+            self.tokens = 0
+            self.updated = now
+
+            if pause:
+                self.paused_until = max(self.paused_until, now + pause)
+
+    def succeed(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+def retry_after(response):
+    '''
+    Returns the Retry-After header in seconds if the server sent one
+    '''
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Manifest:
+    '''
+    Download manifest of a zoom level folder, stored as SQLite database with
+    the status, size, checksum and HTTP validators of every tile
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = f'{folder}/{manifest_file}'
+        self.created = not os.path.exists(self.path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            '''CREATE TABLE IF NOT EXISTS tiles (
+                col INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                size INTEGER,
+                checksum TEXT,
+                error TEXT,
+                updated REAL,
+                etag TEXT,
+                modified TEXT,
+                PRIMARY KEY (col, row)
+            )''')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS tiles_status ON tiles (status)')
+
+        # manifests written before conditional requests were supported
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(tiles)')]
+        for column in ('etag', 'modified'):
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE tiles ADD COLUMN {column} TEXT')
+
+        self.connection.commit()
+
+    def tiles(self, status):
+        cursor = self.connection.execute(
+            'SELECT col, row FROM tiles WHERE status = ?', (status,))
+        return set(cursor.fetchall())
+
+    def validators(self):
+        '''
+        Returns the checksum, ETag and Last-Modified of all downloaded tiles
+        '''
+        cursor = self.connection.execute(
+            "SELECT col, row, checksum, etag, modified FROM tiles WHERE status = 'done'")
+        return {(col, row): (checksum, etag, modified)
+                for col, row, checksum, etag, modified in cursor}
+
+    def record(self, col, row, status, size=None, checksum=None, error=None,
+               etag=None, modified=None):
+        if error is not None:
+            error = ' '.join(str(error).split())
+
+        self.connection.execute(
+            '''INSERT OR REPLACE INTO tiles
+                (col, row, status, size, checksum, error, updated, etag, modified)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (col, row, status, size, checksum, error, time.time(), etag, modified))
+
+    def import_tiles(self, extension):
+        '''
+        Records the tiles downloaded before the manifest existed. Truncated
+        files are left out so they are downloaded again
+        '''
+        count = 0
+
+        for column in os.scandir(self.folder):
+            if not column.is_dir() or not column.name.lstrip('-').isdigit():
+                continue
+
+            for tile in os.scandir(column.path):
+                name, _, ext = tile.name.partition('.')
+
+                if ext != extension or not name.lstrip('-').isdigit():
+                    continue
+
+                with open(tile.path, 'rb') as f:
+                    img = f.read()
+
+                if not image_complete(img, extension):
+                    continue
+
+                self.record(int(column.name), int(name), 'done', len(img),
+                            hashlib.sha1(img).hexdigest())
+                count += 1
+
+        self.commit()
+
+        return count
+
+    def import_store(self, tile_store, zoom):
+        '''
+        Records the tiles already stored in the tile store
+        '''
+        checksums = tile_store.checksums(zoom)
+
+        for (col, row), checksum in checksums.items():
+            self.record(col, row, 'done', checksum=checksum)
+
+        self.commit()
+
+        return len(checksums)
+
+    def verify(self, extension):
+        '''
+        Marks done tiles as missing when the file on disk does not have the
+        recorded size
+        '''
+        invalid = []
+
+        for col, row, size in self.connection.execute(
+                "SELECT col, row, size FROM tiles WHERE status = 'done'").fetchall():
+            try:
+                valid = os.stat(f'{self.folder}/{col}/{row}.{extension}').st_size == size
+            except FileNotFoundError:
+                valid = False
+
+            if not valid:
+                invalid.append((col, row))
+
+        for col, row in invalid:
+            self.record(col, row, 'missing')
+
+        self.commit()
+
+        return len(invalid)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def image_complete(img, extension):
+    '''
+    Checks the end marker of the image to detect truncated files
+    '''
+    if extension == 'png':
+        return img[-12:-8] == b'\x00\x00\x00\x00' and img[-8:-4] == b'IEND'
+
+    if extension in ('jpeg', 'jpg'):
+        return img[-2:] == b'\xff\xd9'
+
+    return len(img) > 0
+
 
 def filter_row_cols_by_bbox(matrix, bbox):
     a = matrix.scaledenominator * 0.00028
@@ -305,9 +821,16 @@ def filter_row_cols_by_bbox(matrix, bbox):
     return (column_orig, column_dest, row_orig, row_dest)
 
 
-def tile_already_exists(file_name, extension):
-    file_path = f'{output_folder}/{file_name}.{extension}'
-    return os.path.exists(file_path)
+def write_changed_tiles(path, changed):
+    '''
+    Writes the new and changed tiles as zoom,col,row list for the later
+    processing stages
+    '''
+    with open(path, 'w') as f:
+        f.write('zoom,col,row\n')
+
+        for zoom, col, row in sorted(changed):
+            f.write(f'{zoom},{col},{row}\n')
 
 
 def write_image(file_name, extension, img):
@@ -316,9 +839,15 @@ def write_image(file_name, extension, img):
     '''
     file_path = f'{output_folder}/{file_name}.{extension}'
 
-    out = open(file_path, 'wb')
-    out.write(img.read())
+    # write next to the tile first so a crash never leaves a truncated tile
+    out = open(f'{file_path}.part', 'wb')
+    out.write(img)
     out.close()
 
+    os.replace(f'{file_path}.part', file_path)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
 
-init()
+    init()
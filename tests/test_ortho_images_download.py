@@ -0,0 +1,291 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import ortho_images_download
+from tile_store import MBTilesStore
+
+LAYER = "ortho"
+PROJ = "EPSG:3857"
+ZOOM_FOLDER = f"{LAYER}/{PROJ.replace(':', '-')}/15"
+TILES = [(col, row) for col in range(3) for row in range(2)]
+
+CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1"
+    xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <ows:ServiceIdentification>
+    <ows:Title>Test WMTS</ows:Title>
+    <ows:ServiceType>OGC WMTS</ows:ServiceType>
+    <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>
+    <ows:AccessConstraints>none</ows:AccessConstraints>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetCapabilities"><ows:DCP><ows:HTTP><ows:Get xlink:href="{url}?">
+      <ows:Constraint name="GetEncoding"><ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues></ows:Constraint>
+    </ows:Get></ows:HTTP></ows:DCP></ows:Operation>
+    <ows:Operation name="GetTile"><ows:DCP><ows:HTTP><ows:Get xlink:href="{url}?">
+      <ows:Constraint name="GetEncoding"><ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues></ows:Constraint>
+    </ows:Get></ows:HTTP></ows:DCP></ows:Operation>
+  </ows:OperationsMetadata>
+  <Contents>
+    <Layer>
+      <ows:Title>Ortho</ows:Title>
+      <ows:WGS84BoundingBox><ows:LowerCorner>9.0 47.6</ows:LowerCorner><ows:UpperCorner>9.3 47.8</ows:UpperCorner></ows:WGS84BoundingBox>
+      <ows:Identifier>ortho</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style>
+      <Format>image/png</Format>
+      <TileMatrixSetLink>
+        <TileMatrixSet>EPSG:3857</TileMatrixSet>
+        <TileMatrixSetLimits>
+          <TileMatrixLimits>
+            <TileMatrix>EPSG:3857:15</TileMatrix>
+            <MinTileRow>0</MinTileRow><MaxTileRow>2</MaxTileRow><MinTileCol>0</MinTileCol><MaxTileCol>3</MaxTileCol>
+          </TileMatrixLimits>
+        </TileMatrixSetLimits>
+      </TileMatrixSetLink>
+    </Layer>
+    <TileMatrixSet>
+      <ows:Identifier>EPSG:3857</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::3857</ows:SupportedCRS>
+      <TileMatrix>
+        <ows:Identifier>EPSG:3857:15</ows:Identifier>
+        <ScaleDenominator>17061.8</ScaleDenominator>
+        <TopLeftCorner>-20037508.34 20037508.34</TopLeftCorner>
+        <TileWidth>256</TileWidth><TileHeight>256</TileHeight>
+        <MatrixWidth>32768</MatrixWidth><MatrixHeight>32768</MatrixHeight>
+      </TileMatrix>
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>
+"""
+
+
+def png(text):
+    """
+    Bytes ending with the IEND chunk of a PNG
+    """
+    return b"\x89PNG\r\n\x1a\n" + text.encode() + b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+
+class WMTSHandler(BaseHTTPRequestHandler):
+    """
+    KVP WMTS with one layer and a 3x2 tile matrix at zoom level 15. Tiles
+    answer with the scripted statuses of the server first, then with the
+    tile and its ETag or 304 if the ETag did not change.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        query = {key.upper(): values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        server = self.server
+
+        if query.get("REQUEST") == "GetCapabilities":
+            return self.send(200, CAPABILITIES.replace("{url}", server.url).encode(), "application/xml")
+
+        tile = (int(query["TILECOL"]), int(query["TILEROW"]))
+        with server.lock:
+            script = server.scripts.get(tile)
+            status = script.pop(0) if script else 200
+            server.requests.append({
+                "tile": tile, "status": status, "time": time.monotonic(), "port": self.client_address[1],
+                "auth": self.headers.get("Authorization"), "if_none_match": self.headers.get("If-None-Match")})
+
+        if status != 200:
+            return self.send(status, b"busy", "text/plain", {"Retry-After": "1"} if status in (429, 503) else {})
+
+        content = server.tiles[tile]
+        etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            with server.lock:
+                server.requests[-1]["status"] = 304
+            return self.send(304, b"", None, {"ETag": etag})
+
+        self.send(200, content, "image/png", {"ETag": etag})
+
+    def send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def wmts():
+    """
+    Local WMTS server with scripts of statuses per tile and a log of the tile
+    requests
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WMTSHandler)
+    server.url = f"http://127.0.0.1:{server.server_port}/wmts"
+    server.lock = threading.Lock()
+    server.tiles = {tile: png(f"tile {tile} v1") for tile in TILES}
+    server.scripts = {}
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def download(tmp_path, wmts, monkeypatch):
+    """
+    Runs the downloader against the local WMTS and returns the requests of
+    the run
+    """
+    monkeypatch.setattr(ortho_images_download, "backoff", 0.01)
+
+    def run(*options):
+        start = len(wmts.requests)
+        ortho_images_download.args = ortho_images_download.parser.parse_args([
+            wmts.url, "--username", "u", "--password", "p", "--layer", LAYER,
+            "--output", str(tmp_path), "--workers", "3", "--rate", "50", *options])
+        ortho_images_download.init()
+        return wmts.requests[start:]
+
+    return run
+
+
+def requested(requests):
+    return sorted(request["tile"] for request in requests)
+
+
+def manifest_rows(tmp_path):
+    connection = sqlite3.connect(tmp_path / ZOOM_FOLDER / ortho_images_download.manifest_file)
+    rows = connection.execute("SELECT col, row, status, size, checksum, error, etag FROM tiles").fetchall()
+    connection.close()
+    return {(col, row): (status, size, checksum, error, etag) for col, row, status, size, checksum, error, etag in rows}
+
+
+def test_download_retries_throttled_tiles_over_pooled_sessions(tmp_path, wmts, download):
+    wmts.scripts = {(0, 0): [429], (1, 1): [503, 503], (2, 1): [404]}
+
+    requests = download()
+
+    assert requested(requests) == sorted(TILES + [(0, 0), (1, 1), (1, 1)])
+    assert all(request["auth"].startswith("Basic ") for request in requests)
+    # one keep-alive connection per worker
+    assert len({request["port"] for request in requests}) <= 3
+
+    # the requests after the 429 wait for its Retry-After
+    throttled = next(request["time"] for request in requests if request["status"] == 429)
+    assert min(request["time"] for request in requests if request["time"] > throttled) - throttled >= 0.9
+
+    rows = manifest_rows(tmp_path)
+    for tile in TILES:
+        path = tmp_path / ZOOM_FOLDER / f"{tile[0]}/{tile[1]}.png"
+        if tile == (2, 1):
+            assert not path.exists()
+            assert rows[tile][0] == "failed" and "404" in rows[tile][3]
+        else:
+            content = wmts.tiles[tile]
+            assert path.read_bytes() == content
+            assert rows[tile] == ("done", len(content), hashlib.sha1(content).hexdigest(), None, f'"{hashlib.sha1(content).hexdigest()}"')
+
+
+def test_download_gives_up_after_retries(tmp_path, wmts, download):
+    wmts.scripts = {(0, 1): [503] * 3}
+
+    requests = download("--retries", "2")
+
+    assert requested(requests).count((0, 1)) == 3
+    assert manifest_rows(tmp_path)[(0, 1)][0] == "failed"
+    assert not (tmp_path / ZOOM_FOLDER / "0/1.png").exists()
+
+
+def test_download_resumes_from_files_and_manifest(tmp_path, wmts, download):
+    # tiles of an earlier run without manifest, one of them truncated
+    for (col, row), content in [((0, 1), wmts.tiles[(0, 1)]), ((1, 0), wmts.tiles[(1, 0)][:-6])]:
+        (tmp_path / ZOOM_FOLDER / str(col)).mkdir(parents=True, exist_ok=True)
+        (tmp_path / ZOOM_FOLDER / f"{col}/{row}.png").write_bytes(content)
+    wmts.scripts = {(2, 0): [404]}
+
+    assert requested(download()) == [tile for tile in TILES if tile != (0, 1)]
+    assert manifest_rows(tmp_path)[(2, 0)][0] == "failed"
+    assert (tmp_path / ZOOM_FOLDER / "1/0.png").read_bytes() == wmts.tiles[(1, 0)]
+
+    assert requested(download("--retry-failed")) == [(2, 0)]
+    assert {row[0] for row in manifest_rows(tmp_path).values()} == {"done"}
+
+    assert requested(download()) == []
+
+
+def test_refresh_replaces_only_changed_tiles(tmp_path, wmts, download):
+    download()
+    wmts.tiles[(1, 0)] = png("tile (1, 0) v2")
+
+    requests = download("--refresh")
+
+    assert requested(requests) == TILES
+    assert all(request["if_none_match"] for request in requests)
+    assert sorted(request["tile"] for request in requests if request["status"] == 200) == [(1, 0)]
+    assert (tmp_path / ZOOM_FOLDER / "1/0.png").read_bytes() == wmts.tiles[(1, 0)]
+    assert manifest_rows(tmp_path)[(1, 0)][2] == hashlib.sha1(wmts.tiles[(1, 0)]).hexdigest()
+    changed = (tmp_path / LAYER / PROJ.replace(":", "-") / ortho_images_download.changed_tiles_file).read_text()
+    assert changed == "zoom,col,row\n15,1,0\n"
+
+
+def test_removeold_clears_mbtiles_store(tmp_path, wmts, download):
+    store_path = tmp_path / LAYER / f"{PROJ.replace(':', '-')}.mbtiles"
+    store_path.parent.mkdir(parents=True)
+    store = MBTilesStore(str(store_path))
+    for col, row in TILES:
+        store.put(15, col, row, b"old tile %d %d" % (col, row))
+    store.put(16, 0, 0, b"other zoom")
+    store.close()
+
+    assert requested(download("--store", "mbtiles")) == []
+
+    assert requested(download("--store", "mbtiles", "--removeold")) == TILES
+
+    store = MBTilesStore(str(store_path), readonly=True)
+    assert store.tiles(15) == set(TILES)
+    assert store.tiles(16) == {(0, 0)}
+    assert store.count() == (len(TILES) + 1, len(TILES) + 1)
+    store.close()
+
+
+def test_zoom_missing_from_tile_matrix_set_is_skipped(download, capsys):
+    assert requested(download("--zoom", "16", "15")) == TILES
+    assert "Zoom level 16 not in tile matrix set" in capsys.readouterr().out
+
+
+def test_rate_limiter_halves_rate_and_pauses_on_throttling():
+    limiter = ortho_images_download.RateLimiter(rate=20, max_inflight=2)
+
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+        limiter.release()
+    assert time.monotonic() - start >= 0.2
+
+    limiter.throttle(pause=0.3)
+    assert limiter.rate == 10
+    start = time.monotonic()
+    limiter.acquire()
+    limiter.release()
+    assert time.monotonic() - start >= 0.3
+
+    # throttled requests failing together back off once
+    limiter.throttle()
+    assert limiter.rate == 10
+
+    for _ in range(100):
+        limiter.succeed()
+    assert limiter.rate == 20
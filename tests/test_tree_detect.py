@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pyproj import Geod
+
+pytest.importorskip("deepforest")
+
+from affine import Affine
+from rasterio.crs import CRS
+
+from tree_detect import georeference_trees
+
+
+def test_georeference_trees_measures_geodesic_sizes():
+    # 10 cm pixels of an EPSG:4326 raster in Konstanz
+    transform = Affine(1.3e-06, 0.0, 9.17, 0.0, -0.9e-06, 47.68)
+    boxes = pd.DataFrame({
+        "xmin": [0, 1000, 250],
+        "ymin": [0, 400, 3000],
+        "xmax": [100, 1060, 450],
+        "ymax": [80, 460, 3150],
+        "score": [0.9, 0.8, 0.7]
+    })
+
+    trees = georeference_trees(boxes, transform, CRS.from_epsg(4326))
+
+    geod = Geod(ellps="WGS84")
+    for box, tree in zip(boxes.itertuples(), trees.itertuples()):
+        lat = tree.ycenter_coord
+        # Geod.inv takes longitudes before latitudes
+        _, _, width = geod.inv(lons1=tree.xmin_coord, lats1=lat, lons2=tree.xmax_coord, lats2=lat)
+        _, _, height = geod.inv(lons1=tree.xcenter_coord, lats1=tree.ymin_coord, lons2=tree.xcenter_coord, lats2=tree.ymax_coord)
+        area, _ = geod.geometry_area_perimeter(tree.geometry)
+
+        assert tree.xmax_coord - tree.xmin_coord == pytest.approx((box.xmax - box.xmin) * transform.a)
+        assert tree.diameter == pytest.approx((width + height) / 2, rel=2e-3)
+        assert tree.crown_area == pytest.approx(abs(area), rel=4e-3)
+
+    # a 100x80 box of 1.3e-6° x 0.9e-6° pixels is about 9.7 m x 8.0 m wide
+    assert trees.diameter.iloc[0] == pytest.approx(8.9, abs=0.1)
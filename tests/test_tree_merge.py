@@ -0,0 +1,203 @@
+import argparse
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import tree_merge
+import tree_query
+from merged_store import MergedStore
+
+
+def write_cadastre(path, x, y, diameters):
+    n = len(x)
+    pd.DataFrame({
+        "X": x, "Y": y, "OBJECTID": np.arange(n), "baumId": np.arange(n) + 1, "baumNr": 1, "baumart": 1,
+        "hoeheM": 10, "kronendurchmesserM": diameters, "stammumfangCM": 100,
+        "location": "Park", "Name_dt": "Linde", "Name_lat": "Tilia", "Name_Sym": "Tilia"
+    }).to_csv(path, index=False)
+
+
+def write_detections(path, x, y, radius, scores):
+    pd.DataFrame({
+        "xmin": 0, "ymin": 0, "xmax": 10, "ymax": 10,
+        "xmin_coord": x - radius * tree_merge.LON_PER_METER, "ymin_coord": y - radius * tree_merge.LAT_PER_METER,
+        "xmax_coord": x + radius * tree_merge.LON_PER_METER, "ymax_coord": y + radius * tree_merge.LAT_PER_METER,
+        "xcenter_coord": x, "ycenter_coord": y, "diameter": radius * 2, "crown_area": np.pi * radius ** 2,
+        "score": scores
+    }).to_csv(path)
+
+
+@pytest.fixture
+def trees(tmp_path, monkeypatch):
+    """
+    City trees on a 30 m grid with a detection close to most of them and
+    unmatched detections in between
+    """
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+
+    n = 400
+    x = 9.17 + (np.arange(n) % 20) * 30 * tree_merge.LON_PER_METER
+    y = 47.68 + (np.arange(n) // 20) * 30 * tree_merge.LAT_PER_METER
+    write_cadastre(tmp_path / "cadastre.csv", x, y, rng.integers(4, 12, n))
+
+    m = 600
+    x = np.r_[x[:300] + rng.normal(0, 2, 300) * tree_merge.LON_PER_METER, rng.uniform(x.min(), x.max(), m - 300)]
+    y = np.r_[y[:300] + rng.normal(0, 2, 300) * tree_merge.LAT_PER_METER, rng.uniform(y.min(), y.max(), m - 300)]
+    write_detections(tmp_path / "detected.csv", x, y, rng.uniform(2, 6, m), rng.uniform(0, 1, m))
+
+    return tree_merge.load_city_trees(tmp_path / "cadastre.csv"), tree_merge.load_detected_trees(tmp_path / "detected.csv")
+
+
+def store_trees(store):
+    return gpd.read_file(store.path, layer=store.layer)
+
+
+def pairs(merged):
+    ids = merged[["baumId", "detect_id", "maintained", "detected"]].astype("Int64").fillna(-1)
+    return sorted(map(tuple, ids.values.tolist()))
+
+
+@pytest.mark.parametrize("suffix", ["geojson", "parquet", "arrow"])
+def test_tree_merge_writes_points(trees, tmp_path, suffix):
+    trees_city, trees_detected = trees
+    args = tree_merge.get_parser().parse_args([
+        "--cadastre", str(tmp_path / "cadastre.csv"), "--detected", str(tmp_path / "detected.csv"),
+        "--outputs", str(tmp_path / f"merged.{suffix}")])
+
+    tree_merge.tree_merge(args, tree_merge.get_logger())
+
+    merged = tree_query.load_merged(tmp_path / f"merged.{suffix}")
+    assert pairs(merged) == pairs(tree_merge.merge_trees(trees_city, trees_detected))
+    assert (merged.geom_type == "Point").all()
+    assert merged.crs == "EPSG:4326"
+
+
+@pytest.mark.parametrize("match", ["iou", "distance"])
+@pytest.mark.parametrize("cell_size", [1.0, 100.0, 1000.0])
+def test_partitioned_merge_matches_single_pass(trees, tmp_path, match, cell_size):
+    trees_city, trees_detected = trees
+    args = argparse.Namespace(match=match, min_iou=0.0, max_distance=5.0, workers=2, cell_size=cell_size)
+
+    count = tree_merge.merge_partitioned(trees_city, trees_detected, tmp_path / "merged.parquet", args, tree_merge.get_logger())
+
+    merged = tree_merge.merge_trees(trees_city, trees_detected, match, 0.0, 5.0)
+    partitioned = gpd.read_parquet(tmp_path / "merged.parquet")
+    assert count == len(merged)
+    assert pairs(partitioned) == pairs(merged)
+    assert (merged.detected & merged.maintained).sum() > 100
+
+
+@pytest.mark.parametrize("match", ["iou", "distance"])
+@pytest.mark.parametrize("moved", [[5, 250], list(range(1, 400, 9))])
+@pytest.mark.parametrize("full_merge_share", [tree_merge.FULL_MERGE_SHARE, 0.0])
+def test_incremental_merge_of_changed_ids_matches_full_merge(trees, tmp_path, monkeypatch, match, moved, full_merge_share):
+    monkeypatch.setattr(tree_merge, "FULL_MERGE_SHARE", full_merge_share)
+    trees_city, trees_detected = trees
+    store = MergedStore(tmp_path / "merged.gpkg")
+    store.create(tree_merge.merge_trees(trees_city, trees_detected, match).astype({column: "string" for column in tree_merge.STRING_COLUMNS}))
+
+    # move trees by 4 m and drop another one from the cadastre
+    cadastre = pd.read_csv(tmp_path / "cadastre.csv")
+    cadastre.loc[cadastre.baumId.isin(moved), "X"] += 4 * tree_merge.LON_PER_METER
+    cadastre.loc[cadastre.baumId != 120].to_csv(tmp_path / "cadastre_changed.csv", index=False)
+    trees_city = tree_merge.load_city_trees(tmp_path / "cadastre_changed.csv")
+
+    args = argparse.Namespace(match=match, min_iou=0.0, max_distance=5.0, changed_areas=None, changed_ids=[*moved, 120])
+    tree_merge.merge_incremental(trees_city, trees_detected, store, args, tree_merge.get_logger())
+
+    assert pairs(store_trees(store)) == pairs(tree_merge.merge_trees(trees_city, trees_detected, match))
+
+
+def test_store_reads_trees_in_areas(trees, tmp_path):
+    trees_city, trees_detected = trees
+    merged = tree_merge.merge_trees(trees_city, trees_detected)
+    store = MergedStore(tmp_path / "merged.gpkg")
+    store.create(merged.astype({column: "string" for column in tree_merge.STRING_COLUMNS}))
+
+    x, y = merged.geometry.x.values, merged.geometry.y.values
+    areas = np.array([
+        [9.17, 47.68, 9.17 + 100 * tree_merge.LON_PER_METER, 47.68 + 50 * tree_merge.LAT_PER_METER],
+        [9.17 + 200 * tree_merge.LON_PER_METER, 47.68, 9.17 + 300 * tree_merge.LON_PER_METER, 47.68 + 100 * tree_merge.LAT_PER_METER]
+    ])
+    inside = np.zeros(len(merged), dtype=bool)
+    for min_x, min_y, max_x, max_y in areas:
+        inside |= (x >= min_x) & (y >= min_y) & (x <= max_x) & (y <= max_y)
+
+    stored = store.read(["baumId", "detect_id", "maintained", "detected"], areas)
+
+    assert 0 < len(stored) < len(merged)
+    assert pairs(stored) == pairs(merged.loc[inside])
+    assert len(store.read(["baumId"])) == len(merged)
+
+
+def test_incremental_merge_keeps_partner_of_rematched_detection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # meters east in degrees of longitude, LON_PER_METER is a third shorter
+    east = 1 / (111320 * np.cos(np.radians(47.68)))
+
+    # tree 2 pairs with the detection 4.6 m west of it, until tree 1 moves
+    # to 3 m west of the detection
+    write_cadastre(tmp_path / "cadastre.csv", 9.17 + np.array([-200, 0]) * east, np.full(2, 47.68), [6, 6])
+    write_detections(tmp_path / "detected.csv", np.array([9.17 - 4.6 * east]), np.array([47.68]), np.array([3.0]), [0.9])
+    trees_detected = tree_merge.load_detected_trees(tmp_path / "detected.csv")
+
+    store = MergedStore(tmp_path / "merged.gpkg")
+    merged = tree_merge.merge_trees(tree_merge.load_city_trees(tmp_path / "cadastre.csv"), trees_detected, "distance")
+    store.create(merged.astype({column: "string" for column in tree_merge.STRING_COLUMNS}))
+    assert pairs(merged) == [(1, -1, 1, 0), (2, 0, 1, 1)]
+
+    write_cadastre(tmp_path / "cadastre_changed.csv", 9.17 + np.array([-7.6, 0]) * east, np.full(2, 47.68), [6, 6])
+    trees_city = tree_merge.load_city_trees(tmp_path / "cadastre_changed.csv")
+
+    args = argparse.Namespace(match="distance", min_iou=0.0, max_distance=5.0, changed_areas=None, changed_ids=[1])
+    tree_merge.merge_incremental(trees_city, trees_detected, store, args, tree_merge.get_logger())
+
+    assert pairs(store_trees(store)) == [(1, 0, 1, 1), (2, -1, 1, 0)]
+
+
+@pytest.mark.parametrize("match", ["iou", "distance"])
+def test_incremental_merge_of_changed_areas_matches_full_merge(trees, tmp_path, monkeypatch, match):
+    trees_city, trees_detected = trees
+    merged = tree_merge.merge_trees(trees_city, trees_detected, match).astype({column: "string" for column in tree_merge.STRING_COLUMNS})
+    incremental = MergedStore(tmp_path / "incremental.gpkg")
+    incremental.create(merged)
+    full = MergedStore(tmp_path / "full.gpkg")
+    full.create(merged)
+
+    # trees detected again in two areas of about 100 m
+    areas = [shapely.box(9.1702, 47.6802, 9.1702 + 100 * tree_merge.LON_PER_METER, 47.6802 + 100 * tree_merge.LAT_PER_METER),
+             shapely.box(9.1748, 47.6835, 9.1748 + 80 * tree_merge.LON_PER_METER, 47.6835 + 120 * tree_merge.LAT_PER_METER)]
+    gpd.GeoDataFrame(geometry=areas, crs="EPSG:4326").to_file(tmp_path / "areas.geojson", driver="GeoJSON")
+    rng = np.random.default_rng(1)
+    x = np.r_[trees_city.geometry_city.x.values + rng.normal(0, 2, 400) * tree_merge.LON_PER_METER, rng.uniform(9.17, 9.1775, 200)]
+    y = np.r_[trees_city.geometry_city.y.values + rng.normal(0, 2, 400) * tree_merge.LAT_PER_METER, rng.uniform(47.68, 47.6853, 200)]
+    write_detections(tmp_path / "detected_again.csv", x, y, rng.uniform(2, 6, 600), rng.uniform(0, 1, 600))
+    trees_detected = tree_merge.load_detected_trees(tmp_path / "detected_again.csv")
+
+    first_new = incremental.next_detect_id()
+    changed_area = shapely.union_all(areas)
+    trees_new = trees_detected.loc[shapely.intersects(changed_area, trees_detected.geometry_detect.values)]
+    trees_new = trees_new.assign(detectId=first_new + np.arange(len(trees_new)))
+
+    args = argparse.Namespace(match=match, min_iou=0.0, max_distance=5.0, changed_areas=tmp_path / "areas.geojson", changed_ids=None)
+    merge_full = tree_merge.merge_full
+    monkeypatch.setattr(tree_merge, "merge_full", None)
+    tree_merge.merge_incremental(trees_city, trees_detected, incremental, args, tree_merge.get_logger())
+    merge_full(trees_city, trees_new, full, changed_area, args)
+
+    stored = store_trees(incremental)
+    assert pairs(stored) == pairs(store_trees(full))
+    assert set(stored.maintained) == {0, 1} and set(stored.detected) == {0, 1}
+    assert not ((stored.maintained == 0) & (stored.detected == 0)).any()
+    detect_ids = stored.detect_id.dropna()
+    assert detect_ids.is_unique
+    # the old detections in the areas are gone, all new ones are stored
+    assert np.isin(trees_new.detectId.values, detect_ids.values).all()
+    old = merged.loc[merged.detect_id.notna()]
+    in_areas = shapely.intersects(changed_area, shapely.points(old.detect_x_center_coord.values, old.detect_y_center_coord.values))
+    assert in_areas.any()
+    assert not np.isin(old.detect_id.values[in_areas], detect_ids.values).any()
@@ -0,0 +1,104 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import tree_query
+from tree_merge import METRIC_CRS
+
+SPECIES = ["Tilia cordata", "Acer platanoides", "Quercus robur", "Platanus x hispanica"]
+
+
+@pytest.fixture
+def trees():
+    """
+    Merged trees at random points of about 1 km, a few without species
+    """
+    rng = np.random.default_rng(0)
+    n = 300
+    species = pd.Series(rng.choice(SPECIES, n), dtype="object")
+    species[rng.random(n) < 0.05] = None
+
+    return gpd.GeoDataFrame({
+        "baumId": np.arange(n) + 1,
+        "location": rng.choice(["Park", "Strasse", "Friedhof"], n),
+        "Name_lat": species,
+        "maintained": rng.integers(0, 2, n),
+        "detected": rng.integers(0, 2, n)
+    }, geometry=gpd.points_from_xy(rng.uniform(9.17, 9.183, n), rng.uniform(47.66, 47.669, n)), crs="EPSG:4326")
+
+
+def distances(trees, lon, lat):
+    """
+    Distances in meters of all trees to a WGS84 point
+    """
+    point = gpd.GeoSeries([shapely.Point(lon, lat)], crs="EPSG:4326").to_crs(METRIC_CRS)[0]
+
+    return trees.geometry.to_crs(METRIC_CRS).distance(point).values
+
+
+def test_bbox_matches_brute_force(trees):
+    index = tree_query.TreeIndex(trees)
+    x, y = trees.geometry.x, trees.geometry.y
+
+    for bounds in [(9.172, 47.661, 9.178, 47.664), (9.17, 47.66, 9.183, 47.669), (9.19, 47.67, 9.2, 47.68)]:
+        min_lon, min_lat, max_lon, max_lat = bounds
+        expected = np.flatnonzero((x >= min_lon) & (x <= max_lon) & (y >= min_lat) & (y <= max_lat))
+        np.testing.assert_array_equal(index.bbox(*bounds), expected)
+
+
+def test_radius_and_nearest_match_brute_force(trees):
+    index = tree_query.TreeIndex(trees)
+
+    for lon, lat in [(9.175, 47.664), (9.18, 47.668), (9.16, 47.65)]:
+        meters = distances(trees, lon, lat)
+        order = np.argsort(meters, kind="stable")
+
+        positions, found = index.radius(lon, lat, 150)
+        np.testing.assert_array_equal(positions, order[:(meters <= 150).sum()])
+        np.testing.assert_allclose(found, meters[positions], atol=1e-6)
+
+        for k in [1, 7, len(trees), len(trees) + 5]:
+            positions, found = index.nearest(lon, lat, k)
+            np.testing.assert_array_equal(positions, order[:k])
+            np.testing.assert_allclose(found, meters[order[:k]], atol=1e-6)
+
+
+def test_nearest_of_no_trees_is_empty(trees):
+    for index, k in [(tree_query.TreeIndex(trees), 0), (tree_query.TreeIndex(trees), -3), (tree_query.TreeIndex(trees.iloc[:0]), 5)]:
+        positions, found = index.nearest(9.175, 47.664, k)
+        assert len(positions) == 0 and len(found) == 0
+        assert positions.dtype.kind == "i"
+
+
+@pytest.mark.parametrize("query", [
+    {},
+    {"species": "Tilia cordata"},
+    {"species": "Fagus sylvatica"},
+    {"location": "Park", "maintained": 1, "detected": 0},
+    {"species": "Acer platanoides", "location": "Strasse", "detected": 1},
+    {"maintained": 0}
+])
+def test_filter_matches_brute_force(trees, query):
+    index = tree_query.TreeIndex(trees)
+    positions = index.bbox(9.172, 47.661, 9.18, 47.667)
+
+    mask = np.ones(len(trees), dtype=bool)
+    for column, value in [("Name_lat", query.get("species")), ("location", query.get("location")),
+                          ("maintained", query.get("maintained")), ("detected", query.get("detected"))]:
+        if value is not None:
+            mask &= (trees[column] == value).values
+
+    np.testing.assert_array_equal(index.filter(**query), np.flatnonzero(mask))
+    np.testing.assert_array_equal(index.filter(positions=positions, **query), np.intersect1d(positions, np.flatnonzero(mask)))
+
+
+def test_species_counts_match_brute_force(trees):
+    index = tree_query.TreeIndex(trees)
+    positions = index.bbox(9.172, 47.661, 9.18, 47.667)
+
+    counts = index.species_counts(positions)
+
+    assert counts.to_dict() == trees.Name_lat.iloc[positions].value_counts().to_dict()
+    assert counts.is_monotonic_decreasing
@@ -0,0 +1,126 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+pytest.importorskip("deepforest")
+
+import tree_service
+from tree_detect import get_logger
+from rasterio.windows import Window
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """
+    Service on a free port whose jobs have two windows of a fake raster
+    """
+
+    def open_job(job):
+        job.dataset = object()
+        job.windows.extend([Window(0, 0, 400, 400), Window(400, 0, 400, 400)])
+        job.remaining = len(job.windows)
+
+    monkeypatch.setattr(tree_service.Job, "open", open_job)
+    monkeypatch.setattr(tree_service.Job, "close", lambda job: job.done.set())
+    monkeypatch.setattr(tree_service, "read_window", lambda dataset, window: np.zeros((400, 400, 3), dtype="float32"))
+
+    service = tree_service.DetectionService(model=None, batch_size=2, logger=get_logger())
+    server = ThreadingHTTPServer(("127.0.0.1", 0), tree_service.get_handler(service, job_timeout=2))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield service, f"http://127.0.0.1:{server.server_address[1]}/detect"
+
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body=json.dumps({"raster_path": "fake.tif"}).encode("utf-8")):
+    request = urllib.request.Request(url, data=body, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read().decode("utf-8")
+    except urllib.error.HTTPError as error:
+        return error.code, error.read().decode("utf-8")
+
+
+def test_model_error_fails_job_and_keeps_scheduler(service, monkeypatch):
+    service, url = service
+    calls = []
+
+    def predict_batch(model, crops):
+        calls.append(len(crops))
+        if len(calls) == 1:
+            raise RuntimeError("out of memory")
+        return [None] * len(crops)
+
+    monkeypatch.setattr(tree_service, "predict_batch", predict_batch)
+    service.start()
+
+    assert post(url) == (500, "out of memory")
+    assert service.alive()
+
+    status, body = post(url)
+    assert status == 200
+    assert body.splitlines()[0].startswith(",xmin")
+
+
+def test_stopped_scheduler_answers_503(service):
+    service, url = service
+
+    assert post(url) == (503, "Detection scheduler stopped")
+
+
+def test_timed_out_job_is_closed_by_scheduler(service, monkeypatch):
+    service, url = service
+    release = threading.Event()
+    closed = []
+
+    def close(job):
+        closed.append(threading.current_thread())
+        job.done.set()
+
+    monkeypatch.setattr(tree_service.Job, "close", close)
+    monkeypatch.setattr(tree_service, "predict_batch", lambda model, crops: release.wait(10) and [None] * len(crops))
+    service.start()
+
+    assert post(url) == (503, "Job did not finish within 2 s")
+    # the scheduler is still predicting the windows of the job
+    assert closed == []
+
+    release.set()
+    while service.pending():
+        time.sleep(0.1)
+    assert closed == [service.thread]
+
+
+@pytest.mark.parametrize("body", [
+    b"[]",
+    b"{",
+    b'{"raster_path": "fake.tif", "patch_size": "500"}',
+    b'{"raster_path": "fake.tif", "patch_overlap": 1.5}',
+    b'{"raster_path": "fake.tif", "sigma": true}',
+    b'{"raster_path": "fake.tif", "outputs": "trees.csv"}'
+])
+def test_invalid_job_answers_400(service, body):
+    service, url = service
+    service.start()
+
+    status, _ = post(url, body)
+
+    assert status == 400
+    assert service.pending() == 0
+
+
+def test_outputs_stay_in_output_folder(tmp_path):
+    args = tree_service.parse_job(b'{"raster_path": "fake.tif", "outputs": "trees/fake.gpkg"}', tmp_path)
+    assert args.outputs == tmp_path.resolve() / "trees" / "fake.gpkg"
+
+    for outputs in ["../fake.gpkg", "/tmp/fake.gpkg"]:
+        with pytest.raises(ValueError):
+            tree_service.parse_job(json.dumps({"raster_path": "fake.tif", "outputs": outputs}).encode("utf-8"), tmp_path)
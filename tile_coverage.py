@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Tile coverage
+-------------
+
+Compute the exact set of tiles intersecting an area of interest
+
+The area is read from a polygon file (e.g. the city boundary as GeoJSON) or
+built as buffer around the points of a CSV with X/Y columns in WGS84 such as
+the tree cadastre.
+
+"""
+
+import math
+import geopandas as gpd
+from shapely.geometry import box
+from shapely.prepared import prep
+
+from cadastre import load_cadastre
+
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+
+def load_coverage(path, buffer=0):
+    """
+    Loads the area of interest as single geometry in EPSG:4326
+
+    :param path: polygon file readable by geopandas or CSV with X/Y columns
+    :param buffer: buffer around the geometries in meters
+    """
+    if str(path).endswith(".csv"):
+        areas = load_cadastre(path).geometry
+    else:
+        areas = gpd.read_file(path).geometry.to_crs("EPSG:4326")
+
+    if buffer:
+        areas = areas.to_crs("EPSG:25832").buffer(buffer).to_crs("EPSG:4326")
+
+    return areas.unary_union
+
+
+def tiles_in_geometry(geometry, origin_x, origin_y, tile_width, tile_height):
+    """
+    Returns the sorted (col, row) of all tiles of a grid sharing area with
+    the geometry. Rows are counted downwards from the origin.
+
+    Every row strip is clipped to the geometry first, so only the columns
+    within the clipped parts are tested against the geometry.
+    """
+    prepared = prep(geometry)
+    min_x, min_y, max_x, max_y = geometry.bounds
+
+    min_col = math.floor((min_x - origin_x) / tile_width)
+    max_col = math.floor((max_x - origin_x) / tile_width)
+    min_row = math.floor((origin_y - max_y) / tile_height)
+    max_row = math.floor((origin_y - min_y) / tile_height)
+
+    tiles = []
+
+    for row in range(min_row, max_row + 1):
+        top = origin_y - row * tile_height
+        strip = geometry.intersection(box(
+            origin_x + min_col * tile_width, top - tile_height,
+            origin_x + (max_col + 1) * tile_width, top))
+
+        if strip.is_empty:
+            continue
+
+        parts = getattr(strip, "geoms", [strip])
+        cols = set()
+
+        for part in parts:
+            part_min_x, _, part_max_x, _ = part.bounds
+            cols.update(range(
+                math.floor((part_min_x - origin_x) / tile_width),
+                math.floor((part_max_x - origin_x) / tile_width) + 1))
+
+        for col in sorted(cols):
+            tile = box(
+                origin_x + col * tile_width, top - tile_height,
+                origin_x + (col + 1) * tile_width, top)
+
+            # tiles only touching the boundary do not cover any area
+            if prepared.intersects(tile) and not prepared.touches(tile):
+                tiles.append((col, row))
+
+    return tiles
+
+
+def matrix_tiles(geometry, matrix, crs):
+    """
+    Returns the tiles of a WMTS tile matrix covering a EPSG:4326 geometry
+
+    :param matrix: owslib tile matrix
+    :param crs: CRS of the tile matrix set
+    """
+    geometry = gpd.GeoSeries([geometry], crs="EPSG:4326").to_crs(crs).iloc[0]
+    size = matrix.scaledenominator * 0.00028
+
+    return tiles_in_geometry(
+        geometry, matrix.topleftcorner[0], matrix.topleftcorner[1],
+        size * matrix.tilewidth, size * matrix.tileheight)
+
+
+def xyz_tiles(geometry, z):
+    """
+    Returns the slippy map tiles of a zoom level covering a EPSG:4326
+    geometry
+    """
+    geometry = gpd.GeoSeries([geometry], crs="EPSG:4326").to_crs("EPSG:3857").iloc[0]
+    size = 2 * WEB_MERCATOR_EXTENT / (1 << z)
+
+    return tiles_in_geometry(
+        geometry, -WEB_MERCATOR_EXTENT, WEB_MERCATOR_EXTENT, size, size)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Tile store
+----------
+
+Single-file MBTiles container for slippy map tiles
+
+Identical tiles (e.g. uniform water tiles) are stored once and referenced
+by their content hash. Tiles are addressed with XYZ coordinates, rows are
+flipped to the TMS scheme of the MBTiles specification on the way in and
+out.
+
+"""
+
+import sqlite3
+import hashlib
+
+
+class MBTilesStore:
+    """
+    MBTiles container writing tiles in batched transactions
+    """
+
+    def __init__(self, path, batch_size=500, readonly=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = 0
+
+        if readonly:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            return
+
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS map (
+                zoom_level INTEGER NOT NULL,
+                tile_column INTEGER NOT NULL,
+                tile_row INTEGER NOT NULL,
+                tile_id TEXT NOT NULL,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            );
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB NOT NULL);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                       map.tile_row AS tile_row, images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+        """)
+        self.connection.commit()
+
+    def put(self, z, x, y, data, checksum=None):
+        """
+        Adds a tile, the image is only stored if its content is new
+        """
+        tile_id = checksum or hashlib.sha1(data).hexdigest()
+
+        self.connection.execute(
+            "INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)",
+            (tile_id, sqlite3.Binary(data)))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)",
+            (z, x, flip_row(y, z), tile_id))
+
+        self.pending += 1
+
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def get(self, z, x, y):
+        row = self.connection.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, flip_row(y, z))).fetchone()
+
+        return bytes(row[0]) if row else None
+
+    def tiles(self, z):
+        """
+        Returns the XYZ column and row of all tiles of a zoom level
+        """
+        cursor = self.connection.execute(
+            "SELECT tile_column, tile_row FROM map WHERE zoom_level = ?", (z,))
+
+        return {(x, flip_row(y, z)) for x, y in cursor}
+
+    def checksums(self, z):
+        """
+        Returns the content hash of all tiles of a zoom level
+        """
+        cursor = self.connection.execute(
+            "SELECT tile_column, tile_row, tile_id FROM map WHERE zoom_level = ?", (z,))
+
+        return {(x, flip_row(y, z)): tile_id for x, y, tile_id in cursor}
+
+    def delete_zoom(self, z):
+        """
+        Removes all tiles of a zoom level and the images no other tile uses
+
+        :return: the number of removed tiles
+        """
+        removed = self.connection.execute("DELETE FROM map WHERE zoom_level = ?", (z,)).rowcount
+        self.connection.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+        self.commit()
+
+        return removed
+
+    def count(self):
+        """
+        Returns the number of tiles and of unique images
+        """
+        tiles = self.connection.execute("SELECT COUNT(*) FROM map").fetchone()[0]
+        images = self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+        return tiles, images
+
+    def set_metadata(self, **metadata):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+            [(name, str(value)) for name, value in metadata.items()])
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def flip_row(y, z):
+    """
+    Converts between XYZ and TMS rows (the conversion is its own inverse)
+    """
+    return (1 << z) - 1 - y
@@ -10,15 +10,43 @@ Detect trees on ortho images
 
 """
 
+import os
 import sys
+import math
+import torch
 import rasterio
 import logging
 import argparse
-import geopy.distance
+import functools
+import itertools
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
 from pathlib import Path
-from typing import NoReturn
-from deepforest import main
-from deepforest.utilities import annotations_to_shapefile
+from typing import Callable, Iterator, List, NoReturn, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torchvision.ops.misc import FrozenBatchNorm2d
+import deepforest
+from deepforest import main, predict, preprocess, visualize
+
+from cadastre import load_cadastre
+from detection_cache import DetectionCache
+from tree_io import TreeWriter
+
+IOU_THRESHOLD = 0.15  # predict_tile default for hard NMS between windows
+METRIC_CRS = "EPSG:25832"  # ETRS89 / UTM zone 32N, metric CRS for Konstanz
+
+COLUMNS = ["xmin", "ymin", "xmax", "ymax", "xmin_coord", "ymin_coord", "xmax_coord", "ymax_coord", "xcenter_coord", "ycenter_coord", "diameter", "crown_area", "score"]
+
+# model, raster and window cache of a shard worker process
+worker_model = None
+worker_dataset = None
+worker_cache = None
 
 
 def tree_detect(
@@ -33,10 +61,30 @@ def tree_detect(
 
     logger.info(f"Starting detecting trees with arguments {args}")
 
+    if args.sweep:
+        tree_detect_sweep(args=args, logger=logger)
+        logger.info("Finished detecting trees")
+        return
+
+    if args.workers > 1:
+        tree_detect_sharded(args=args, logger=logger)
+        logger.info("Finished detecting trees")
+        return
+
     # model
     logger.info(f"Starting loading model")
-    model = main.deepforest()
-    model.use_release()
+    model = load_model()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.backend != "eager":
+        model = optimize_model(model, args, logger)
+
+    if args.stream or args.vegetation_filter or args.backend != "eager" or args.window_cache:
+        tree_detect_stream(args=args, model=model, logger=logger)
+        logger.info("Finished detecting trees")
+        return
 
     # predict trees
     logger.info(f"Starting predicting trees")
@@ -45,36 +93,1034 @@ def tree_detect(
         patch_size=args.patch_size,
         patch_overlap=args.patch_overlap,
         use_soft_nms=args.use_soft_nms,
-        sigma=0.01,
-        thresh=0.1,
+        sigma=args.sigma,
+        thresh=args.thresh,
         return_plot=False
     )
 
     # transform to coordinates
     logger.info(f"Starting transforming coordinates")
     r = rasterio.open(args.raster_path)
-    transform = r.transform
-    crs = r.crs
-    trees = annotations_to_shapefile(trees, transform=transform, crs=crs)
-    trees["xmin_coord"] = trees["geometry"].bounds.minx
-    trees["xmax_coord"] = trees["geometry"].bounds.maxx
-    trees["ymin_coord"] = trees["geometry"].bounds.miny
-    trees["ymax_coord"] = trees["geometry"].bounds.maxy
+    trees = georeference_trees(trees, transform=r.transform, crs=r.crs)
+
+    # outputs
+    write_trees(trees, args.outputs)
+
+    logger.info("Finished detecting trees")
+
+    return
+
+
+def load_model() -> main.deepforest:
+    """
+    Load the release model prepared for prediction as predict_tile does
+
+    :return: model
+    """
+
+    model = main.deepforest()
+    model.use_release()
+    model.model.eval()
+    model.model.score_thresh = model.config["score_thresh"]
+    model.model.nms_thresh = model.config["nms_thresh"]
+
+    return model
+
+
+def fold_frozen_batch_norms(module: torch.nn.Module) -> NoReturn:
+    """
+    Fold every FrozenBatchNorm2d into the convolution registered right
+    before it, as the ResNet backbone does, and replace it by Identity
+
+    :return: NoReturn
+    """
+
+    previous = None
+
+    for name, child in list(module.named_children()):
+        if isinstance(child, FrozenBatchNorm2d) and isinstance(previous, torch.nn.Conv2d):
+            scale = child.weight * (child.running_var + child.eps).rsqrt()
+            shift = child.bias - child.running_mean * scale
+            if previous.bias is not None:
+                shift = shift + previous.bias * scale
+            previous.weight = torch.nn.Parameter(previous.weight * scale.reshape(-1, 1, 1, 1))
+            previous.bias = torch.nn.Parameter(shift)
+            setattr(module, name, torch.nn.Identity())
+        else:
+            fold_frozen_batch_norms(child)
+        previous = child
+
+
+def quantize_backbone(
+    model: main.deepforest,
+    crops: List[np.ndarray],
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Quantize the ResNet body of the backbone to int8 with static post
+    training quantization calibrated on the crops. Dynamic quantization
+    would only cover linear layers, which RetinaNet does not have.
+
+    :return: NoReturn
+    """
+
+    torch.backends.quantized.engine = "fbgemm"
+    body = model.model.backbone.body
+    fold_frozen_batch_norms(body)
+
+    example = preprocess.preprocess_image(crops[0], device=model.current_device)
+    prepared = prepare_fx(body, get_default_qconfig_mapping("fbgemm"), example_inputs=(example,))
+    model.model.backbone.body = prepared
+
+    logger.info(f"Calibrating quantization on {len(crops)} windows")
+    for crop in crops:
+        predict_batch(model, [crop])
+
+    model.model.backbone.body = convert_fx(prepared)
+
+
+def calibration_crops(args: argparse.Namespace) -> List[np.ndarray]:
+    """
+    Read windows spread evenly over the raster for calibration
+
+    :return: crops
+    """
+
+    with rasterio.open(args.raster_path) as dataset:
+        rows = compute_windows(dataset.width, dataset.height, args.patch_size, args.patch_overlap)
+        windows = [window for _, row in rows for window in row]
+        indexes = np.unique(np.linspace(0, len(windows) - 1, args.calibration_windows).astype(int))
+        return [read_window(dataset, windows[index]) for index in indexes]
+
+
+def optimize_model(
+    model: main.deepforest,
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> main.deepforest:
+    """
+    Replace the eager model by its TorchScript export, optionally quantized.
+    The export is cached per release in the model cache and only created
+    if missing.
+
+    :return: model with the TorchScript module
+    """
+
+    suffix = "_int8" if args.quantize else ""
+    path = Path(args.model_cache) / f"deepforest_{model.__release_version__}{suffix}.pt"
+
+    if path.exists():
+        logger.info(f"Loading TorchScript model {path}")
+        model.model = torch.jit.load(str(path), map_location=model.current_device).eval()
+        return model
+
+    if args.quantize:
+        quantize_backbone(model, calibration_crops(args), logger)
+
+    logger.info(f"Exporting TorchScript model {path}")
+    scripted = torch.jit.script(model.model)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    scripted.save(str(path))
+    model.model = scripted
+
+    return model
+
+
+def georeference_trees(
+    trees: pd.DataFrame,
+    transform: rasterio.Affine,
+    crs: rasterio.crs.CRS
+) -> gpd.GeoDataFrame:
+    """
+    Add coordinates, centroids, diameter and crown area to predicted boxes.
+    The boxes are placed like annotations_to_shapefile does (pixel centers)
+    and measured in a metric CRS, all as column operations.
+
+    :return: trees with box geometries
+    """
+
+    cols = trees[["xmin", "xmax"]].values.astype(float) + 0.5
+    rows = trees[["ymin", "ymax"]].values.astype(float) + 0.5
+    x_coords = transform.a * cols + transform.b * rows + transform.c
+    y_coords = transform.d * cols + transform.e * rows + transform.f
+    xmin_coords, xmax_coords = x_coords[:, 0], x_coords[:, 1]
+    ymin_coords, ymax_coords = y_coords[:, 0], y_coords[:, 1]
+
+    trees = gpd.GeoDataFrame(trees, geometry=shapely.box(xmin_coords, ymin_coords, xmax_coords, ymax_coords), crs=crs)
+    trees["xmin_coord"] = np.minimum(xmin_coords, xmax_coords)
+    trees["xmax_coord"] = np.maximum(xmin_coords, xmax_coords)
+    trees["ymin_coord"] = np.minimum(ymin_coords, ymax_coords)
+    trees["ymax_coord"] = np.maximum(ymin_coords, ymax_coords)
 
     # compute centroids
-    logger.info(f"Starting computing centroids")
-    trees["xcenter_coord"] = trees["geometry"].centroid.x
-    trees["ycenter_coord"] = trees["geometry"].centroid.y
+    trees["xcenter_coord"] = (trees["xmin_coord"] + trees["xmax_coord"]) / 2
+    trees["ycenter_coord"] = (trees["ymin_coord"] + trees["ymax_coord"]) / 2
 
-    # compute diameter
-    trees["diameter"] = trees.apply(lambda tree: (geopy.distance.distance((tree["xmin_coord"], tree["ymin_coord"]), (tree["xmax_coord"], tree["ymin_coord"])).m + geopy.distance.distance((tree["xmin_coord"], tree["ymin_coord"]), (tree["xmin_coord"], tree["ymax_coord"])).m) / 2, axis=1)
+    # compute diameter as mean of the box width and height in meters
+    metric = trees.geometry.to_crs(METRIC_CRS)
+    bounds = metric.bounds
+    trees["diameter"] = ((bounds.maxx - bounds.minx) + (bounds.maxy - bounds.miny)) / 2
+    trees["crown_area"] = metric.area
 
-    # outputs
-    trees = trees.astype({"xmin": int, "ymin": int, "xmax": int, "ymax": int})
-    columns = ["xmin", "ymin", "xmax", "ymax", "xmin_coord", "ymin_coord", "xmax_coord", "ymax_coord", "xcenter_coord", "ycenter_coord", "diameter", "score"]
-    trees.to_csv(args.outputs, columns=columns, index=True, float_format="%.8f")
+    return trees
 
-    logger.info("Finished detecting trees")
+
+def write_trees(
+    trees: gpd.GeoDataFrame,
+    outputs: Path
+) -> NoReturn:
+    """
+    Write trees to the outputs as CSV, GeoParquet or Arrow IPC by suffix
+
+    :return: NoReturn
+    """
+
+    writer = TreeWriter(outputs, COLUMNS)
+    writer.write(trees)
+    writer.close()
+
+    return
+
+
+def compute_windows(
+    width: int,
+    height: int,
+    patch_size: int,
+    patch_overlap: float
+) -> List[Tuple[int, List[Window]]]:
+    """
+    Compute the sliding windows of predict_tile, grouped by rows
+
+    :return: row offset and windows of each row
+    """
+
+    def offsets(size: int, window_size: int) -> List[int]:
+        step = window_size - int(math.floor(window_size * patch_overlap))
+        last = size - window_size
+        values = list(range(0, last + 1, step))
+        if not values or values[-1] != last:
+            values.append(last)
+        return values
+
+    window_width = min(patch_size, width)
+    window_height = min(patch_size, height)
+
+    return [
+        (row, [Window(col, row, window_width, window_height) for col in offsets(width, window_width)])
+        for row in offsets(height, window_height)
+    ]
+
+
+def read_window(
+    dataset: rasterio.DatasetReader,
+    window: Window
+) -> np.ndarray:
+    """
+    Read a window of the raster as RGB crop in the layout of predict_tile
+
+    :return: crop with channels last
+    """
+
+    return np.moveaxis(dataset.read([1, 2, 3], window=window), 0, 2).astype("float32")
+
+
+def predict_batch(
+    model: main.deepforest,
+    crops: List[np.ndarray]
+) -> List[Optional[pd.DataFrame]]:
+    """
+    Predict trees on several crops in one forward pass, each crop is handled
+    as predict_image does. Crops should have the same shape, the model pads
+    differently sized images of a batch.
+
+    :return: boxes of each crop, None if no tree was found
+    """
+
+    images = [preprocess.preprocess_image(crop, device=model.current_device)[0] for crop in crops]
+
+    with torch.no_grad():
+        predictions = model.model(images)
+
+    # scripted RetinaNet returns losses and detections
+    if isinstance(predictions, tuple):
+        predictions = predictions[1]
+
+    return [
+        predict.across_class_nms(visualize.format_boxes(prediction), iou_threshold=0.1) if len(prediction["boxes"]) else None
+        for prediction in predictions
+    ]
+
+
+def predict_window(
+    model: main.deepforest,
+    dataset: rasterio.DatasetReader,
+    window: Window
+) -> pd.DataFrame:
+    """
+    Predict trees in a window of the raster as predict_tile does
+
+    :return: boxes in raster pixel coordinates, None if no tree was found
+    """
+
+    boxes = predict_batch(model, [read_window(dataset, window)])[0]
+
+    if boxes is not None:
+        boxes[["xmin", "xmax"]] += window.col_off
+        boxes[["ymin", "ymax"]] += window.row_off
+
+    return boxes
+
+
+def predict_windows(
+    model: main.deepforest,
+    dataset: rasterio.DatasetReader,
+    windows: List[Window],
+    batch_size: int,
+    cache: Optional[DetectionCache] = None
+) -> List[Optional[pd.DataFrame]]:
+    """
+    Predict trees in windows of the raster in batches. With a cache, only
+    windows whose pixels are not cached are predicted.
+
+    :return: boxes of each window in raster pixel coordinates, None if no
+        tree was found
+    """
+
+    results = []
+
+    for start in range(0, len(windows), batch_size):
+        batch = windows[start:start + batch_size]
+        crops = [read_window(dataset, window) for window in batch]
+
+        if cache is None:
+            predictions = predict_batch(model, crops)
+        else:
+            keys = [cache.key(crop) for crop in crops]
+            predictions = [cache.get(key) for key in keys]
+            missing = [index for index, boxes in enumerate(predictions) if boxes is None]
+            if missing:
+                for index, boxes in zip(missing, predict_batch(model, [crops[index] for index in missing])):
+                    cache.put(keys[index], boxes)
+                    predictions[index] = boxes
+            predictions = [None if boxes is None or len(boxes) == 0 else boxes for boxes in predictions]
+
+        for window, boxes in zip(batch, predictions):
+            if boxes is not None:
+                boxes[["xmin", "xmax"]] += window.col_off
+                boxes[["ymin", "ymax"]] += window.row_off
+            results.append(boxes)
+
+    return results
+
+
+def open_cache(
+    model: main.deepforest,
+    args: argparse.Namespace
+) -> Optional[DetectionCache]:
+    """
+    Open the window cache of --window-cache. The fingerprint covers all
+    settings changing the boxes predicted in a window.
+
+    :return: cache, None without --window-cache
+    """
+
+    if args.window_cache is None:
+        return None
+
+    fingerprint = ":".join(str(value) for value in [
+        deepforest.__version__, model.__release_version__, args.backend, args.quantize,
+        model.config["score_thresh"], model.config["nms_thresh"]
+    ])
+
+    return DetectionCache(args.window_cache, fingerprint)
+
+
+def overlap_components(boxes: np.ndarray) -> np.ndarray:
+    """
+    Label groups of boxes connected by overlaps. Boxes closer than one pixel
+    count as overlapping, as in the +1 areas of soft NMS, so boxes of
+    different groups never influence each other during NMS.
+
+    :return: group label of each box
+    """
+
+    parents = np.arange(len(boxes))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    order = np.argsort(boxes[:, 0], kind="stable")
+    sorted_boxes = boxes[order]
+    ends = np.searchsorted(sorted_boxes[:, 0], sorted_boxes[:, 2] + 1, side="left")
+
+    for i in range(len(sorted_boxes)):
+        candidates = np.arange(i + 1, ends[i])
+        if len(candidates) == 0:
+            continue
+        overlap = np.minimum(sorted_boxes[i, 3], sorted_boxes[candidates, 3]) - np.maximum(sorted_boxes[i, 1], sorted_boxes[candidates, 1]) + 1 > 0
+        for j in candidates[overlap]:
+            root_i, root_j = find(order[i]), find(order[j])
+            if root_i != root_j:
+                parents[root_j] = root_i
+
+    return np.array([find(i) for i in range(len(boxes))])
+
+
+def box_pairs(boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find all pairs of boxes closer than one pixel in both directions, which
+    includes all overlapping pairs. The boxes are bucketed in a uniform grid
+    with cells larger than any box, so only boxes of neighbouring cells are
+    compared.
+
+    :return: indexes i < j of the pairs
+    """
+
+    n = len(boxes)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    size = max(float((boxes[:, 2] - boxes[:, 0]).max()), float((boxes[:, 3] - boxes[:, 1]).max())) + 1
+    cells = np.floor(boxes[:, :2] / size).astype(np.int64)
+    cells -= cells.min(axis=0)
+    stride = int(cells[:, 1].max()) + 3
+    keys = cells[:, 0] * stride + cells[:, 1]
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    positions = np.arange(n)
+    first, second = [], []
+
+    # each pair of neighbouring cells is visited once
+    for dx, dy in [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]:
+        target = sorted_keys + dx * stride + dy
+        start = np.searchsorted(sorted_keys, target, side="left")
+        end = np.searchsorted(sorted_keys, target, side="right")
+        if dx == 0 and dy == 0:
+            start = positions + 1
+        counts = np.maximum(end - start, 0)
+        sources = np.repeat(positions, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        first.append(order[sources])
+        second.append(order[np.repeat(start, counts) + offsets])
+
+    i, j = np.concatenate(first), np.concatenate(second)
+    close = (
+        (np.minimum(boxes[i, 2], boxes[j, 2]) - np.maximum(boxes[i, 0], boxes[j, 0]) + 1 > 0) &
+        (np.minimum(boxes[i, 3], boxes[j, 3]) - np.maximum(boxes[i, 1], boxes[j, 1]) + 1 > 0)
+    )
+    i, j = i[close], j[close]
+    swap = i > j
+
+    return np.where(swap, j, i), np.where(swap, i, j)
+
+
+def pair_iou(
+    boxes: np.ndarray,
+    i: np.ndarray,
+    j: np.ndarray,
+    offset: float
+) -> np.ndarray:
+    """
+    IoU of pairs of boxes, offset is 1 for the inclusive pixel boxes of
+    soft NMS and 0 for torchvision NMS
+
+    :return: IoU of each pair
+    """
+
+    width = np.maximum(0, np.minimum(boxes[i, 2], boxes[j, 2]) - np.maximum(boxes[i, 0], boxes[j, 0]) + offset)
+    height = np.maximum(0, np.minimum(boxes[i, 3], boxes[j, 3]) - np.maximum(boxes[i, 1], boxes[j, 1]) + offset)
+    areas = (boxes[:, 2] - boxes[:, 0] + offset) * (boxes[:, 3] - boxes[:, 1] + offset)
+    intersection = width * height
+
+    return intersection / (areas[i] + areas[j] - intersection)
+
+
+def greedy_rounds(
+    scores: np.ndarray,
+    i: np.ndarray,
+    j: np.ndarray,
+    weights: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Greedy NMS over a graph of interacting boxes. Instead of selecting one
+    box after the other, every round selects all boxes scoring higher than
+    all their remaining neighbours (ties go to the lower index). Those boxes
+    come before their neighbours in the sequential order as well, so the
+    result is the same. Neighbours of selected boxes are removed, or decayed
+    by the weights of the pairs for soft NMS.
+
+    :return: selected boxes and their scores after decay
+    """
+
+    n = len(scores)
+    scores = scores.copy()
+    alive = np.ones(n, dtype=bool)
+    selected = np.zeros(n, dtype=bool)
+
+    while alive.any():
+        active = alive[i] & alive[j]
+        i, j = i[active], j[active]
+        if weights is not None:
+            weights = weights[active]
+
+        wins = (scores[i] > scores[j]) | ((scores[i] == scores[j]) & (i < j))
+        losers = np.zeros(n, dtype=bool)
+        losers[np.where(wins, j, i)] = True
+
+        maxima = alive & ~losers
+        alive &= ~maxima
+        selected |= maxima
+
+        first, second = maxima[i], maxima[j]
+        if weights is None:
+            alive[j[first]] = False
+            alive[i[second]] = False
+        else:
+            np.multiply.at(scores, j[first], weights[first])
+            np.multiply.at(scores, i[second], weights[second])
+
+    return selected, scores
+
+
+def grid_nms(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    iou_threshold: float
+) -> np.ndarray:
+    """
+    NMS as torchvision nms, comparing only neighbouring boxes
+
+    :return: indexes of kept boxes by decreasing score
+    """
+
+    i, j = box_pairs(boxes)
+    suppressing = pair_iou(boxes, i, j, offset=0) > iou_threshold
+    selected, _ = greedy_rounds(scores, i[suppressing], j[suppressing])
+    keep = np.flatnonzero(selected)
+
+    return keep[np.argsort(-scores[keep], kind="stable")]
+
+
+def grid_soft_nms(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    sigma: float,
+    thresh: float
+) -> np.ndarray:
+    """
+    Gaussian soft NMS as deepforest soft_nms, comparing only neighbouring
+    boxes
+
+    :return: indexes of kept boxes by decreasing decayed score
+    """
+
+    i, j = box_pairs(boxes)
+    iou = pair_iou(boxes, i, j, offset=1)
+    weights = np.exp(-(iou * iou) / np.float32(sigma)).astype(scores.dtype)
+    _, decayed = greedy_rounds(scores, i, j, weights)
+    keep = np.flatnonzero(decayed > thresh)
+
+    return keep[np.argsort(-decayed[keep], kind="stable")]
+
+
+def suppress(
+    boxes: pd.DataFrame,
+    use_soft_nms: bool,
+    sigma: float,
+    thresh: float
+) -> pd.DataFrame:
+    """
+    Non-max suppression of boxes from overlapping windows as in predict_tile
+
+    :return: kept boxes
+    """
+
+    coords = boxes[["xmin", "ymin", "xmax", "ymax"]].values.astype("float32")
+    scores = boxes.score.values.astype("float32")
+    labels = boxes.label.values
+
+    if not use_soft_nms:
+        keep = grid_nms(coords, scores, iou_threshold=IOU_THRESHOLD)
+    else:
+        keep = grid_soft_nms(coords, scores, sigma=sigma, thresh=thresh)
+
+    return pd.DataFrame({
+        "xmin": coords[keep, 0].astype(int),
+        "ymin": coords[keep, 1].astype(int),
+        "xmax": coords[keep, 2].astype(int),
+        "ymax": coords[keep, 3].astype(int),
+        "label": labels[keep],
+        "score": scores[keep]
+    })
+
+
+def has_vegetation(
+    dataset: rasterio.DatasetReader,
+    window: Window,
+    args: argparse.Namespace
+) -> bool:
+    """
+    Check a downsampled copy of a window for vegetation. A pixel counts as
+    vegetation if its excess green index 2g - r - b on chromatic coordinates
+    exceeds the threshold.
+
+    :return: whether the vegetation fraction reaches the minimum
+    """
+
+    factor = args.vegetation_downsample
+    shape = (3, max(1, window.height // factor), max(1, window.width // factor))
+    red, green, blue = dataset.read([1, 2, 3], window=window, out_shape=shape, resampling=Resampling.average).astype("float32")
+
+    total = red + green + blue
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exg = np.where(total > 0, (2 * green - red - blue) / total, 0)
+
+    return np.count_nonzero(exg > args.exg_threshold) >= args.vegetation_fraction * exg.size
+
+
+def stream_predictions(
+    model: main.deepforest,
+    dataset: rasterio.DatasetReader,
+    args: argparse.Namespace,
+    logger: logging.Logger,
+    rows: Optional[List[Tuple[int, List[Window]]]] = None,
+    top_limit: float = -math.inf,
+    bottom_row: float = math.inf,
+    deferred: Optional[List[pd.DataFrame]] = None,
+    skipped: Optional[List[Window]] = None,
+    cache: Optional[DetectionCache] = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Predict trees row of windows by row of windows. Boxes are suppressed and
+    yielded as soon as no box of a later row can overlap them, so only the
+    boxes along the current row are held in memory.
+
+    For the rows of a shard, groups of boxes that may continue in the
+    previous shard (reaching above top_limit, the lowest box edge of the
+    previous shard) or in the next shard (reaching below bottom_row, its
+    first row offset) are appended unsuppressed to deferred instead.
+
+    With the vegetation filter, windows without vegetation are appended to
+    skipped instead of being predicted. With a cache, windows with cached
+    pixels are not predicted again.
+
+    :return: iterator of kept boxes
+    """
+
+    if rows is None:
+        rows = compute_windows(dataset.width, dataset.height, args.patch_size, args.patch_overlap)
+    pending = None
+
+    for index, (row, windows) in enumerate(rows):
+        if args.vegetation_filter:
+            vegetation = [has_vegetation(dataset, window, args) for window in windows]
+            skipped.extend(window for window, green in zip(windows, vegetation) if not green)
+            windows = [window for window, green in zip(windows, vegetation) if green]
+        boxes = predict_windows(model, dataset, windows, args.batch_size, cache)
+        boxes = [b for b in boxes if b is not None]
+        if pending is not None:
+            boxes.insert(0, pending)
+        if not boxes:
+            continue
+        pending = pd.concat(boxes, ignore_index=True)
+
+        logger.info(f"Predicted row {index + 1}/{len(rows)} of windows, {len(pending)} boxes pending")
+
+        if args.patch_overlap == 0:
+            yield pending
+            pending = None
+            continue
+
+        # boxes of later rows start at the next row offset, groups of boxes
+        # ending before it are complete
+        next_row = rows[index + 1][0] if index + 1 < len(rows) else bottom_row
+        groups = overlap_components(pending[["xmin", "ymin", "xmax", "ymax"]].values)
+        open_groups = np.unique(groups[pending.ymax.values > next_row - 1])
+        complete = ~np.isin(groups, open_groups)
+
+        seam_groups = np.unique(groups[complete & (pending.ymin.values < top_limit + 1)])
+        seam = np.isin(groups, seam_groups)
+        if seam.any():
+            deferred.append(pending[seam])
+
+        kept = complete & ~seam
+        if kept.any():
+            yield suppress(pending[kept], args.use_soft_nms, args.sigma, args.thresh)
+
+        pending = pending[~complete].reset_index(drop=True) if not complete.all() else None
+
+    if pending is not None:
+        deferred.append(pending)
+
+
+def append_trees(
+    trees: pd.DataFrame,
+    dataset: rasterio.DatasetReader,
+    writer: TreeWriter
+) -> int:
+    """
+    Georeference predicted boxes and append them to the outputs
+
+    :return: number of trees written so far
+    """
+
+    if len(trees) == 0:
+        return writer.count
+
+    trees = georeference_trees(trees, transform=dataset.transform, crs=dataset.crs)
+    writer.write(trees)
+
+    return writer.count
+
+
+def report_skipped(
+    dataset: rasterio.DatasetReader,
+    skipped: List[Window],
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Log the windows and the area skipped by the vegetation filter, i.e. the
+    area not covered by any predicted window. With a cadastre, also log how
+    many of its trees lie in the skipped area and may have been missed.
+
+    :return: NoReturn
+    """
+
+    rows = compute_windows(dataset.width, dataset.height, args.patch_size, args.patch_overlap)
+    windows = [window for _, row in rows for window in row]
+    skipped = {(window.col_off, window.row_off) for window in skipped}
+
+    # coverage of the predicted windows on a coarse grid, cells partly
+    # covered count as covered
+    factor = args.vegetation_downsample
+    covered = np.zeros((math.ceil(dataset.height / factor), math.ceil(dataset.width / factor)), dtype=bool)
+    for window in windows:
+        if (window.col_off, window.row_off) not in skipped:
+            covered[
+                window.row_off // factor:math.ceil((window.row_off + window.height) / factor),
+                window.col_off // factor:math.ceil((window.col_off + window.width) / factor)
+            ] = True
+
+    fraction = 1 - covered.mean()
+    raster = gpd.GeoSeries([shapely.box(*dataset.bounds)], crs=dataset.crs).to_crs(METRIC_CRS)
+    area = raster.area.iloc[0] * fraction / 1e6
+
+    logger.info(f"Skipped {len(skipped)}/{len(windows)} windows without vegetation, {fraction:.1%} of the raster or {area:.2f} km²")
+
+    if args.cadastre is None:
+        return
+
+    points = load_cadastre(args.cadastre).geometry.to_crs(dataset.crs)
+    inverse = ~dataset.transform
+    point_cols = np.floor(inverse.a * points.x.values + inverse.b * points.y.values + inverse.c).astype(int)
+    point_rows = np.floor(inverse.d * points.x.values + inverse.e * points.y.values + inverse.f).astype(int)
+
+    inside = (point_cols >= 0) & (point_cols < dataset.width) & (point_rows >= 0) & (point_rows < dataset.height)
+    missed = np.count_nonzero(~covered[point_rows[inside] // factor, point_cols[inside] // factor])
+
+    logger.info(f"{missed}/{np.count_nonzero(inside)} cadastre trees on the raster lie in the skipped area")
+
+    return
+
+
+def tree_detect_stream(
+    args: argparse.Namespace,
+    model: main.deepforest,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Detect trees window by window and write them incrementally, the memory
+    does not depend on the size of the raster
+
+    :return: NoReturn
+    """
+
+    logger.info(f"Starting streaming prediction of trees")
+    writer = TreeWriter(args.outputs, COLUMNS)
+    skipped = []
+    cache = open_cache(model, args)
+
+    with rasterio.open(args.raster_path) as dataset:
+        for trees in stream_predictions(model, dataset, args, logger, skipped=skipped, cache=cache):
+            trees["label"] = trees.label.apply(lambda x: model.numeric_to_label_dict[x])
+            append_trees(trees, dataset, writer)
+
+        if args.vegetation_filter:
+            report_skipped(dataset, skipped, args, logger)
+
+    if cache is not None:
+        logger.info(f"Predicted {cache.misses} windows, {cache.hits} windows from the cache")
+        cache.close()
+
+    writer.close()
+    logger.info(f"Written {writer.count} trees")
+
+    return
+
+
+def init_shard_worker(args: argparse.Namespace, threads: int) -> NoReturn:
+    """
+    Load the model and open the raster once per worker process
+
+    :return: NoReturn
+    """
+
+    global worker_model, worker_dataset, worker_cache
+
+    torch.set_num_threads(threads)
+    worker_model = load_model()
+    if args.backend != "eager":
+        worker_model = optimize_model(worker_model, args, logging.getLogger(__name__))
+    worker_dataset = rasterio.open(args.raster_path)
+    worker_cache = open_cache(worker_model, args)
+
+
+def detect_shard(
+    args: argparse.Namespace,
+    rows: List[Tuple[int, List[Window]]],
+    top_limit: float,
+    bottom_row: float
+) -> Tuple[pd.DataFrame, pd.DataFrame, List[Window]]:
+    """
+    Predict trees on a shard of rows of windows in a worker process
+
+    :return: kept boxes, unsuppressed boxes along the shard seams and
+        windows skipped by the vegetation filter
+    """
+
+    logger = logging.getLogger(__name__)
+    deferred = []
+    skipped = []
+    kept = list(stream_predictions(worker_model, worker_dataset, args, logger, rows, top_limit, bottom_row, deferred, skipped, worker_cache))
+    if worker_cache is not None:
+        worker_cache.commit()
+
+    labels = worker_model.numeric_to_label_dict
+    kept = pd.concat(kept, ignore_index=True) if kept else pd.DataFrame(columns=["xmin", "ymin", "xmax", "ymax", "label", "score"])
+    deferred = pd.concat(deferred, ignore_index=True) if deferred else pd.DataFrame(columns=["xmin", "ymin", "xmax", "ymax", "label", "score"])
+    kept["label"] = kept.label.apply(lambda x: labels[x])
+    deferred["label"] = deferred.label.apply(lambda x: labels[x])
+
+    return kept, deferred, skipped
+
+
+def tree_detect_sharded(
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Detect trees on spatial shards of rows of windows in worker processes,
+    each loading the model once. The boxes along the shard seams are
+    suppressed together afterwards, so the trees are the same as with a
+    single process
+
+    :return: NoReturn
+    """
+
+    with rasterio.open(args.raster_path) as dataset:
+        rows = compute_windows(dataset.width, dataset.height, args.patch_size, args.patch_overlap)
+
+    window_height = rows[0][1][0].height
+    shard_count = min(len(rows), args.workers * 4)
+    bounds = np.linspace(0, len(rows), shard_count + 1).astype(int)
+
+    shards = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        top_limit = rows[start - 1][0] + window_height if start > 0 else -math.inf
+        bottom_row = rows[end][0] if end < len(rows) else math.inf
+        shards.append((rows[start:end], top_limit, bottom_row))
+
+    logger.info(f"Starting predicting trees on {len(shards)} shards with {args.workers} workers")
+
+    # export the model once before the workers load it
+    if args.backend != "eager":
+        optimize_model(load_model(), args, logger)
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    writer = TreeWriter(args.outputs, COLUMNS)
+    deferred = []
+    skipped = []
+
+    with rasterio.open(args.raster_path) as dataset, ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=init_shard_worker,
+        initargs=(args, threads)
+    ) as executor:
+        futures = [executor.submit(detect_shard, args, *shard) for shard in shards]
+
+        for index, future in enumerate(as_completed(futures), 1):
+            kept, seam, shard_skipped = future.result()
+            count = append_trees(kept, dataset, writer)
+            deferred.append(seam)
+            skipped.extend(shard_skipped)
+            logger.info(f"Finished shard {index}/{len(shards)}, {count} trees written")
+
+        deferred = pd.concat(deferred, ignore_index=True)
+        logger.info(f"Suppressing {len(deferred)} boxes along the shard seams")
+        if len(deferred):
+            append_trees(suppress(deferred, args.use_soft_nms, args.sigma, args.thresh), dataset, writer)
+
+        if args.vegetation_filter:
+            report_skipped(dataset, skipped, args, logger)
+
+    writer.close()
+    logger.info(f"Written {writer.count} trees")
+
+    return
+
+
+def predict_raw(
+    model: main.deepforest,
+    dataset: rasterio.DatasetReader,
+    patch_size: int,
+    patch_overlap: float,
+    logger: logging.Logger
+) -> pd.DataFrame:
+    """
+    Predict the boxes of all windows before the NMS between windows
+
+    :return: boxes in raster pixel coordinates with their window index
+    """
+
+    rows = compute_windows(dataset.width, dataset.height, patch_size, patch_overlap)
+    windows = [window for _, row in rows for window in row]
+    boxes = []
+
+    for index, window in enumerate(windows):
+        window_boxes = predict_window(model, dataset, window)
+        if window_boxes is not None:
+            window_boxes["window"] = index
+            boxes.append(window_boxes)
+        if (index + 1) % 100 == 0:
+            logger.info(f"Predicted {index + 1}/{len(windows)} windows")
+
+    if not boxes:
+        return pd.DataFrame({column: [] for column in ["xmin", "ymin", "xmax", "ymax", "label", "score", "window"]})
+
+    return pd.concat(boxes, ignore_index=True)
+
+
+def load_raw_predictions(
+    args: argparse.Namespace,
+    patch_size: int,
+    patch_overlap: float,
+    get_model: Callable[[], main.deepforest],
+    logger: logging.Logger
+) -> pd.DataFrame:
+    """
+    Load raw predictions of a patch size and overlap from the sweep cache,
+    predicting and adding them to the cache if missing. The cache is a npz
+    file with one set of columns per patch size and overlap, it is dropped
+    if the raster changed.
+
+    :return: boxes in raster pixel coordinates with their window index
+    """
+
+    stat = os.stat(args.raster_path)
+    raster = f"{Path(args.raster_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    key = f"{patch_size}_{patch_overlap}"
+
+    arrays = {}
+    if args.sweep_cache.exists():
+        with np.load(args.sweep_cache) as cache:
+            if str(cache["raster"]) == raster:
+                arrays = dict(cache)
+
+    if f"{key}_score" in arrays:
+        return pd.DataFrame({
+            column: arrays[f"{key}_{column}"]
+            for column in ["xmin", "ymin", "xmax", "ymax", "label", "score", "window"]
+        })
+
+    logger.info(f"Starting predicting raw boxes with patch size {patch_size} and overlap {patch_overlap}")
+    with rasterio.open(args.raster_path) as dataset:
+        boxes = predict_raw(get_model(), dataset, patch_size, patch_overlap, logger)
+
+    arrays["raster"] = np.array(raster)
+    arrays.update({
+        f"{key}_xmin": boxes.xmin.values.astype("float32"),
+        f"{key}_ymin": boxes.ymin.values.astype("float32"),
+        f"{key}_xmax": boxes.xmax.values.astype("float32"),
+        f"{key}_ymax": boxes.ymax.values.astype("float32"),
+        f"{key}_label": boxes.label.values.astype("int16"),
+        f"{key}_score": boxes.score.values.astype("float32"),
+        f"{key}_window": boxes.window.values.astype("int32")
+    })
+
+    with open(args.sweep_cache, "wb") as f:
+        np.savez_compressed(f, **arrays)
+
+    logger.info(f"Cached {len(boxes)} raw boxes in {args.sweep_cache}")
+
+    return boxes
+
+
+def tree_detect_sweep(
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Count the detected trees for all combinations of the sweep parameters.
+    Inference only runs once per patch size and overlap, NMS, score
+    threshold and form factor filter are applied to the cached raw boxes.
+
+    The form factor filter keeps boxes with |width / height - 1| below the
+    form factor, as in Posprocessing.py.
+
+    :return: NoReturn
+    """
+
+    if args.sweep_cache is None:
+        args.sweep_cache = Path(args.raster_path).with_suffix(".sweep.npz")
+
+    patch_sizes = args.sweep_patch_sizes or [args.patch_size]
+    patch_overlaps = args.sweep_patch_overlaps or [args.patch_overlap]
+    # sigma and thresh only matter for soft NMS
+    nms_parameters = list(itertools.product(args.sweep_sigmas or [args.sigma], args.sweep_threshs or [args.thresh])) if args.use_soft_nms else [(math.nan, math.nan)]
+    scores = args.sweep_scores or [0.0]
+    form_factors = args.sweep_form_factors or [math.inf]
+
+    # the model is only loaded if predictions are missing in the cache
+    get_model = functools.lru_cache(maxsize=None)(load_model)
+    results = []
+
+    for patch_size, patch_overlap in itertools.product(patch_sizes, patch_overlaps):
+        boxes = load_raw_predictions(args, patch_size, patch_overlap, get_model, logger)
+
+        for sigma, thresh in nms_parameters:
+            kept = boxes
+            if patch_overlap != 0 and len(boxes):
+                kept = suppress(boxes, args.use_soft_nms, sigma, thresh)
+
+            width = (kept.xmax - kept.xmin).values.astype(float)
+            height = (kept.ymax - kept.ymin).values.astype(float)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                form = np.abs(width / height - 1)
+            kept_scores = kept.score.values
+
+            for score, form_factor in itertools.product(scores, form_factors):
+                count = int(np.count_nonzero((kept_scores >= score) & (form < form_factor)))
+                results.append({
+                    "patch_size": patch_size,
+                    "patch_overlap": patch_overlap,
+                    "use_soft_nms": args.use_soft_nms,
+                    "sigma": sigma,
+                    "thresh": thresh,
+                    "score": score,
+                    "form_factor": form_factor,
+                    "raw_boxes": len(boxes),
+                    "trees": count
+                })
+
+            logger.info(f"Swept patch size {patch_size}, overlap {patch_overlap}, sigma {sigma}, thresh {thresh}")
+
+    pd.DataFrame(results).to_csv(args.sweep, index=False)
+    logger.info(f"Written {len(results)} parameter sets to {args.sweep}")
 
     return
 
@@ -122,10 +1168,148 @@ def get_parser():
         default=True,
         help="Use Soft NMS (default: False)"
     )
+    parser.add_argument(
+        "--sigma",
+        type=float,
+        default=0.01,
+        help="Variance of the Gaussian function of Soft NMS (default: 0.01)"
+    )
+    parser.add_argument(
+        "--thresh",
+        type=float,
+        default=0.1,
+        help="Score threshold after Soft NMS (default: 0.1)"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the raster window by window and write trees incrementally (default: False)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes predicting shards of the raster, implies --stream (default: 1)"
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["eager", "torchscript"],
+        default="eager",
+        help="Inference backend, torchscript exports the model once to the model cache and implies --stream (default: eager)"
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Quantize the backbone to int8 before the export of --backend torchscript (default: False)"
+    )
+    parser.add_argument(
+        "--calibration-windows",
+        type=int,
+        default=16,
+        help="Number of windows of the raster to calibrate the quantization on (default: 16)"
+    )
+    parser.add_argument(
+        "--model-cache",
+        type=Path,
+        default=Path("data/models"),
+        help="Directory of exported models (default: data/models)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of windows predicted in one forward pass when streaming (default: 1)"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Number of torch intra-op threads, 0 keeps the default (default: 0)"
+    )
+    parser.add_argument(
+        "--window-cache",
+        type=Path,
+        help="SQLite cache of the boxes of each window keyed by its pixels, only windows with changed pixels are predicted, implies --stream"
+    )
+    parser.add_argument(
+        "--vegetation-filter",
+        action="store_true",
+        help="Skip windows without vegetation by their excess green index, implies --stream (default: False)"
+    )
+    parser.add_argument(
+        "--exg-threshold",
+        type=float,
+        default=0.05,
+        help="Excess green index 2g - r - b above which a pixel counts as vegetation (default: 0.05)"
+    )
+    parser.add_argument(
+        "--vegetation-fraction",
+        type=float,
+        default=0.001,
+        help="Minimum fraction of vegetation pixels of a predicted window (default: 0.001)"
+    )
+    parser.add_argument(
+        "--vegetation-downsample",
+        type=int,
+        default=8,
+        help="Downsampling factor of the windows for the vegetation filter (default: 8)"
+    )
+    parser.add_argument(
+        "--cadastre",
+        type=Path,
+        help="Tree cadastre CSV or GeoJSON to count cadastre trees in windows skipped by the vegetation filter"
+    )
+    parser.add_argument(
+        "--sweep",
+        type=Path,
+        help="Write the number of trees per combination of the sweep parameters to this CSV instead of detecting trees"
+    )
+    parser.add_argument(
+        "--sweep-cache",
+        type=Path,
+        help="Cache of the raw predictions for --sweep (default: raster path with suffix .sweep.npz)"
+    )
+    parser.add_argument(
+        "--sweep-patch-sizes",
+        type=int,
+        nargs="+",
+        help="Patch sizes for --sweep (default: --patch-size)"
+    )
+    parser.add_argument(
+        "--sweep-patch-overlaps",
+        type=float,
+        nargs="+",
+        help="Patch overlaps for --sweep (default: --patch-overlap)"
+    )
+    parser.add_argument(
+        "--sweep-sigmas",
+        type=float,
+        nargs="+",
+        help="Soft NMS sigmas for --sweep (default: --sigma)"
+    )
+    parser.add_argument(
+        "--sweep-threshs",
+        type=float,
+        nargs="+",
+        help="Soft NMS score thresholds for --sweep (default: --thresh)"
+    )
+    parser.add_argument(
+        "--sweep-scores",
+        type=float,
+        nargs="+",
+        help="Minimum scores of trees for --sweep (default: 0)"
+    )
+    parser.add_argument(
+        "--sweep-form-factors",
+        type=float,
+        nargs="+",
+        help="Maximum |width / height - 1| of trees for --sweep (default: no limit)"
+    )
     parser.add_argument(
         "--outputs",
         type=Path,
-        help="Path to outputs"
+        help="Path to outputs, written as GeoParquet for .parquet, Arrow IPC for .arrow/.feather and CSV otherwise"
     )
 
     return parser
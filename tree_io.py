@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Tree IO
+-------
+
+Read and write detected trees as CSV, GeoParquet or Arrow IPC
+
+The format follows the file suffix. The columnar formats keep the box
+geometry as WKB with GeoParquet metadata, the detection id as column and
+compact dtypes, and are written in chunks so detections can be streamed.
+The CSV is written as before, with the detection id as unnamed index.
+
+Merged trees are written in chunks as GeoParquet, Arrow IPC or GeoJSON.
+
+"""
+
+import json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PARQUET_SUFFIXES = {".parquet", ".geoparquet"}
+ARROW_SUFFIXES = {".arrow", ".feather", ".ipc"}
+
+COMPACT_DTYPES = {
+    "xmin": "int32",
+    "ymin": "int32",
+    "xmax": "int32",
+    "ymax": "int32",
+    "diameter": "float32",
+    "crown_area": "float32",
+    "score": "float32"
+}
+
+
+def output_format(path):
+    """
+    Returns parquet, arrow or csv depending on the suffix of the path
+    """
+    suffix = str(getattr(path, "suffix", "")).lower()
+
+    if suffix in PARQUET_SUFFIXES:
+        return "parquet"
+    if suffix in ARROW_SUFFIXES:
+        return "arrow"
+
+    return "csv"
+
+
+def geo_metadata(crs, geometry_type="Polygon"):
+    """
+    Returns the GeoParquet metadata of a geometry column
+    """
+    column = {"encoding": "WKB", "geometry_type": geometry_type}
+
+    if crs is not None:
+        column["crs"] = crs.to_json_dict()
+
+    return {"version": "0.4.0", "primary_column": "geometry", "columns": {"geometry": column}}
+
+
+def to_arrow(trees, columns, start):
+    """
+    Converts trees to an Arrow table with detection ids from start, all
+    columns are numeric
+    """
+    frame = pd.DataFrame({column: trees[column].values for column in columns})
+    frame = frame.astype({column: COMPACT_DTYPES.get(column, "float64") for column in frame})
+    frame.insert(0, "detectId", np.arange(start, start + len(frame), dtype="int64"))
+
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    geometry = shapely.to_wkb(np.asarray(trees.geometry.values, dtype=object)) if len(trees) else np.array([], dtype=object)
+    table = table.append_column("geometry", pa.array(geometry, type=pa.binary()))
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"geo"] = json.dumps(geo_metadata(getattr(trees, "crs", None))).encode("utf-8")
+
+    return table.replace_schema_metadata(metadata)
+
+
+class TreeWriter:
+    """
+    Writes trees in chunks to a CSV, GeoParquet or Arrow IPC file. CSV can
+    also be written to a text buffer.
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.format = output_format(path)
+        self.count = 0
+        self.writer = None
+
+    def write(self, trees):
+        """
+        Appends trees, numbered after the trees written before
+        """
+        trees = trees.astype({"xmin": int, "ymin": int, "xmax": int, "ymax": int})
+
+        if self.format == "csv":
+            trees.index = pd.RangeIndex(self.count, self.count + len(trees))
+            trees.to_csv(self.path, columns=self.columns, index=True, float_format="%.8f", mode="a" if self.count else "w", header=not self.count)
+        else:
+            table = to_arrow(trees, self.columns, self.count)
+            if self.writer is None:
+                self.writer = self.open(table.schema)
+            if self.format == "parquet":
+                self.writer.write_table(table)
+            else:
+                self.writer.write(table)
+
+        self.count += len(trees)
+
+    def open(self, schema):
+        if self.format == "parquet":
+            return pq.ParquetWriter(str(self.path), schema, compression="zstd")
+
+        return pa.ipc.new_file(str(self.path), schema)
+
+    def close(self):
+        """
+        Finishes the file, an empty file with header or schema is written if
+        no tree was written
+        """
+        if self.count == 0 and self.writer is None:
+            empty = gpd.GeoDataFrame(pd.DataFrame(columns=self.columns), geometry=gpd.GeoSeries([]))
+            if self.format == "csv":
+                self.write(empty)
+                return
+            self.writer = self.open(to_arrow(empty, self.columns, 0).schema)
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def read_trees(path):
+    """
+    Reads detected trees of any format with their boxes as geometry and the
+    detection id as detectId column
+    """
+    if output_format(path) == "parquet":
+        return gpd.read_parquet(path)
+    if output_format(path) == "arrow":
+        return gpd.read_feather(path)
+
+    trees = pd.read_csv(path)
+    trees = trees.rename(columns={"Unnamed: 0": "detectId"})
+
+    return gpd.GeoDataFrame(trees, geometry=shapely.box(
+        trees.xmin_coord.values, trees.ymin_coord.values,
+        trees.xmax_coord.values, trees.ymax_coord.values), crs="EPSG:4326")
+
+
+class FrameWriter:
+    """
+    Writes GeoDataFrames with the same columns and dtypes in chunks to a
+    GeoParquet, Arrow IPC or GeoJSON file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.format = output_format(path)
+        self.count = 0
+        self.writer = None
+        self.schema = None
+
+    def write(self, frame):
+        if self.format == "csv":
+            self.write_geojson(frame)
+        else:
+            self.write_arrow(frame)
+
+        self.count += len(frame)
+
+    def write_arrow(self, frame):
+        table = pa.Table.from_pandas(pd.DataFrame(frame.drop(columns=frame.geometry.name)), preserve_index=False)
+        geometry = shapely.to_wkb(np.asarray(frame.geometry.values, dtype=object)) if len(frame) else np.array([], dtype=object)
+        table = table.append_column("geometry", pa.array(geometry, type=pa.binary()))
+
+        if self.writer is None:
+            metadata = dict(table.schema.metadata or {})
+            metadata[b"geo"] = json.dumps(geo_metadata(frame.crs, geometry_type=["Point", "Polygon"])).encode("utf-8")
+            self.schema = table.schema.with_metadata(metadata)
+            if self.format == "parquet":
+                self.writer = pq.ParquetWriter(str(self.path), self.schema, compression="zstd")
+            else:
+                self.writer = pa.ipc.new_file(str(self.path), self.schema)
+
+        table = table.replace_schema_metadata(self.schema.metadata).cast(self.schema)
+
+        if self.format == "parquet":
+            self.writer.write_table(table)
+        else:
+            self.writer.write(table)
+
+    def write_geojson(self, frame):
+        if self.writer is None:
+            self.writer = open(self.path, "w", encoding="utf-8")
+            self.writer.write('{"type": "FeatureCollection", "features": [\n')
+
+        features = json.loads(frame.to_json(na="null", drop_id=True))["features"]
+
+        for feature in features:
+            if self.count or feature is not features[0]:
+                self.writer.write(",\n")
+            self.writer.write(json.dumps(feature))
+
+    def close(self):
+        if self.format == "csv":
+            if self.writer is None:
+                self.writer = open(self.path, "w", encoding="utf-8")
+                self.writer.write('{"type": "FeatureCollection", "features": [\n')
+            self.writer.write("\n]}\n")
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
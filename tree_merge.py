@@ -10,82 +10,850 @@ Merge trees from kataster and detection
 
 """
 
+import sys
+import logging
+import argparse
 import pandas as pd
 import geopandas as gpd
-from shapely import geometry
+import numpy as np
+import shapely
+from pathlib import Path
+from typing import NoReturn, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
 
+from cadastre import load_cadastre
+from merged_store import MergedStore
+from tree_io import FrameWriter, output_format, read_trees
 
-# load city trees
-trees_city = gpd.read_file("data/raw/KN_Baumkataster_2020S.geojson")
-trees_city = trees_city.drop(columns=["OBJECTID"])
+# degrees per meter in Konstanz
+LON_PER_METER = 9.041375464338667e-06
+LAT_PER_METER = 9.099335504202068e-06
+METRIC_CRS = "EPSG:25832"  # ETRS89 / UTM zone 32N, metric CRS for Konstanz
+MAX_DETECT_DIAMETER = 50  # meters
+MERGE_CHUNK_TREES = 200000  # trees assembled at once by merge_partitioned
+FULL_MERGE_SHARE = 0.5  # share of city trees around changes above which the store is rebuilt
 
-# create bounding boxes for trees
-trees_city["geometry_city"] = trees_city.geometry
-trees_city.geometry = trees_city.apply(lambda tree: geometry.box(tree.geometry.x - (tree.kronendurchmesserM/2)*9.041375464338667e-06, tree.geometry.y - (tree.kronendurchmesserM/2)*9.099335504202068e-06, tree.geometry.x + (tree.kronendurchmesserM/2)*9.041375464338667e-06, tree.geometry.y + (tree.kronendurchmesserM/2)*9.099335504202068e-06), axis=1)
+STRING_COLUMNS = ["location", "Name_dt", "Name_lat", "Name_Sym"]
 
-# tree detected by us
-trees_detected = pd.read_csv("data/processed/DOP_20_C_EPSG_4326.csv")
-trees_detected = trees_detected.rename( columns={'Unnamed: 0':'detectId'})
-trees_detected = gpd.GeoDataFrame(trees_detected, geometry=gpd.points_from_xy(trees_detected["xcenter_coord"], trees_detected["ycenter_coord"], crs="EPSG:4326"))
+# columns of detected trees in the merged trees
+DETECT_COLUMNS = {"detectId": "detect_id", "xmin": "detect_x_min", "ymin": "detect_y_min",
+    "xmax": "detect_x_max", "ymax": "detect_y_max", "xmin_coord": "detect_x_min_coord", "ymin_coord": "detect_y_min_coord",
+    "xmax_coord": "detect_x_max_coord", "ymax_coord": "detect_y_max_coord", 'xcenter_coord': "detect_x_center_coord",
+    'ycenter_coord': "detect_y_center_coord", "diameter": "detect_diameter", "crown_area": "detect_crown_area",
+    "score": "detect_score"
+}
 
-# add box as geometry
-trees_detected["geometry_detect"] = trees_detected.geometry
-trees_detected.geometry = trees_detected.apply(lambda tree: geometry.box(tree.xmin_coord, tree.ymin_coord, tree.xmax_coord, tree.ymax_coord), axis=1)
+# columns of the store read by incremental merges
+STORED_COLUMNS = ["baumId", "maintained", "detected", *DETECT_COLUMNS.values()]
 
 
-# merge tiles
-trees_detected = trees_detected.loc[(trees_detected.score>=0.00000)&(trees_detected.diameter<=50)]
+def tree_merge(
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Merge trees from kataster and detection
 
-# tree set 1
-trees_1 = gpd.sjoin(trees_city, trees_detected, how="inner", op='intersects')
-trees_1 = trees_1.drop_duplicates(subset = ["baumId"], keep="first")
-trees_1.geometry = trees_1.geometry_city
-trees_1["maintained"] = 1
-trees_1["detected"] = 1
+    :return: NoReturn
+    """
 
-# tree set 2
-# trees in kataster
-trees_2 = trees_city.loc[~trees_city.baumId.isin(trees_1.baumId)]
-trees_2.geometry = trees_2.geometry_city
-trees_2["maintained"] = 1
-trees_2["detected"] = 0
+    logger.info(f"Starting merging trees with arguments {args}")
 
-# tree set 3
-trees_3 = trees_detected.loc[~trees_detected.detectId.isin(trees_1.detectId)]
-trees_3.geometry = trees_3.geometry_detect
-trees_3["maintained"] = 0
-trees_3["detected"] = 1
+    trees_city = load_city_trees(args.cadastre)
+    trees_detected = load_detected_trees(args.detected)
+    logger.info(f"Loaded {len(trees_city)} cadastre trees and {len(trees_detected)} detected trees")
 
-trees = pd.concat([trees_1, trees_2, trees_3], ignore_index=True)
+    if args.store and MergedStore(args.store).exists() and (args.changed_areas or args.changed_ids):
+        count = merge_incremental(trees_city, trees_detected, MergedStore(args.store), args, logger)
+    elif args.store:
+        trees = merge_trees(trees_city, trees_detected, args.match, args.min_iou, args.max_distance)
+        MergedStore(args.store).create(trees.astype({column: "string" for column in STRING_COLUMNS}))
+        count = len(trees)
+    elif args.workers > 1:
+        count = merge_partitioned(trees_city, trees_detected, args.outputs, args, logger)
+    else:
+        trees = merge_trees(trees_city, trees_detected, args.match, args.min_iou, args.max_distance)
+        write_merged(trees, args.outputs)
+        count = len(trees)
 
-trees = trees.rename(columns={"detectId": "detect_id", "xmin": "detect_x_min", "ymin": "detect_y_min",
-    "xmax": "detect_x_max", "ymax": "detect_y_max", "xmin_coord": "detect_x_min_coord", "ymin_coord": "detect_y_min_coord",
-    "xmax_coord": "detect_x_max_coord", "ymax_coord": "detect_y_max_coord", 'xcenter_coord': "detect_x_center_coord",
-    'ycenter_coord': "detect_y_center_coord", "diameter": "detect_diameter", "score": "detect_score"
-})
-
-trees = trees.astype({
-    "baumId": pd.Int64Dtype(),
-    "baumNr": pd.Int64Dtype(),
-    "baumart": pd.Int64Dtype(),
-    "hoeheM": pd.Int64Dtype(),
-    "kronendurchmesserM": pd.Int64Dtype(),
-    "stammumfangCM": pd.Int64Dtype(),
-    "detect_id": pd.Int64Dtype(),
-    "detect_x_min": pd.Int64Dtype(),
-    "detect_y_min": pd.Int64Dtype(),
-    "detect_x_max": pd.Int64Dtype(),
-    "detect_y_max": pd.Int64Dtype()
-})
-
-cols = [
-    'baumId', 'baumNr', 'baumart', 'hoeheM', 'kronendurchmesserM', 'stammumfangCM',
-    'location', 'Name_dt', 'Name_lat', 'Name_Sym', 'detect_id', 'detect_x_min',
-       'detect_y_min', 'detect_x_max', 'detect_y_max', 'detect_x_min_coord',
-       'detect_y_min_coord', 'detect_x_max_coord', 'detect_y_max_coord',
-       'detect_x_center_coord', 'detect_y_center_coord', 'detect_diameter',
-       'detect_score', 'maintained', 'detected', "geometry"
-]
-
-trees.loc[:, cols].to_file("data/processed/DOP_20_C_EPSG_4326.geojson", driver="GeoJSON", float_format="%.8f")
+    logger.info(f"Written {count} trees to {args.store or args.outputs}")
+
+    return
+
+
+def load_city_trees(path: Path) -> gpd.GeoDataFrame:
+    """
+    Load city trees from CSV or GeoJSON with their crown as box geometry
+
+    :return: city trees
+    """
+
+    trees_city = load_cadastre(path)
+    trees_city = trees_city.drop(columns=["OBJECTID"])
+
+    # create bounding boxes for trees
+    trees_city["geometry_city"] = trees_city.geometry
+    x = trees_city.geometry.x.values
+    y = trees_city.geometry.y.values
+    radius = trees_city.kronendurchmesserM.values / 2
+    trees_city.geometry = shapely.box(x - radius * LON_PER_METER, y - radius * LAT_PER_METER, x + radius * LON_PER_METER, y + radius * LAT_PER_METER)
+
+    return trees_city
+
+
+def load_detected_trees(path: Path) -> gpd.GeoDataFrame:
+    """
+    Load trees detected by us from CSV, GeoParquet or Arrow IPC with their
+    box as geometry
+
+    :return: detected trees
+    """
+
+    trees_detected = read_trees(path)
+    trees_detected["geometry_detect"] = gpd.points_from_xy(trees_detected["xcenter_coord"], trees_detected["ycenter_coord"], crs="EPSG:4326")
+
+    # merge tiles
+    trees_detected = trees_detected.loc[(trees_detected.score>=0.00000)&(trees_detected.diameter<=MAX_DETECT_DIAMETER)]
+
+    return trees_detected
+
+
+def box_iou(
+    boxes_a: np.ndarray,
+    boxes_b: np.ndarray
+) -> np.ndarray:
+    """
+    IoU of pairs of axis-aligned boxes given by their bounds
+
+    :return: IoU of each pair
+    """
+
+    width = np.clip(np.minimum(boxes_a[:, 2], boxes_b[:, 2]) - np.maximum(boxes_a[:, 0], boxes_b[:, 0]), 0, None)
+    height = np.clip(np.minimum(boxes_a[:, 3], boxes_b[:, 3]) - np.maximum(boxes_a[:, 1], boxes_b[:, 1]), 0, None)
+    intersection = width * height
+    areas_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    areas_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(intersection > 0, intersection / (areas_a + areas_b - intersection), 0)
+
+
+def greedy_matching(
+    first: np.ndarray,
+    second: np.ndarray,
+    costs: np.ndarray,
+    first_ids: np.ndarray,
+    second_ids: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Assign candidate pairs one-to-one by increasing cost. Ties are broken by
+    the ids of both sides, so the result does not depend on the row order.
+
+    :return: indexes of the assigned pairs
+    """
+
+    order = np.lexsort((second_ids[second], first_ids[first], costs))
+    used_first, used_second = set(), set()
+    matched = []
+
+    for index in order:
+        i, j = first[index], second[index]
+        if i in used_first or j in used_second:
+            continue
+        used_first.add(i)
+        used_second.add(j)
+        matched.append(index)
+
+    matched = np.array(matched, dtype=int)
+
+    return first[matched], second[matched]
+
+
+def overlap_pairs(
+    boxes_city: np.ndarray,
+    boxes_detected: np.ndarray,
+    min_iou: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the crown boxes intersecting with an IoU above min_iou with a bulk
+    query of an STRtree
+
+    :return: positions of the city and detected boxes and cost of each pair
+    """
+
+    tree = shapely.STRtree(boxes_detected)
+    first, second = tree.query(boxes_city, predicate="intersects")
+    iou = box_iou(shapely.bounds(boxes_city[first]), shapely.bounds(boxes_detected[second]))
+    candidates = iou > min_iou
+
+    return first[candidates], second[candidates], -iou[candidates]
+
+
+def distance_pairs(
+    points_city: np.ndarray,
+    points_detected: np.ndarray,
+    max_distance: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the metric points closer than max_distance meters with a bulk query
+    of an STRtree
+
+    :return: positions of the city and detected points and cost of each pair
+    """
+
+    tree = shapely.STRtree(points_detected)
+    first, second = tree.query(points_city, predicate="dwithin", distance=max_distance)
+
+    return first, second, shapely.distance(points_city[first], points_detected[second])
+
+
+def metric_points(points: gpd.GeoSeries) -> np.ndarray:
+    """
+    Points in the metric CRS
+
+    :return: points
+    """
+
+    return np.asarray(points.to_crs(METRIC_CRS).values)
+
+
+def candidate_pairs(
+    trees_city: gpd.GeoDataFrame,
+    trees_detected: gpd.GeoDataFrame,
+    method: str,
+    min_iou: float,
+    max_distance: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find candidate pairs of city trees and detected trees, either crown boxes
+    intersecting with an IoU above min_iou or tree points closer than
+    max_distance meters
+
+    :return: positions of the city and detected trees and cost of each pair
+    """
+
+    if method == "iou":
+        return overlap_pairs(np.asarray(trees_city.geometry.values), np.asarray(trees_detected.geometry.values), min_iou)
+
+    return distance_pairs(
+        metric_points(gpd.GeoSeries(trees_city.geometry_city.values, crs=trees_city.crs)),
+        metric_points(gpd.GeoSeries(trees_detected.geometry_detect.values, crs=trees_detected.crs)),
+        max_distance)
+
+
+def match_trees(
+    trees_city: gpd.GeoDataFrame,
+    trees_detected: gpd.GeoDataFrame,
+    method: str,
+    min_iou: float,
+    max_distance: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Match city trees and detected trees one-to-one, by decreasing IoU of
+    their crown boxes or by increasing distance of their points
+
+    :return: positions of the matched city and detected trees
+    """
+
+    first, second, costs = candidate_pairs(trees_city, trees_detected, method, min_iou, max_distance)
+
+    return greedy_matching(first, second, costs, trees_city.baumId.values, trees_detected.detectId.values)
+
+
+def merge_trees(
+    trees_city: gpd.GeoDataFrame,
+    trees_detected: gpd.GeoDataFrame,
+    method: str = "iou",
+    min_iou: float = 0.0,
+    max_distance: float = 5.0
+) -> gpd.GeoDataFrame:
+    """
+    Merge city trees and detected trees into trees found in both, only in
+    the kataster and only detected
+
+    :return: merged trees
+    """
+
+    city, detected = match_trees(trees_city, trees_detected, method, min_iou, max_distance)
+
+    return assemble_trees(trees_city, trees_detected, trees_city.iloc[city], trees_detected.iloc[detected])
+
+
+def assemble_trees(
+    trees_city: gpd.GeoDataFrame,
+    trees_detected: gpd.GeoDataFrame,
+    matched_city: gpd.GeoDataFrame,
+    matched_detected: gpd.GeoDataFrame,
+    matched_city_ids: Optional[np.ndarray] = None,
+    matched_detected_ids: Optional[np.ndarray] = None
+) -> gpd.GeoDataFrame:
+    """
+    Build the merged trees from the matched pairs and the unmatched city and
+    detected trees. Without the ids of all matched trees, the matched pairs
+    are all pairs.
+
+    :return: merged trees
+    """
+
+    # tree set 1
+    trees_1 = pd.concat([
+        matched_city.reset_index(drop=True),
+        pd.DataFrame(matched_detected.drop(columns=["geometry", "geometry_detect"])).reset_index(drop=True)
+    ], axis=1)
+    trees_1 = gpd.GeoDataFrame(trees_1, geometry="geometry", crs=trees_city.crs)
+    trees_1["geometry"] = trees_1["geometry_city"].values
+    trees_1["maintained"] = 1
+    trees_1["detected"] = 1
+
+    if matched_city_ids is None:
+        matched_city_ids = trees_1.baumId
+        matched_detected_ids = trees_1.detectId
+
+    # tree set 2
+    # trees in kataster
+    trees_2 = trees_city.loc[~trees_city.baumId.isin(matched_city_ids)]
+    trees_2["geometry"] = trees_2["geometry_city"].values
+    trees_2["maintained"] = 1
+    trees_2["detected"] = 0
+
+    # tree set 3
+    trees_3 = trees_detected.loc[~trees_detected.detectId.isin(matched_detected_ids)]
+    trees_3["geometry"] = trees_3["geometry_detect"].values
+    trees_3["maintained"] = 0
+    trees_3["detected"] = 1
+
+    trees = pd.concat([trees_1, trees_2, trees_3], ignore_index=True)
+
+    trees = trees.rename(columns=DETECT_COLUMNS)
+
+    trees = trees.astype({
+        "baumId": pd.Int64Dtype(),
+        "baumNr": pd.Int64Dtype(),
+        "baumart": pd.Int64Dtype(),
+        "hoeheM": pd.Int64Dtype(),
+        "kronendurchmesserM": pd.Int64Dtype(),
+        "stammumfangCM": pd.Int64Dtype(),
+        "detect_id": pd.Int64Dtype(),
+        "detect_x_min": pd.Int64Dtype(),
+        "detect_y_min": pd.Int64Dtype(),
+        "detect_x_max": pd.Int64Dtype(),
+        "detect_y_max": pd.Int64Dtype()
+    })
+
+    cols = [
+        'baumId', 'baumNr', 'baumart', 'hoeheM', 'kronendurchmesserM', 'stammumfangCM',
+        'location', 'Name_dt', 'Name_lat', 'Name_Sym', 'detect_id', 'detect_x_min',
+           'detect_y_min', 'detect_x_max', 'detect_y_max', 'detect_x_min_coord',
+           'detect_y_min_coord', 'detect_x_max_coord', 'detect_y_max_coord',
+           'detect_x_center_coord', 'detect_y_center_coord', 'detect_diameter',
+           'detect_crown_area',
+           'detect_score', 'maintained', 'detected', "geometry"
+    ]
+
+    return trees.loc[:, cols]
+
+
+def grid_cells(
+    points: np.ndarray,
+    cell_size: float
+) -> np.ndarray:
+    """
+    Grid cell of metric points
+
+    :return: column and row of the cell of each point
+    """
+
+    return np.floor(shapely.get_coordinates(points) / cell_size).astype(np.int64)
+
+
+def cell_groups(cells: np.ndarray) -> dict:
+    """
+    Group points by their grid cell, sorting the cells once instead of
+    comparing every point with every cell
+
+    :return: ascending positions of the points of each (col, row) cell
+    """
+
+    order = np.lexsort((cells[:, 1], cells[:, 0]))
+    keys, starts = np.unique(cells[order], axis=0, return_index=True)
+
+    return dict(zip(map(tuple, keys.tolist()), np.split(order, starts[1:])))
+
+
+def cell_pairs(
+    method: str,
+    city: np.ndarray,
+    detected: np.ndarray,
+    min_iou: float,
+    max_distance: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the candidate pairs of the city trees of a cell in a worker process.
+    Only plain arrays are sent to the worker, crown box bounds for iou and
+    metric coordinates for distance.
+
+    :return: positions in city and detected and cost of each pair
+    """
+
+    if method == "iou":
+        return overlap_pairs(shapely.box(*city.T), shapely.box(*detected.T), min_iou)
+
+    return distance_pairs(shapely.points(city), shapely.points(detected), max_distance)
+
+
+def merge_partitioned(
+    trees_city: gpd.GeoDataFrame,
+    trees_detected: gpd.GeoDataFrame,
+    outputs: Path,
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> int:
+    """
+    Merge city trees and detected trees cell by cell of a grid. Cells are
+    made of smaller cells as large as the reach of a pair, the crown boxes or
+    max_distance, so the candidate pairs of the city trees of a cell are all
+    found among the detections of the cell and the ring of small cells
+    around it. These are found in a process pool and then assigned one-to-one together, which only needs
+    their ids and costs, so the matches are the same as in a single pass.
+    The merged trees are assembled and written in chunks of cells.
+
+    :return: number of merged trees
+    """
+
+    trees_city = trees_city.reset_index(drop=True)
+    trees_detected = trees_detected.reset_index(drop=True)
+
+    points_city = metric_points(gpd.GeoSeries(trees_city.geometry_city.values, crs=trees_city.crs))
+    points_detected = metric_points(gpd.GeoSeries(trees_detected.geometry_detect.values, crs=trees_detected.crs))
+
+    if args.match == "iou":
+        data_city = shapely.bounds(trees_city.geometry.values)
+        data_detected = shapely.bounds(trees_detected.geometry.values)
+        # half extent in meters of the largest city and detected box
+        reach = sum(
+            max(((bounds[:, 2] - bounds[:, 0]) / LON_PER_METER).max(initial=0), ((bounds[:, 3] - bounds[:, 1]) / LAT_PER_METER).max(initial=0)) / 2
+            for bounds in (data_city, data_detected))
+    else:
+        data_city = shapely.get_coordinates(points_city)
+        data_detected = shapely.get_coordinates(points_detected)
+        reach = args.max_distance
+    # margin for the distortion between degrees and the metric CRS, a pair
+    # is at most one reach cell apart in each direction
+    reach *= 1.1
+    span = max(1, int(args.cell_size // reach))
+    reach_city = grid_cells(points_city, reach)
+    reach_detected = grid_cells(points_detected, reach)
+
+    city_cells = cell_groups(reach_city // span)
+    detected_cells = cell_groups(reach_detected // span)
+    empty = np.empty(0, dtype=int)
+
+    cells = list(city_cells)
+    halos = []
+    for col, row in cells:
+        positions = np.concatenate([detected_cells.get((col + i, row + j), empty) for i in (-1, 0, 1) for j in (-1, 0, 1)])
+        lower = np.array([col, row]) * span - 1
+        near = ((reach_detected[positions] >= lower) & (reach_detected[positions] <= lower + span + 1)).all(axis=1)
+        halos.append(positions[near])
+
+    logger.info(f"Starting finding candidate pairs in {len(cells)} cells of {span * reach:.0f} m with {args.workers} workers")
+
+    first, second, costs = [], [], []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = executor.map(
+            cell_pairs, [args.match] * len(cells), [data_city[city_cells[cell]] for cell in cells],
+            [data_detected[halo] for halo in halos], [args.min_iou] * len(cells), [args.max_distance] * len(cells),
+            chunksize=max(1, len(cells) // (args.workers * 4)))
+
+        for cell, halo, (cell_first, cell_second, cell_costs) in zip(cells, halos, results):
+            first.append(city_cells[cell][cell_first])
+            second.append(halo[cell_second])
+            costs.append(cell_costs)
+
+    first = np.concatenate(first) if first else empty
+    second = np.concatenate(second) if second else empty
+    costs = np.concatenate(costs) if costs else np.empty(0)
+    city, detected = greedy_matching(first, second, costs, trees_city.baumId.values, trees_detected.detectId.values)
+    logger.info(f"Matched {len(city)} of {len(first)} candidate pairs")
+
+    matched_city_ids = trees_city.baumId.values[city]
+    matched_detected_ids = trees_detected.detectId.values[detected]
+
+    # chunks of whole cells, matches go with the chunk of their city tree
+    chunk_of_city = np.zeros(len(trees_city), dtype=int)
+    chunks, chunk, size = [], ([], []), 0
+    for cell in sorted(set(city_cells) | set(detected_cells)):
+        chunk[0].append(city_cells.get(cell, empty))
+        chunk[1].append(detected_cells.get(cell, empty))
+        size += len(chunk[0][-1]) + len(chunk[1][-1])
+        if size >= MERGE_CHUNK_TREES:
+            chunks.append(chunk)
+            chunk, size = ([], []), 0
+    chunks.append(chunk)
+
+    chunks = [(np.sort(np.concatenate(city_chunk)), np.sort(np.concatenate(detected_chunk))) for city_chunk, detected_chunk in chunks]
+    for index, (city_chunk, detected_chunk) in enumerate(chunks):
+        chunk_of_city[city_chunk] = index
+    match_chunks = chunk_of_city[city]
+
+    writer = FrameWriter(outputs)
+    for index, (city_chunk, detected_chunk) in enumerate(chunks):
+        in_chunk = match_chunks == index
+        trees = assemble_trees(
+            trees_city.iloc[city_chunk], trees_detected.iloc[detected_chunk],
+            trees_city.iloc[city[in_chunk]], trees_detected.iloc[detected[in_chunk]],
+            matched_city_ids, matched_detected_ids)
+        writer.write(trees.astype({column: "string" for column in STRING_COLUMNS}))
+    writer.close()
+
+    return writer.count
+
+
+def stored_detections(stored: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Detected trees of merged trees read from the store, with the columns of
+    load_detected_trees
+
+    :return: detected trees
+    """
+
+    detected = pd.DataFrame(stored.loc[stored.detected == 1, list(DETECT_COLUMNS.values())])
+    detected = detected.rename(columns={value: key for key, value in DETECT_COLUMNS.items()})
+    detected = detected.astype({"detectId": "int64", "xmin": "int64", "ymin": "int64", "xmax": "int64", "ymax": "int64"})
+
+    detected = gpd.GeoDataFrame(detected, geometry=shapely.box(
+        detected.xmin_coord.values, detected.ymin_coord.values,
+        detected.xmax_coord.values, detected.ymax_coord.values), crs="EPSG:4326")
+    detected["geometry_detect"] = gpd.points_from_xy(detected.xcenter_coord, detected.ycenter_coord, crs="EPSG:4326")
+
+    return detected
+
+
+def pair_components(
+    first: np.ndarray,
+    second: np.ndarray,
+    count_first: int,
+    count_second: int
+) -> np.ndarray:
+    """
+    Connected components of the graph of candidate pairs, the greedy
+    matching of a component does not depend on the other components
+
+    :return: component of each first and then each second tree
+    """
+
+    labels = np.arange(count_first + count_second)
+    second = second + count_first
+
+    while True:
+        lowest = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, lowest)
+        np.minimum.at(updated, second, lowest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def merge_boxes(boxes: np.ndarray) -> np.ndarray:
+    """
+    Merge overlapping or touching boxes into their enclosing boxes until no
+    two boxes overlap
+
+    :return: bounds of the merged boxes
+    """
+
+    while True:
+        merged = shapely.bounds(shapely.envelope(shapely.get_parts(shapely.union_all(shapely.box(*boxes.T)))))
+        if len(merged) == len(boxes):
+            return merged
+        boxes = merged
+
+
+def merge_incremental(
+    trees_city: gpd.GeoDataFrame,
+    trees_detected: gpd.GeoDataFrame,
+    store: MergedStore,
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> int:
+    """
+    Update the merged trees of the store after changes of the detections in
+    some areas or of some city trees. The detections in the changed areas
+    are replaced by the new detections in these areas.
+
+    The city trees and detections in separate areas around the changes are
+    loaded from the cadastre, the new detections and the store. All
+    connected components of their candidate pairs with a changed tree, or
+    with a tree paired before to a changed tree, are matched again. The
+    areas grow until they contain every tree that can pair with a tree of
+    these components, so the store afterwards equals a full merge. Once the
+    areas hold more than FULL_MERGE_SHARE of the city trees, the store is
+    rebuilt instead.
+
+    :return: number of merged trees written
+    """
+
+    changed_area = None
+    trees_new = trees_detected.iloc[:0]
+    first_new = store.next_detect_id()
+
+    if args.changed_areas:
+        changed_area = shapely.union_all(gpd.read_file(args.changed_areas).to_crs("EPSG:4326").geometry.values)
+        shapely.prepare(changed_area)
+        trees_new = trees_detected.loc[shapely.intersects(changed_area, trees_detected.geometry_detect.values)]
+        trees_new = trees_new.assign(detectId=first_new + np.arange(len(trees_new)))
+
+    changed_ids = np.unique(np.asarray(args.changed_ids or [], dtype=np.int64))
+
+    city_x = trees_city.geometry_city.x.values
+    city_y = trees_city.geometry_city.y.values
+
+    # farthest distance between the points of two trees that can pair, in
+    # degrees at the northmost tree as LON_PER_METER is too short a step of
+    # longitude to bound it
+    if args.match == "iou":
+        reach = (np.nanmax(trees_city.kronendurchmesserM.values.astype(float)) / 2 + MAX_DETECT_DIAMETER) * 1.1
+    else:
+        reach = args.max_distance * 1.1
+    reach = np.array([reach * LAT_PER_METER / np.cos(np.radians(np.abs(city_y).max())), reach * LAT_PER_METER])
+
+    changed_city = trees_city.baumId.isin(changed_ids).to_numpy(dtype=bool)
+    stored_x, stored_y = store.positions(changed_ids)
+
+    x = np.concatenate([city_x[changed_city], stored_x, trees_new.xcenter_coord.values])
+    y = np.concatenate([city_y[changed_city], stored_y, trees_new.ycenter_coord.values])
+    areas = np.column_stack([x - reach[0], y - reach[1], x + reach[0], y + reach[1]])
+    if changed_area is not None:
+        areas = np.vstack([areas, shapely.bounds(shapely.get_parts(changed_area)) + np.concatenate([-reach, reach])])
+    if len(areas) == 0:
+        logger.info("No changed trees or areas")
+        return 0
+
+    # scattered changes are matched again in separate areas around them
+    areas = merge_boxes(areas)
+    city_points = trees_city.geometry_city.values
+
+    while True:
+        area_tree = shapely.STRtree(shapely.box(*areas.T))
+        in_areas = np.zeros(len(trees_city), dtype=bool)
+        in_areas[area_tree.query(city_points, predicate="intersects")[0]] = True
+        if np.count_nonzero(in_areas) > len(trees_city) * FULL_MERGE_SHARE:
+            logger.info(f"Changes reach {np.count_nonzero(in_areas)} of {len(trees_city)} city trees, rebuilding the store")
+            return merge_full(trees_city, trees_new, store, changed_area, args)
+
+        # matched pairs are stored at the city tree, up to reach away from
+        # the detection
+        stored = store.read(STORED_COLUMNS, areas + np.concatenate([-reach, reach]))
+        city = trees_city.loc[in_areas]
+
+        detected = stored_detections(stored)
+        if changed_area is not None:
+            dropped = shapely.intersects(changed_area, detected.geometry_detect.values)
+        else:
+            dropped = np.zeros(len(detected), dtype=bool)
+        dropped_ids = detected.detectId.values[dropped]
+        detected = pd.concat([detected.loc[~dropped], trees_new], ignore_index=True)
+
+        # pairs in the store, before the changes
+        pairs = stored.loc[(stored.maintained == 1) & (stored.detected == 1), ["baumId", "detect_id"]].astype("int64")
+
+        first, second, costs = candidate_pairs(city, detected, args.match, args.min_iou, args.max_distance)
+        labels = pair_components(first, second, len(city), len(detected))
+
+        city_ids = city.baumId.to_numpy(dtype=np.int64)
+        detected_ids = detected.detectId.values
+        affected = np.concatenate([
+            np.isin(city_ids, changed_ids) | np.isin(city_ids, pairs.baumId.values[np.isin(pairs.detect_id.values, dropped_ids)]),
+            (detected_ids >= first_new) | np.isin(detected_ids, pairs.detect_id.values[np.isin(pairs.baumId.values, changed_ids)])
+        ])
+
+        # trees paired before to an affected tree are affected as well
+        while True:
+            affected = np.isin(labels, labels[affected])
+            partners_city = pairs.baumId.values[np.isin(pairs.detect_id.values, detected_ids[affected[len(city):]])]
+            partners_detected = pairs.detect_id.values[np.isin(pairs.baumId.values, city_ids[affected[:len(city)]])]
+            grown = affected | np.concatenate([np.isin(city_ids, partners_city), np.isin(detected_ids, partners_detected)])
+            if np.array_equal(grown, affected):
+                break
+            affected = grown
+
+        # every tree that can pair with an affected tree must be loaded
+        x = np.concatenate([city.geometry_city.x.values, detected.xcenter_coord.values])[affected]
+        y = np.concatenate([city.geometry_city.y.values, detected.ycenter_coord.values])[affected]
+        needed = np.column_stack([x - reach[0], y - reach[1], x + reach[0], y + reach[1]])
+        covered = np.zeros(len(needed), dtype=bool)
+        covered[area_tree.query(shapely.box(*needed.T), predicate="within")[0]] = True
+
+        if covered.all():
+            break
+
+        areas = merge_boxes(np.vstack([areas, needed[~covered]]))
+        logger.info(f"Growing the changed areas to {len(areas)} areas")
+
+    affected_city = affected[:len(city)]
+    affected_detected = affected[len(city):]
+    logger.info(f"Matching {np.count_nonzero(affected_city)} city trees and {np.count_nonzero(affected_detected)} detected trees again")
+
+    # components are closed, every pair of an affected tree is affected
+    candidates = affected_city[first]
+    matched_city, matched_detected = greedy_matching(first[candidates], second[candidates], costs[candidates], city_ids, detected_ids)
+
+    trees = assemble_trees(
+        city.loc[affected_city], detected.loc[affected_detected],
+        city.iloc[matched_city], detected.iloc[matched_detected])
+
+    store.delete(
+        np.union1d(city_ids[affected_city], changed_ids),
+        np.union1d(detected_ids[affected_detected & (detected_ids < first_new)], dropped_ids))
+    store.append(trees.astype({column: "string" for column in STRING_COLUMNS}))
+
+    return len(trees)
+
+
+def merge_full(
+    trees_city: gpd.GeoDataFrame,
+    trees_new: gpd.GeoDataFrame,
+    store: MergedStore,
+    changed_area: Optional[shapely.Geometry],
+    args: argparse.Namespace
+) -> int:
+    """
+    Rebuild the store from all city trees and the stored detections, those
+    in the changed areas replaced by the new detections
+
+    :return: number of merged trees written
+    """
+
+    detected = stored_detections(store.read(STORED_COLUMNS))
+    if changed_area is not None:
+        detected = detected.loc[~shapely.intersects(changed_area, detected.geometry_detect.values)]
+    detected = pd.concat([detected, trees_new], ignore_index=True)
+
+    trees = merge_trees(trees_city, detected, args.match, args.min_iou, args.max_distance)
+    store.create(trees.astype({column: "string" for column in STRING_COLUMNS}))
+
+    return len(trees)
+
+
+def write_merged(
+    trees: gpd.GeoDataFrame,
+    outputs: Path
+) -> NoReturn:
+    """
+    Write merged trees as GeoParquet for .parquet, Arrow IPC for .arrow and
+    GeoJSON otherwise
+
+    :return: NoReturn
+    """
+
+    if output_format(outputs) == "parquet":
+        trees.to_parquet(outputs, compression="zstd", index=False)
+    elif output_format(outputs) == "arrow":
+        trees.to_feather(outputs, index=False)
+    else:
+        # categoricals cannot be written by fiona, 8 decimals are about a millimeter
+        trees.astype({column: "string" for column in STRING_COLUMNS}).to_file(outputs, driver="GeoJSON", COORDINATE_PRECISION=8)
+
+    return
+
+
+def get_logger():
+    # logger
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    # formatter
+    formatter = logging.Formatter(fmt="[%(asctime)s] %(levelname)s: %(message)s", datefmt="%Y-%m-%dT%H:%M:%SZ")
+
+    # handler
+    ch = logging.StreamHandler(stream=sys.stdout)
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    return logger
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Merge trees from kataster and detection")
+    parser.add_argument(
+        "--cadastre",
+        type=Path,
+        default=Path("data/raw/KN_Baumkataster_2020S.geojson"),
+        help="Path to the tree cadastre as CSV or GeoJSON (default: data/raw/KN_Baumkataster_2020S.geojson)"
+    )
+    parser.add_argument(
+        "--detected",
+        type=Path,
+        default=Path("data/processed/DOP_20_C_EPSG_4326.csv"),
+        help="Path to the detected trees as CSV, GeoParquet or Arrow IPC (default: data/processed/DOP_20_C_EPSG_4326.csv)"
+    )
+    parser.add_argument(
+        "--match",
+        type=str,
+        choices=["iou", "distance"],
+        default="iou",
+        help="Match trees one-to-one by IoU of their crown boxes or by distance of their points (default: iou)"
+    )
+    parser.add_argument(
+        "--min-iou",
+        type=float,
+        default=0.0,
+        help="Matched crown boxes need a larger IoU (default: 0.0, any overlap)"
+    )
+    parser.add_argument(
+        "--max-distance",
+        type=float,
+        default=5.0,
+        help="Maximum distance in meters of matched tree points (default: 5.0)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes matching grid cells, the merged trees are written in chunks of cells. Only pays off on inputs much larger than one city and several cores, a single pass is faster otherwise (default: 1)"
+    )
+    parser.add_argument(
+        "--cell-size",
+        type=float,
+        default=1000.0,
+        help="Size in meters of the grid cells for --workers, at least the reach of a pair (default: 1000.0)"
+    )
+    parser.add_argument(
+        "--store",
+        type=Path,
+        help="GeoPackage of the merged trees instead of --outputs, updated incrementally with --changed-areas or --changed-ids and otherwise rebuilt"
+    )
+    parser.add_argument(
+        "--changed-areas",
+        type=Path,
+        help="Polygons of the re-detected areas (e.g. footprints of changed tiles), the detections of --detected in these areas replace those in the store"
+    )
+    parser.add_argument(
+        "--changed-ids",
+        type=int,
+        nargs="+",
+        help="baumIds of changed, added or removed cadastre trees to merge again in the store"
+    )
+    parser.add_argument(
+        "--outputs",
+        type=Path,
+        default=Path("data/processed/DOP_20_C_EPSG_4326.geojson"),
+        help="Path to outputs, written as GeoParquet for .parquet, Arrow IPC for .arrow/.feather and GeoJSON otherwise (default: data/processed/DOP_20_C_EPSG_4326.geojson)"
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    # logger
+    logger = get_logger()
+
+    # args
+    args = get_parser().parse_args()
 
+    # tree merge
+    tree_merge(args=args, logger=logger)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Tree query
+----------
+
+Query the merged trees of tree_merge.py in memory
+
+The merged layer is loaded once into arrays: the points in WGS84 and in the
+metric CRS, the flags and measurements as small ints and the species and
+locations as categoricals. A KD-tree of the metric points answers radius
+and nearest neighbour queries, an R-tree of the WGS84 points bounding box
+queries. The trees of each species and location are kept as sorted row
+positions, so attribute filters only look at the matching rows.
+
+Queries return row positions, rows() turns them into a DataFrame. Run as
+script to benchmark the queries on a merged layer.
+
+"""
+
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from pathlib import Path
+from typing import Callable, NoReturn
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+from tree_io import output_format
+from tree_merge import LAT_PER_METER, LON_PER_METER, METRIC_CRS, get_logger
+
+COLUMNS = {
+    "baumId": "Int32",
+    "baumart": "Int16",
+    "hoeheM": "Int8",
+    "kronendurchmesserM": "Int8",
+    "stammumfangCM": "Int16",
+    "location": "category",
+    "Name_dt": "category",
+    "Name_lat": "category",
+    "detect_id": "Int32",
+    "detect_diameter": "float32",
+    "detect_score": "float32",
+    "maintained": "int8",
+    "detected": "int8"
+}
+
+
+def load_merged(path):
+    """
+    Reads merged trees written by tree_merge.py as GeoJSON, GeoParquet,
+    Arrow IPC or GeoPackage store
+    """
+    if output_format(path) == "parquet":
+        return gpd.read_parquet(path)
+    if output_format(path) == "arrow":
+        return gpd.read_feather(path)
+
+    return gpd.read_file(path)
+
+
+def category_index(values):
+    """
+    Returns the sorted row positions of each category of a categorical
+    """
+    codes = values.cat.codes.values
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(values.cat.categories) + 1))
+
+    return {category: order[bounds[code]:bounds[code + 1]] for code, category in enumerate(values.cat.categories)}
+
+
+class TreeIndex:
+    """
+    Merged trees with spatial and attribute indexes
+    """
+
+    def __init__(self, trees):
+        points = trees.geometry.to_crs("EPSG:4326")
+        self.lon = points.x.values
+        self.lat = points.y.values
+
+        self.transformer = Transformer.from_crs("EPSG:4326", METRIC_CRS, always_xy=True)
+        x, y = self.transformer.transform(self.lon, self.lat)
+        self.kdtree = cKDTree(np.column_stack([x, y]))
+        self.rtree = shapely.STRtree(shapely.points(self.lon, self.lat))
+
+        self.trees = pd.DataFrame({
+            column: pd.Series(trees[column].values).astype(dtype)
+            for column, dtype in COLUMNS.items() if column in trees
+        })
+        self.maintained = self.trees.maintained.values.astype(bool)
+        self.detected = self.trees.detected.values.astype(bool)
+
+        self.species = category_index(self.trees.Name_lat)
+        self.species_codes = self.trees.Name_lat.cat.codes.values
+        self.species_names = self.trees.Name_lat.cat.categories.values
+        self.locations = category_index(self.trees.location)
+
+    def __len__(self):
+        return len(self.trees)
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load_merged(path))
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        Returns the sorted positions of the trees within a WGS84 bounding box
+        """
+        return np.sort(self.rtree.query(shapely.box(min_lon, min_lat, max_lon, max_lat)))
+
+    def radius(self, lon, lat, meters):
+        """
+        Returns the positions and distances in meters of the trees within a
+        radius around a WGS84 point, by increasing distance
+        """
+        point = self.transformer.transform(lon, lat)
+        positions = np.asarray(self.kdtree.query_ball_point(point, meters), dtype=int)
+        distances = np.hypot(*(self.kdtree.data[positions] - point).T)
+        order = np.argsort(distances, kind="stable")
+
+        return positions[order], distances[order]
+
+    def nearest(self, lon, lat, k=1):
+        """
+        Returns the positions and distances in meters of the k nearest trees
+        of a WGS84 point
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=int), np.empty(0)
+
+        distances, positions = self.kdtree.query(self.transformer.transform(lon, lat), k=list(range(1, k + 1)))
+
+        return positions, distances
+
+    def filter(self, species=None, location=None, maintained=None, detected=None, positions=None):
+        """
+        Returns the sorted positions of the trees with all given attributes,
+        out of positions if given. Species are latin names (Name_lat).
+        """
+        candidates = [np.sort(positions)] if positions is not None else []
+        if species is not None:
+            candidates.append(self.species.get(species, np.empty(0, dtype=int)))
+        if location is not None:
+            candidates.append(self.locations.get(location, np.empty(0, dtype=int)))
+
+        if candidates:
+            result = min(candidates, key=len)
+            for other in candidates:
+                if other is not result:
+                    result = result[np.isin(result, other, assume_unique=True)]
+        else:
+            result = np.arange(len(self))
+
+        if maintained is not None:
+            result = result[self.maintained[result] == bool(maintained)]
+        if detected is not None:
+            result = result[self.detected[result] == bool(detected)]
+
+        return result
+
+    def species_counts(self, positions):
+        """
+        Returns the number of trees of each species among the positions
+        """
+        codes = self.species_codes[positions]
+        counts = np.bincount(codes[codes >= 0], minlength=len(self.species_names))
+        found = np.flatnonzero(counts)
+        found = found[np.argsort(-counts[found], kind="stable")]
+
+        return pd.Series(counts[found], index=self.species_names[found])
+
+    def rows(self, positions):
+        """
+        Returns the trees at the positions with their WGS84 point
+        """
+        rows = self.trees.iloc[positions].copy()
+        rows["lon"] = self.lon[positions]
+        rows["lat"] = self.lat[positions]
+
+        return rows
+
+
+def time_queries(
+    query: Callable,
+    arguments: list
+) -> pd.Series:
+    """
+    Run a query once per arguments
+
+    :return: latency percentiles in microseconds and mean number of results
+    """
+
+    latencies, results = [], []
+    for argument in arguments:
+        start = time.perf_counter()
+        result = query(*argument)
+        latencies.append(time.perf_counter() - start)
+        results.append(len(result[0] if isinstance(result, tuple) else result))
+
+    latencies = np.array(latencies) * 1e6
+
+    return pd.Series({
+        "p50_us": np.percentile(latencies, 50),
+        "p99_us": np.percentile(latencies, 99),
+        "max_us": latencies.max(),
+        "mean_results": np.mean(results)
+    })
+
+
+def tree_query_benchmark(
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Time bounding box, radius, nearest neighbour and attribute queries at
+    random points of the merged trees
+
+    :return: NoReturn
+    """
+
+    logger.info(f"Starting tree query benchmark with arguments {args}")
+
+    trees = load_merged(args.merged)
+
+    start = time.perf_counter()
+    index = TreeIndex(trees)
+    logger.info(f"Indexed {len(index)} trees in {time.perf_counter() - start:.2f} s")
+
+    rng = np.random.default_rng(args.seed)
+    centers = rng.choice(len(index), args.queries)
+    lon, lat = index.lon[centers], index.lat[centers]
+    half_lon, half_lat = args.radius * LON_PER_METER, args.radius * LAT_PER_METER
+
+    species = rng.choice(list(index.species), args.queries)
+    locations = rng.choice(list(index.locations), args.queries)
+    boxes = [(x - half_lon * 4, y - half_lat * 4, x + half_lon * 4, y + half_lat * 4) for x, y in zip(lon, lat)]
+
+    results = pd.DataFrame({
+        "bbox": time_queries(index.bbox, boxes),
+        "radius": time_queries(index.radius, [(x, y, args.radius) for x, y in zip(lon, lat)]),
+        "nearest": time_queries(index.nearest, [(x, y, args.k) for x, y in zip(lon, lat)]),
+        "species": time_queries(lambda name: index.filter(species=name), [(name,) for name in species]),
+        "undetected_in_location": time_queries(
+            lambda name: index.filter(location=name, maintained=1, detected=0), [(name,) for name in locations]),
+        "species_counts_in_bbox": time_queries(lambda *bounds: index.species_counts(index.bbox(*bounds)), boxes)
+    }).T
+
+    print(results.to_string(float_format="%.1f"))
+
+    if args.outputs:
+        results.to_csv(args.outputs, index_label="query")
+
+    return
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark in-memory queries of the merged trees")
+    parser.add_argument(
+        "--merged",
+        type=Path,
+        default=Path("data/processed/DOP_20_C_EPSG_4326.geojson"),
+        help="Merged trees of tree_merge.py as GeoJSON, GeoParquet, Arrow IPC or GeoPackage (default: data/processed/DOP_20_C_EPSG_4326.geojson)"
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=1000,
+        help="Number of queries of each kind (default: 1000)"
+    )
+    parser.add_argument(
+        "--radius",
+        type=float,
+        default=50.0,
+        help="Radius in meters of the radius queries, bounding boxes are 8 radii wide (default: 50.0)"
+    )
+    parser.add_argument(
+        "--k",
+        type=int,
+        default=10,
+        help="Number of nearest trees (default: 10)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the query points (default: 0)"
+    )
+    parser.add_argument(
+        "--outputs",
+        type=Path,
+        help="Path to the CSV of latencies"
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    # logger
+    logger = get_logger()
+
+    # args
+    args = get_parser().parse_args()
+
+    # tree query benchmark
+    tree_query_benchmark(args=args, logger=logger)
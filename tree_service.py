@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+
+Tree service
+------------
+
+Detect trees on ortho images with a model loaded once
+
+The service listens on a local HTTP endpoint. A job is posted as JSON with
+the raster path and the parameters of tree_detect.py, e.g.
+
+    curl -X POST localhost:8765/detect -d '{"raster_path": "data/DOP.tif"}'
+
+and answered with the CSV tree_detect.py writes. If the service was started
+with --output-folder, a job may set "outputs" to a path relative to that
+folder, the trees are written there as well in the format of its suffix.
+The windows of all pending jobs are predicted together in batches.
+
+"""
+
+import io
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+import pandas as pd
+import rasterio
+import torch
+from pathlib import Path
+from typing import List, NoReturn, Tuple
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from rasterio.windows import Window
+
+from tree_detect import COLUMNS, compute_windows, georeference_trees, get_logger, load_model, predict_batch, read_window, suppress, write_trees
+from tree_detect import get_parser as get_detect_parser
+
+JOB_PARAMETERS = {
+    "raster_path": str,
+    "patch_size": int,
+    "patch_overlap": (int, float),
+    "use_soft_nms": bool,
+    "sigma": (int, float),
+    "thresh": (int, float),
+    "outputs": str
+}
+
+
+class Job:
+    """
+    Detection job on one raster, predicted window by window
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.id = uuid.uuid4().hex
+        self.args = args
+        self.dataset = None
+        self.windows = deque()
+        self.boxes = []
+        self.remaining = 0
+        self.csv = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def open(self) -> NoReturn:
+        self.dataset = rasterio.open(self.args.raster_path)
+        rows = compute_windows(self.dataset.width, self.dataset.height, self.args.patch_size, self.args.patch_overlap)
+        self.windows.extend(window for _, windows in rows for window in windows)
+        self.remaining = len(self.windows)
+
+    def close(self) -> NoReturn:
+        if self.dataset is not None:
+            self.dataset.close()
+        self.done.set()
+
+
+class DetectionService:
+    """
+    Queue of detection jobs sharing one model. Batches are filled with the
+    next windows of all active jobs in turn. Only the scheduler thread opens
+    and closes the rasters of the jobs, handlers cancel their jobs and the
+    scheduler removes them.
+    """
+
+    def __init__(self, model, batch_size: int, logger: logging.Logger):
+        self.model = model
+        self.batch_size = batch_size
+        self.logger = logger
+        self.jobs = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self) -> NoReturn:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def alive(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def submit(self, args: argparse.Namespace) -> Job:
+        job = Job(args)
+
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify()
+
+        self.logger.info(f"Queued job {job.id} for {args.raster_path}")
+
+        return job
+
+    def pending(self) -> int:
+        with self.condition:
+            return len(self.jobs)
+
+    def run(self) -> NoReturn:
+        """
+        Predict batches of windows as long as jobs are pending
+
+        :return: NoReturn
+        """
+
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                jobs = list(self.jobs)
+
+            for job in jobs:
+                if job.cancelled:
+                    self.remove(job)
+                elif job.dataset is None and not job.done.is_set():
+                    try:
+                        job.open()
+                    except Exception as e:
+                        self.fail(job, e)
+
+            jobs = [job for job in jobs if not job.done.is_set()]
+
+            # an unexpected error fails the jobs of this round, not the scheduler
+            try:
+                batch = self.next_batch(jobs)
+
+                if batch:
+                    self.predict(batch)
+            except Exception as e:
+                for job in jobs:
+                    self.fail(job, e)
+
+            for job in jobs:
+                if job.remaining == 0 and not job.done.is_set() and not job.cancelled:
+                    self.finish(job)
+
+    def next_batch(self, jobs: List[Job]) -> List[Tuple[Job, Window]]:
+        """
+        Take windows of the same size from the jobs in turn, the batch size is
+        shared fairly between the jobs
+
+        :return: job and window of each crop of the batch
+        """
+
+        batch = []
+        shape = None
+
+        while len(batch) < self.batch_size:
+            added = False
+            for job in jobs:
+                if not job.windows or len(batch) >= self.batch_size:
+                    continue
+                window = job.windows[0]
+                if shape is not None and (window.height, window.width) != shape:
+                    continue
+                shape = (window.height, window.width)
+                batch.append((job, job.windows.popleft()))
+                added = True
+            if not added:
+                break
+
+        return batch
+
+    def predict(self, batch: List[Tuple[Job, Window]]) -> NoReturn:
+        crops = []
+
+        for job, window in batch:
+            try:
+                crops.append(read_window(job.dataset, window))
+            except Exception as e:
+                self.fail(job, e)
+                crops.append(None)
+
+        valid = [(item, crop) for item, crop in zip(batch, crops) if crop is not None]
+        if valid:
+            try:
+                predictions = predict_batch(self.model, [crop for _, crop in valid])
+            except Exception as e:
+                for job in {job for (job, _), _ in valid}:
+                    self.fail(job, e)
+                return
+
+            for ((job, window), _), boxes in zip(valid, predictions):
+                if boxes is not None:
+                    boxes[["xmin", "xmax"]] += window.col_off
+                    boxes[["ymin", "ymax"]] += window.row_off
+                    job.boxes.append(boxes)
+
+        for job, _ in batch:
+            job.remaining -= 1
+
+    def finish(self, job: Job) -> NoReturn:
+        """
+        Suppress the boxes of a finished job as predict_tile does and write the
+        trees as CSV
+
+        :return: NoReturn
+        """
+
+        try:
+            csv = io.StringIO()
+
+            if job.boxes:
+                trees = pd.concat(job.boxes, ignore_index=True)
+                if job.args.patch_overlap != 0:
+                    trees = suppress(trees, job.args.use_soft_nms, job.args.sigma, job.args.thresh)
+                trees["label"] = trees.label.apply(lambda x: self.model.numeric_to_label_dict[x])
+                trees = georeference_trees(trees, transform=job.dataset.transform, crs=job.dataset.crs)
+            else:
+                trees = pd.DataFrame(columns=COLUMNS)
+
+            write_trees(trees, csv)
+            job.csv = csv.getvalue()
+
+            if job.args.outputs:
+                write_trees(trees, Path(job.args.outputs))
+
+            self.logger.info(f"Finished job {job.id} with {len(trees)} trees")
+        except Exception as e:
+            job.error = str(e)
+            self.logger.error(f"Failed job {job.id}: {e}")
+
+        self.remove(job)
+
+    def fail(self, job: Job, error: Exception) -> NoReturn:
+        if job.done.is_set():
+            return
+
+        with self.condition:
+            if not job.cancelled:
+                job.error = str(error) or type(error).__name__
+        self.remove(job)
+
+        self.logger.error(f"Failed job {job.id}: {job.error}")
+
+    def cancel(self, job: Job, error: Exception) -> bool:
+        """
+        Fail a job from a waiting handler, its raster may still be read by the
+        scheduler, which removes the job in its next round
+
+        :return: whether the job was cancelled before it was done
+        """
+
+        with self.condition:
+            if job.done.is_set() or job.cancelled:
+                return job.cancelled
+            job.error = str(error) or type(error).__name__
+            job.cancelled = True
+            self.condition.notify()
+
+        self.logger.error(f"Cancelled job {job.id}: {job.error}")
+
+        return True
+
+    def wait(self, job: Job, timeout: float) -> bool:
+        """
+        Wait until the job is done, the job is cancelled if it takes longer
+        than the timeout or the scheduler stopped
+
+        :return: whether the job finished in time
+        """
+
+        start = time.monotonic()
+        while not job.done.wait(1.0):
+            if not self.alive():
+                return not self.cancel(job, RuntimeError("Detection scheduler stopped"))
+            if time.monotonic() - start > timeout:
+                return not self.cancel(job, TimeoutError(f"Job did not finish within {timeout} s"))
+
+        return True
+
+    def remove(self, job: Job) -> NoReturn:
+        with self.condition:
+            if job in self.jobs:
+                self.jobs.remove(job)
+        job.close()
+
+
+def parse_job(body: bytes, output_folder: Path = None) -> argparse.Namespace:
+    """
+    Parse and check the parameters of a job, missing parameters take the
+    defaults of tree_detect.py. Outputs are only written inside the output
+    folder.
+
+    :return: job arguments
+    """
+
+    parameters = json.loads(body or b"{}")
+    if not isinstance(parameters, dict):
+        raise ValueError("Job must be a JSON object")
+    parameters = {key.replace("-", "_"): value for key, value in parameters.items()}
+
+    unknown = set(parameters) - set(JOB_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters {sorted(unknown)}")
+    if not parameters.get("raster_path"):
+        raise ValueError("Missing raster_path")
+
+    for key, value in parameters.items():
+        # bool is an int in Python
+        if not isinstance(value, JOB_PARAMETERS[key]) or (isinstance(value, bool) and JOB_PARAMETERS[key] is not bool):
+            raise ValueError(f"Invalid {key} {value!r}")
+
+    args = get_detect_parser().parse_args([])
+    for key, value in parameters.items():
+        setattr(args, key, value)
+
+    if args.patch_size <= 0:
+        raise ValueError(f"Invalid patch_size {args.patch_size}, must be positive")
+    if not 0 <= args.patch_overlap < 1:
+        raise ValueError(f"Invalid patch_overlap {args.patch_overlap}, must be in [0, 1)")
+    if args.sigma <= 0:
+        raise ValueError(f"Invalid sigma {args.sigma}, must be positive")
+
+    args.raster_path = Path(args.raster_path)
+
+    if args.outputs:
+        if output_folder is None:
+            raise ValueError("outputs needs a service started with --output-folder")
+        outputs = (output_folder / args.outputs).resolve()
+        if not outputs.is_relative_to(output_folder.resolve()):
+            raise ValueError(f"outputs {args.outputs} not inside the output folder")
+        args.outputs = outputs
+
+    return args
+
+
+def get_handler(service: DetectionService, job_timeout: float, output_folder: Path = None):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != "/health":
+                self.respond(404, "Not found")
+                return
+            self.respond(200, json.dumps({"pending": service.pending()}), "application/json")
+
+        def do_POST(self):
+            if self.path != "/detect":
+                self.respond(404, "Not found")
+                return
+
+            try:
+                args = parse_job(self.rfile.read(int(self.headers.get("Content-Length", 0))), output_folder)
+            except ValueError as e:
+                self.respond(400, str(e))
+                return
+
+            if not service.alive():
+                self.respond(503, "Detection scheduler stopped")
+                return
+
+            job = service.submit(args)
+
+            if not service.wait(job, job_timeout):
+                self.respond(503, job.error)
+            elif job.error is not None:
+                self.respond(500, job.error)
+            else:
+                self.respond(200, job.csv, "text/csv")
+
+        def respond(self, status: int, body: str, content_type: str = "text/plain"):
+            data = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            service.logger.debug(f"{self.address_string()} {format % args}")
+
+    return Handler
+
+
+def tree_service(
+    args: argparse.Namespace,
+    logger: logging.Logger
+) -> NoReturn:
+    """
+    Load the model and serve detection jobs until interrupted
+
+    :return: NoReturn
+    """
+
+    logger.info(f"Starting tree service with arguments {args}")
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    logger.info(f"Starting loading model")
+    service = DetectionService(load_model(), args.batch_size, logger)
+    service.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), get_handler(service, args.job_timeout, args.output_folder))
+    logger.info(f"Listening on http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    logger.info("Finished tree service")
+
+    return
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Serve tree detection with a model loaded once")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Host to listen on (default: 127.0.0.1)"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port to listen on (default: 8765)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=8,
+        help="Number of windows predicted in one forward pass (default: 8)"
+    )
+    parser.add_argument(
+        "--job-timeout",
+        type=float,
+        default=3600.0,
+        help="Seconds a request waits for its job before it fails with 503 (default: 3600.0)"
+    )
+    parser.add_argument(
+        "--output-folder",
+        type=Path,
+        help="Folder jobs may write their outputs to, jobs with outputs are refused without it (default: None)"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Number of torch threads, 0 keeps the torch default (default: 0)"
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    # logger
+    logger = get_logger()
+
+    # args
+    args = get_parser().parse_args()
+
+    # tree service
+    tree_service(args=args, logger=logger)